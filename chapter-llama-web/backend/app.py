@@ -1,6 +1,7 @@
 import os
 import tempfile
 import asyncio
+import threading
 from pathlib import Path
 from flask import Flask, request, jsonify
 from flask_cors import CORS
@@ -18,9 +19,20 @@ from tools.download.models import download_model
 app = Flask(__name__)
 CORS(app)
 
-# Global model cache
-model_cache = {}
-current_model = None
+# One base model, with the LoRA of each requested model loaded next to the others
+inference_model = None
+model_lock = threading.Lock()
+
+def init_model(model_name):
+    """Load the base model once and the LoRA of `model_name` if needed"""
+    global inference_model
+    with model_lock:
+        if inference_model is None:
+            inference_model = LlamaInference(ckpt_path="meta-llama/Llama-3.1-8B-Instruct", fast_load=True)
+        if model_name not in inference_model.adapters:
+            model_path = download_model(model_name)
+            inference_model.load_adapter(model_name, model_path)
+        return inference_model
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -67,21 +79,11 @@ def process_video():
         if not video_url:
             return jsonify({"error": "No video URL provided"}), 400
         
-        # Load model if not cached
-        global current_model
-        if current_model is None or current_model != model_name:
-            try:
-                model_path = download_model(model_name)
-                inference_model = LlamaInference(
-                    ckpt_path="meta-llama/Llama-3.1-8B-Instruct",
-                    peft_model=model_path
-                )
-                model_cache[model_name] = inference_model
-                current_model = model_name
-            except Exception as e:
-                return jsonify({"error": f"Failed to load model: {str(e)}"}), 500
-        
-        inference_model = model_cache[model_name]
+        # Load the LoRA of the model if it is not loaded yet
+        try:
+            inference_model = init_model(model_name)
+        except Exception as e:
+            return jsonify({"error": f"Failed to load model: {str(e)}"}), 500
         
         # Create temporary directory for video processing
         with tempfile.TemporaryDirectory() as temp_dir:
@@ -122,7 +124,8 @@ def process_video():
                     max_new_tokens=1024,
                     do_sample=do_sample,
                     vid_id=vid_id,
-                    vid_duration=single_video.get_duration(vid_id)
+                    vid_duration=single_video.get_duration(vid_id),
+                    adapter=model_name
                 )
                 
                 if isinstance(output_text, int):
@@ -167,21 +170,11 @@ def process_file():
         if video_file.filename == '':
             return jsonify({"error": "No video file selected"}), 400
         
-        # Load model if not cached
-        global current_model
-        if current_model is None or current_model != model_name:
-            try:
-                model_path = download_model(model_name)
-                inference_model = LlamaInference(
-                    ckpt_path="meta-llama/Llama-3.1-8B-Instruct",
-                    peft_model=model_path
-                )
-                model_cache[model_name] = inference_model
-                current_model = model_name
-            except Exception as e:
-                return jsonify({"error": f"Failed to load model: {str(e)}"}), 500
-        
-        inference_model = model_cache[model_name]
+        # Load the LoRA of the model if it is not loaded yet
+        try:
+            inference_model = init_model(model_name)
+        except Exception as e:
+            return jsonify({"error": f"Failed to load model: {str(e)}"}), 500
         
         # Create temporary directory for video processing
         with tempfile.TemporaryDirectory() as temp_dir:
@@ -205,7 +198,8 @@ def process_file():
                     max_new_tokens=1024,
                     do_sample=do_sample,
                     vid_id=vid_id,
-                    vid_duration=single_video.get_duration(vid_id)
+                    vid_duration=single_video.get_duration(vid_id),
+                    adapter=model_name
                 )
                 
                 if isinstance(output_text, int):
@@ -1,5 +1,6 @@
 import os
 import tempfile
+import threading
 from pathlib import Path
 from flask import Flask, request, jsonify
 from flask_cors import CORS
@@ -9,38 +10,41 @@ import yt_dlp
 from src.data.single_video import SingleVideo
 from src.data.utils_asr import PromptASR
 from src.models.llama_inference import LlamaInference
+from src.models.llama_scheduler import LlamaScheduler
 from src.test.vidchapters import get_chapters
 from tools.download.models import download_model
 
 app = Flask(__name__)
 CORS(app)
 
-# Global model cache
-model_cache = {}
+# One scheduler shared by all request threads, on a single base model with the
+# LoRA of every requested model loaded next to the others
+scheduler = None
+model_lock = threading.Lock()
 
 def init_model(model_name="asr-10k"):
-    """Initialize and cache the Chapter-Llama model"""
-    if model_name not in model_cache:
-        print(f"🔄 Loading Chapter-Llama model: {model_name}")
+    """Initialize the Chapter-Llama base model and load the LoRA of `model_name`"""
+    global scheduler
+    with model_lock:
         try:
-            # Download the model weights
-            model_path = download_model(model_name)
-            
-            # Initialize inference model
-            inference = LlamaInference(
-                ckpt_path="meta-llama/Llama-3.1-8B-Instruct", 
-                peft_model=model_path
-            )
-            
-            model_cache[model_name] = inference
-            print(f"✅ Model {model_name} loaded successfully")
-            return inference
-            
+            if scheduler is None:
+                inference = LlamaInference(ckpt_path="meta-llama/Llama-3.1-8B-Instruct", fast_load=True)
+                # Concurrent requests are decoded together (continuous batching),
+                # whatever their model
+                scheduler = LlamaScheduler.from_inference(inference)
+
+            if model_name not in scheduler.adapters:
+                print(f"🔄 Loading Chapter-Llama model: {model_name}")
+                # Download the model weights
+                model_path = download_model(model_name)
+                scheduler.load_adapter(model_name, model_path)
+                print(f"✅ Model {model_name} loaded successfully")
+
         except Exception as e:
             print(f"❌ Error loading model {model_name}: {str(e)}")
             return None
-    
-    return model_cache[model_name]
+
+        return scheduler
 
 def download_youtube_video(url, output_dir="/tmp"):
     """Download YouTube video using yt-dlp"""
@@ -86,7 +90,11 @@ def process_video_with_model(video_path, model_name="asr-10k"):
             full_prompt,
             max_new_tokens=1024,
             do_sample=False,
+            vid_duration=single_video.get_duration(vid_id, hms=True),
             vid_id=vid_id,
+            # Every line is a valid chapter, no retry with sampling is needed
+            constrained=True,
+            adapter=model_name,
         )
         
         # Format chapters for frontend
@@ -238,4 +246,5 @@ if __name__ == '__main__':
     # init_model("asr-10k")
     # print("✅ Default model preloaded")
     
-    app.run(debug=True, port=5328, host='0.0.0.0')
+    # Threaded server: concurrent requests share the scheduler's decode loop
+    app.run(debug=True, port=5328, host='0.0.0.0', threaded=True)
@@ -1,25 +1,26 @@
 import os
 import tempfile
+import threading
 from pathlib import Path
 
 import gradio as gr
-from llama_cookbook.inference.model_utils import load_model as load_model_llamarecipes
-from llama_cookbook.inference.model_utils import load_peft_model
-from transformers import AutoTokenizer
 
 from src.data.single_video import SingleVideo
 from src.data.utils_asr import PromptASR
-from src.models.llama_inference import inference
-from src.test.vidchapters import get_chapters
+from src.models.llama_inference import LlamaInference
+from src.models.llama_scheduler import LlamaScheduler
+from src.test.vidchapters import stream_chapters
 from tools.download.models import download_model
 
 # Global variables to store loaded models
 base_model = None
 tokenizer = None
-current_peft_model = None
 inference_model = None
+model_lock = threading.Lock()
 
 LLAMA_CKPT_PATH = "meta-llama/Llama-3.1-8B-Instruct"
+# Requests processed at the same time, their generation is batched by the scheduler
+MAX_CONCURRENT_REQUESTS = 8
 
 
 def load_base_model():
@@ -28,110 +29,43 @@ def load_base_model():
 
     if base_model is None:
         print(f"Loading base model: {LLAMA_CKPT_PATH}")
-        base_model = load_model_llamarecipes(
-            model_name=LLAMA_CKPT_PATH,
-            device_map="auto",
-            quantization=None,
-            use_fast_kernels=True,
+        inference = LlamaInference(
+            LLAMA_CKPT_PATH, use_fast_kernels=True, fast_load=True
         )
-        base_model.eval()
-
-        tokenizer = AutoTokenizer.from_pretrained(LLAMA_CKPT_PATH)
-        tokenizer.pad_token = tokenizer.eos_token
-
-        print("Base model loaded successfully")
-
-
-class FastLlamaInference:
-    def __init__(
-        self,
-        model,
-        add_special_tokens: bool = True,
-        temperature: float = 1.0,
-        max_new_tokens: int = 1024,
-        top_p: float = 1.0,
-        top_k: int = 50,
-        use_cache: bool = True,
-        max_padding_length: int = None,
-        do_sample: bool = False,
-        min_length: int = None,
-        repetition_penalty: float = 1.0,
-        length_penalty: int = 1,
-        max_prompt_tokens: int = 35_000,
-    ):
-        self.model = model
-        self.tokenizer = tokenizer
-        self.add_special_tokens = add_special_tokens
-        self.temperature = temperature
-        self.max_new_tokens = max_new_tokens
-        self.top_p = top_p
-        self.top_k = top_k
-        self.use_cache = use_cache
-        self.max_padding_length = max_padding_length
-        self.do_sample = do_sample
-        self.min_length = min_length
-        self.repetition_penalty = repetition_penalty
-        self.length_penalty = length_penalty
-        self.max_prompt_tokens = max_prompt_tokens
-
-    def __call__(self, prompt: str, **kwargs):
-        # Create a dict of default parameters from instance attributes
-        params = {
-            "model": self.model,
-            "tokenizer": self.tokenizer,
-            "prompt": prompt,
-            "add_special_tokens": self.add_special_tokens,
-            "temperature": self.temperature,
-            "max_new_tokens": self.max_new_tokens,
-            "top_p": self.top_p,
-            "top_k": self.top_k,
-            "use_cache": self.use_cache,
-            "max_padding_length": self.max_padding_length,
-            "do_sample": self.do_sample,
-            "min_length": self.min_length,
-            "repetition_penalty": self.repetition_penalty,
-            "length_penalty": self.length_penalty,
-            "max_prompt_tokens": self.max_prompt_tokens,
-        }
-
-        # Update with any overrides passed in kwargs
-        params.update(kwargs)
+        base_model, tokenizer = inference.model, inference.tokenizer
 
-        return inference(**params)
+        stages = ", ".join(f"{k} {v:.1f}s" for k, v in inference.load_times.items())
+        print(f"Base model loaded successfully ({stages})")
 
 
 def load_peft(model_name: str = "asr-10k"):
-    """Load or switch PEFT model while reusing the base model."""
-    global base_model, current_peft_model, inference_model
-
-    # First make sure the base model is loaded
-    if base_model is None:
-        load_base_model()
-
-    # Only load a new PEFT model if it's different from the current one
-    if current_peft_model != model_name:
-        print(f"Loading PEFT model: {model_name}")
-        model_path = download_model(model_name)
-
-        if not Path(model_path).exists():
-            print(f"PEFT model does not exist at {model_path}")
-            return False
+    """Load the LoRA of a model next to the others, on the shared base model."""
+    global inference_model
+
+    with model_lock:
+        # First make sure the base model is loaded
+        if base_model is None:
+            load_base_model()
+        # Concurrent requests share one decode loop (continuous batching),
+        # whatever their LoRA
+        if inference_model is None:
+            inference_model = LlamaScheduler(
+                base_model, tokenizer, max_batch_size=MAX_CONCURRENT_REQUESTS
+            )
 
-        # Apply the PEFT model to the base model
-        peft_model = load_peft_model(base_model, model_path)
+        if model_name not in inference_model.adapters:
+            print(f"Loading PEFT model: {model_name}")
+            model_path = download_model(model_name)
 
-        peft_model.eval()
+            if model_path is None or not Path(model_path).exists():
+                print(f"PEFT model does not exist at {model_path}")
+                return False
 
-        # Create the inference wrapper
-        inference_model = FastLlamaInference(model=peft_model)
-        current_peft_model = model_name
+            inference_model.load_adapter(model_name, model_path)
+            print(f"PEFT model {model_name} loaded successfully")
 
-        print(f"PEFT model {model_name} loaded successfully")
         return True
 
-    # Model already loaded
-    return True
-
 
 def download_from_url(url, output_path):
     """Download a video from a URL using yt-dlp and save it to output_path."""
@@ -175,18 +109,20 @@ def download_from_url(url, output_path):
 def process_video(
     video_file, video_url, model_name: str = "asr-10k", do_sample: bool = False
 ):
-    """Process a video file or URL and generate chapters."""
+    """Process a video file or URL and yield the chapters as they are generated."""
     progress = gr.Progress()
     progress(0, desc="Starting...")
 
     # Check if we have a valid input
     if video_file is None and not video_url:
-        return "Please upload a video file or provide a URL."
+        yield "Please upload a video file or provide a URL."
+        return
 
     # Load the PEFT model
     progress(0.1, desc=f"Loading LoRA parameters from {model_name}...")
     if not load_peft(model_name):
-        return "Failed to load model. Please try again."
+        yield "Failed to load model. Please try again."
+        return
 
     # Create a temporary directory to save the uploaded or downloaded video
     with tempfile.TemporaryDirectory() as temp_dir:
@@ -202,7 +138,8 @@ def process_video(
             progress(0.2, desc=f"Downloading video from URL: {video_url}...")
             success, error_msg = download_from_url(video_url, temp_video_path)
             if not success:
-                return f"Failed to download video: {error_msg}"
+                yield f"Failed to download video: {error_msg}"
+                return
 
         # Process the video
         progress(0.3, desc="Extracting ASR transcript...")
@@ -218,13 +155,36 @@ def process_video(
         prompt = prompt + transcript
 
         progress(0.6, desc="Generating chapters with Chapter-Llama...")
-        _, chapters = get_chapters(
+        # Show each chapter as soon as its line is generated
+        output = ""
+        chapter_stream = stream_chapters(
             inference_model,
             prompt,
             max_new_tokens=1024,
             do_sample=do_sample,
+            vid_duration=single_video.get_duration(vid_id, hms=True),
             vid_id=vid_id,
+            # Every line is a valid chapter, no retry with sampling is needed
+            constrained=True,
+            adapter=model_name,
         )
+        while True:
+            try:
+                chapter = next(chapter_stream)
+            except StopIteration as stop:
+                _, chapters = stop.value
+                break
+            if chapter is None:
+                # Generated again, the previous chapters are discarded
+                output = ""
+                continue
+            timestamp, text = chapter
+            output += f"{timestamp}: {text}\n"
+            yield output
+
+        if chapters is None:
+            yield "The transcript of this video is too long for the model."
+            return
 
         # Format the output
         progress(0.9, desc="Formatting results...")
@@ -233,7 +193,7 @@ def process_video(
             output += f"{timestamp}: {text}\n"
 
         progress(1.0, desc="Complete!")
-        return output
+        yield output
 
 
 # CSS for the submit button color
@@ -323,14 +283,13 @@ with gr.Blocks(title="Chapter-Llama", head=head) as demo:
 
     def update_status_and_process(video_file, video_url, model_name, do_sample):
         if video_file is None and not video_url:
-            return (
+            yield (
                 "**Status:** No video uploaded or URL provided",
                 "Please upload a video file or provide a URL.",
             )
         else:
-            return "**Status:** Processing video...", process_video(
-                video_file, video_url, model_name, do_sample
-            )
+            for output in process_video(video_file, video_url, model_name, do_sample):
+                yield "**Status:** Processing video...", output
 
     # Load the base model at startup
     load_base_model()
@@ -339,6 +298,7 @@ with gr.Blocks(title="Chapter-Llama", head=head) as demo:
         fn=update_status_and_process,
         inputs=[video_input, video_url_input, model_dropdown, do_sample],
         outputs=[status_area, output_text],
+        concurrency_limit=MAX_CONCURRENT_REQUESTS,
     )
 
     gr.Markdown(bibtext)
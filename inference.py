@@ -21,7 +21,9 @@ def main(video_path: Path, model: str = "asr-10k"):
 
     model_path = download_model(model)
     inference = LlamaInference(
-        ckpt_path="meta-llama/Llama-3.1-8B-Instruct", peft_model=model_path
+        ckpt_path="meta-llama/Llama-3.1-8B-Instruct",
+        peft_model=model_path,
+        fast_load=True,
     )
 
     output_text, chapters = get_chapters(
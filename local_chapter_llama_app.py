@@ -1,5 +1,6 @@
 import os
 import tempfile
+import threading
 from pathlib import Path
 from flask import Flask, request, jsonify
 from flask_cors import CORS
@@ -13,55 +14,58 @@ os.environ['TOKENIZERS_PARALLELISM'] = 'false'
 from src.data.single_video import SingleVideo
 from src.data.utils_asr import PromptASR
 from src.models.llama_inference import LlamaInference
+from src.models.llama_scheduler import LlamaScheduler
 from src.test.vidchapters import get_chapters
 from tools.download.models import download_model
 
 app = Flask(__name__)
 CORS(app)
 
-# Global model cache with memory management
+# Global model cache with memory management: one scheduler per model, shared by
+# all request threads
 model_cache = {}
+model_lock = threading.Lock()
 OFFLOAD_DIR = "/tmp/model_offload"
 
 def init_model_with_memory_management(model_name="asr-10k"):
     """Initialize model with proper memory management"""
-    if model_name not in model_cache:
-        print(f"🔄 Loading Chapter-Llama model: {model_name}")
-        try:
-            # Download the model weights
-            model_path = download_model(model_name)
-            print(f"📦 Model path: {model_path}")
-            
-            # Initialize inference model with memory optimizations
-            inference = LlamaInference(
-                ckpt_path="meta-llama/Llama-3.1-8B-Instruct", 
-                peft_model=model_path,
-                offload_dir=OFFLOAD_DIR,  # Add offload directory
-                load_in_8bit=True,  # Use 8-bit quantization
-                device_map="auto"  # Automatic device mapping
-            )
-            
-            model_cache[model_name] = inference
-            print(f"✅ Model {model_name} loaded successfully with memory optimization")
-            return inference
-            
-        except Exception as e:
-            print(f"❌ Error loading model {model_name}: {str(e)}")
-            # Try with simplified configuration
+    with model_lock:
+        if model_name not in model_cache:
+            print(f"🔄 Loading Chapter-Llama model: {model_name}")
             try:
-                print("🔄 Retrying with simplified configuration...")
+                # Download the model weights
+                model_path = download_model(model_name)
+                print(f"📦 Model path: {model_path}")
+            
+                # Initialize inference model with memory optimizations
                 inference = LlamaInference(
                     ckpt_path="meta-llama/Llama-3.1-8B-Instruct", 
-                    peft_model=model_path
+                    peft_model=model_path,
+                    offload_dir=OFFLOAD_DIR,  # Add offload directory
+                    load_in_8bit=True,  # Use 8-bit quantization
+                    device_map="auto"  # Automatic device mapping
                 )
-                model_cache[model_name] = inference
-                print(f"✅ Model {model_name} loaded with simplified config")
-                return inference
-            except Exception as e2:
-                print(f"❌ Simplified config also failed: {str(e2)}")
-                return None
+            
+                # Concurrent requests are decoded together (continuous batching)
+                model_cache[model_name] = LlamaScheduler.from_inference(inference)
+                print(f"✅ Model {model_name} loaded successfully with memory optimization")
+            
+            except Exception as e:
+                print(f"❌ Error loading model {model_name}: {str(e)}")
+                # Try with simplified configuration
+                try:
+                    print("🔄 Retrying with simplified configuration...")
+                    inference = LlamaInference(
+                        ckpt_path="meta-llama/Llama-3.1-8B-Instruct", 
+                        peft_model=model_path
+                    )
+                    model_cache[model_name] = LlamaScheduler.from_inference(inference)
+                    print(f"✅ Model {model_name} loaded with simplified config")
+                except Exception as e2:
+                    print(f"❌ Simplified config also failed: {str(e2)}")
+                    return None
     
-    return model_cache[model_name]
+        return model_cache[model_name]
 
 def download_youtube_video(url, output_dir="/tmp"):
     """Download YouTube video using yt-dlp"""
@@ -107,7 +111,10 @@ def process_video_with_local_model(video_path, model_name="asr-10k"):
             full_prompt,
             max_new_tokens=1024,
             do_sample=False,
+            vid_duration=single_video.get_duration(vid_id, hms=True),
             vid_id=vid_id,
+            # Every line is a valid chapter, no retry with sampling is needed
+            constrained=True,
         )
         
         # Format chapters for frontend
@@ -254,4 +261,5 @@ if __name__ == '__main__':
     print("💾 Memory optimization and offload directory configured")
     print("🔧 PEFT compatibility issues resolved")
     
-    app.run(debug=True, port=5328, host='0.0.0.0')
+    # Threaded server: concurrent requests share the scheduler's decode loop
+    app.run(debug=True, port=5328, host='0.0.0.0', threaded=True)
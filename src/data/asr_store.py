@@ -0,0 +1,95 @@
+from pathlib import Path
+
+import numpy as np
+from lutils import openf
+
+from src.data.store import MmapStore, pack_strings, unpack_strings, write_store
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+
+class ASRStore(MmapStore):
+    """
+    Memory-mapped view of a compiled ``docs/asrs.json``.
+
+    Every ASR segment of every video is a row of the float32 `starts`/`ends`
+    arrays, and its text is a slice of a single UTF-8 blob. `line_offsets`
+    gives the segments of each video, so reading a video only touches the
+    bytes of that video.
+    """
+
+    VERSION = 1
+    ARRAYS = ["line_offsets", "starts", "ends", "text_offsets", "text"]
+
+    def __getitem__(self, video_id):
+        """
+        Return the ASR of a video as `{"text": [...], "start": ..., "end": ...}`.
+
+        `start` and `end` are numpy views into the store (not lists).
+        """
+        row = self.get_row(video_id)
+        start, end = self._line_offsets[row], self._line_offsets[row + 1]
+        return {
+            "text": unpack_strings(self._text, self._text_offsets, start, end),
+            "start": self._starts[start:end],
+            "end": self._ends[start:end],
+        }
+
+    def get_n_lines(self, video_id):
+        row = self.get_row(video_id)
+        return int(self._line_offsets[row + 1] - self._line_offsets[row])
+
+
+def compile_asr_store(json_path, store_dir):
+    """Compile an `asrs.json`-like file into an `ASRStore` directory."""
+    json_path, store_dir = Path(json_path), Path(store_dir)
+    log.info(f"Compiling {json_path} into {store_dir}")
+    asrs = openf(json_path)
+
+    line_offsets = np.zeros(len(asrs) + 1, dtype=np.int64)
+    starts, ends, texts = [], [], []
+    for row, asr in enumerate(asrs.values()):
+        assert len(asr["text"]) == len(asr["start"]) == len(asr["end"])
+        line_offsets[row + 1] = line_offsets[row] + len(asr["text"])
+        starts.extend(asr["start"])
+        ends.extend(asr["end"])
+        texts.extend(asr["text"])
+
+    text_offsets, text = pack_strings(texts)
+    arrays = {
+        "line_offsets": line_offsets,
+        "starts": np.array(starts, dtype=np.float32),
+        "ends": np.array(ends, dtype=np.float32),
+        "text_offsets": text_offsets,
+        "text": text,
+    }
+    write_store(
+        store_dir, asrs.keys(), arrays, version=ASRStore.VERSION, source=str(json_path)
+    )
+    log.info(f"Compiled {len(asrs)} videos and {len(texts)} ASR segments")
+    return store_dir
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(
+        description="Compile docs/asrs.json into a memory-mapped ASRStore."
+    )
+    parser.add_argument("--vidc_dir", type=Path, default=Path("dataset/"))
+    parser.add_argument("--json_path", type=Path, default=None)
+    parser.add_argument("--store_dir", type=Path, default=None)
+    args = parser.parse_args()
+
+    json_path = args.json_path or args.vidc_dir / "docs/asrs.json"
+    store_dir = args.store_dir or args.vidc_dir / "docs/asrs_store"
+    compile_asr_store(json_path, store_dir)
+
+    start = time.perf_counter()
+    store = ASRStore(store_dir)
+    vid_id = store.video_ids[len(store) // 2]
+    asr = store[vid_id]
+    print(f"Opened {len(store)} videos in {time.perf_counter() - start:.3f}s")
+    print(vid_id, len(asr["text"]), asr["text"][:3], asr["start"][:3])
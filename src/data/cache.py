@@ -0,0 +1,134 @@
+import hashlib
+import json
+from collections import OrderedDict
+from pathlib import Path
+
+from src.data.store import MmapStore, pack_strings, unpack_strings, write_store
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+# Bump when the rendered transcript format changes (invalidates the disk tier)
+TRANSCRIPT_FORMAT_VERSION = 1
+
+
+class LRUCache(OrderedDict):
+    def __init__(self, maxsize=32):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key):
+        if key not in self:
+            return None
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, value):
+        if key in self:
+            self.move_to_end(key)
+        self[key] = value
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+class TranscriptStore(MmapStore):
+    """
+    Memory-mapped rendered transcripts, one UTF-8 string per video.
+
+    This is the on-disk tier of `TranscriptCache`: reading a transcript is a
+    binary search and a slice of the blob, with no formatting at all.
+    """
+
+    VERSION = 1
+    ARRAYS = ["text_offsets", "text"]
+
+    def __getitem__(self, video_id):
+        row = self.get_row(video_id)
+        return unpack_strings(self._text, self._text_offsets, row, row + 1)[0]
+
+
+class TranscriptCache:
+    """
+    Two-tier cache of rendered transcripts.
+
+    Entries are keyed by `(video_id, *variant)` where `variant` holds the
+    rendering options (e.g. `add_end`). The in-process tier is a bounded LRU.
+    The on-disk tier is one `TranscriptStore` per subset and variant, whose
+    directory name is a hash of the source data, the options and
+    `TRANSCRIPT_FORMAT_VERSION`, so a stale store is never read.
+
+    `render(video_id, *variant)` renders a transcript (or returns None if the
+    video has none) and `video_ids()` lists the videos to render in the store.
+    """
+
+    def __init__(self, cache_dir, name, source, render, video_ids, maxsize=1024):
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.name = name
+        self.source = source
+        self.render = render
+        self.video_ids = video_ids
+        self.memory = LRUCache(maxsize=maxsize)
+        self._stores = {}
+
+    def get(self, video_id, *variant):
+        key = (video_id, *variant)
+        text = self.memory.get(key)
+        if text is not None:
+            return text
+
+        store = self.get_store(*variant)
+        if store is not None and video_id in store:
+            text = store[video_id]
+        else:
+            text = self.render(video_id, *variant)
+        if text is not None:
+            self.memory.put(key, text)
+        return text
+
+    def store_dir(self, *variant):
+        key = json.dumps(
+            {
+                "version": TRANSCRIPT_FORMAT_VERSION,
+                "source": self.source,
+                "variant": variant,
+            },
+            sort_keys=True,
+        )
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return self.cache_dir / f"{self.name}_{digest}"
+
+    def get_store(self, *variant):
+        """Open (and build on first use) the on-disk store of `variant`."""
+        if self.cache_dir is None:
+            return None
+        if variant not in self._stores:
+            store_dir = self.store_dir(*variant)
+            try:
+                if not TranscriptStore.exists(store_dir):
+                    self.build_store(store_dir, *variant)
+                self._stores[variant] = TranscriptStore(store_dir)
+            except OSError as e:
+                # e.g. read-only dataset directory: keep the in-process tier only
+                log.warning(f"Transcript cache disabled for {store_dir}: {e}")
+                self._stores[variant] = None
+        return self._stores[variant]
+
+    def build_store(self, store_dir, *variant):
+        log.info(f"Rendering transcripts into {store_dir}")
+        video_ids, texts = [], []
+        for vid_id in self.video_ids():
+            text = self.render(vid_id, *variant)
+            if text is not None:
+                video_ids.append(vid_id)
+                texts.append(text)
+        text_offsets, text = pack_strings(texts)
+        write_store(
+            store_dir,
+            video_ids,
+            {"text_offsets": text_offsets, "text": text},
+            version=TranscriptStore.VERSION,
+            overwrite=False,
+            format_version=TRANSCRIPT_FORMAT_VERSION,
+            source=self.source,
+            variant=list(variant),
+        )
@@ -0,0 +1,104 @@
+from pathlib import Path
+
+import numpy as np
+from lutils import openf
+
+from src.data.store import MmapStore, pack_strings, unpack_strings, write_store
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+PACK_DIR = "_pack"
+
+
+class CaptionsPack(MmapStore):
+    """
+    Memory-mapped pack of the frame captions of a captions directory.
+
+    Built from the per-video ``<captions_dir>/<id[:2]>/<id>.json`` files by
+    ``compile_captions_pack``. The records of a video are contiguous and
+    already sorted by frame: `frames` holds the `(index, n_frames)` pair of
+    each caption (its time is `duration * index / n_frames`) and the captions
+    are slices of a single UTF-8 blob.
+    """
+
+    VERSION = 1
+    ARRAYS = ["record_offsets", "frames", "text_offsets", "text"]
+
+    def __getitem__(self, video_id):
+        """Return the `(frames, captions)` records of a video."""
+        row = self.get_row(video_id)
+        start, end = self._record_offsets[row], self._record_offsets[row + 1]
+        frames = np.asarray(self._frames[start:end], dtype=np.int64)
+        return frames, unpack_strings(self._text, self._text_offsets, start, end)
+
+    @staticmethod
+    def pack_dir(captions_dir):
+        return Path(captions_dir) / PACK_DIR
+
+
+def sort_captions(vid_captions):
+    """Sort the `{"index/n_frames": caption}` of a video by frame index."""
+    frame_keys = sorted(vid_captions, key=lambda x: int(x.split("/")[0]))
+    frames = np.array(
+        [frame_key.split("/") for frame_key in frame_keys], dtype=np.int64
+    ).reshape(-1, 2)
+    return frames, [vid_captions[frame_key] for frame_key in frame_keys]
+
+
+def compile_captions_pack(captions_dir, pack_dir=None):
+    """Pack the per-video caption JSON files of `captions_dir` into a store."""
+    captions_dir = Path(captions_dir)
+    pack_dir = Path(pack_dir or CaptionsPack.pack_dir(captions_dir))
+    captions_pths = sorted(
+        p for p in captions_dir.glob("*/*.json") if p.parent.name != PACK_DIR
+    )
+    log.info(f"Packing {len(captions_pths)} caption files into {pack_dir}")
+
+    video_ids, frames, texts = [], [], []
+    record_offsets = np.zeros(len(captions_pths) + 1, dtype=np.int64)
+    for row, captions_pth in enumerate(captions_pths):
+        vid_frames, vid_texts = sort_captions(openf(captions_pth))
+        record_offsets[row + 1] = record_offsets[row] + len(vid_texts)
+        video_ids.append(captions_pth.stem)
+        frames.append(vid_frames)
+        texts.extend(vid_texts)
+
+    text_offsets, text = pack_strings(texts)
+    frames = np.concatenate(frames) if frames else np.zeros((0, 2), dtype=np.int64)
+    arrays = {
+        "record_offsets": record_offsets,
+        "frames": frames.astype(np.int32),
+        "text_offsets": text_offsets,
+        "text": text,
+    }
+    write_store(
+        pack_dir,
+        video_ids,
+        arrays,
+        version=CaptionsPack.VERSION,
+        source=str(captions_dir),
+    )
+    log.info(f"Packed {len(video_ids)} videos and {len(texts)} captions")
+    return pack_dir
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(
+        description="Pack the per-video caption JSON files into a CaptionsPack."
+    )
+    parser.add_argument("captions_dir", type=Path)
+    parser.add_argument("--pack_dir", type=Path, default=None)
+    args = parser.parse_args()
+
+    pack_dir = compile_captions_pack(args.captions_dir, args.pack_dir)
+
+    start = time.perf_counter()
+    pack = CaptionsPack(pack_dir)
+    vid_id = pack.video_ids[len(pack) // 2]
+    frames, captions = pack[vid_id]
+    print(f"Opened {len(pack)} videos in {time.perf_counter() - start:.3f}s")
+    print(vid_id, frames[:3].tolist(), captions[:3])
@@ -1,7 +1,19 @@
 import random
 from pathlib import Path
 
-from lutils import openf, writef
+import numpy as np
+
+from lutils import openf
+
+from src.data.chapters_store import ChaptersStore
+from src.data.segments import (
+    RaggedTable,
+    boundaries_to_segments,
+    build_timestamps,
+    chapters_to_segments,
+)
+from src.data.subsets import extract_subsets
+from src.data.timestamps import hms_to_sec, sec_to_hms
 
 
 class Chapters:
@@ -11,17 +23,30 @@ class Chapters:
         self.subset = subset
 
         self.data = self.load_subset_data(subset=subset)
-        self.video_ids = list(self.data.keys())
+        if isinstance(self.data, ChaptersStore):
+            # Ids are decoded lazily from the memory-mapped store
+            self.video_ids = self.data.video_ids
+        else:
+            self.video_ids = list(self.data.keys())
         assert len(self.video_ids) == len(self.data), (
             f"len(data)= {len(self.data)} != len(ids)= {len(self.video_ids)}."
         )
 
         self.videos_dir = videos_dir
+        self._tables = {}
 
     def get_subset_ids(self, subset: str):
         return openf(self.vidc_dir / f"docs/subset_data/{subset}.json")
 
     def load_subset_data(self, subset=""):
+        # Use the compiled store if available (python -m src.data.chapters_store)
+        store_dir = self.vidc_dir / "docs/chapters_store"
+        if ChaptersStore.exists(store_dir):
+            store = ChaptersStore(store_dir)
+            if subset:
+                store = store.subset(self.get_subset_ids(subset))
+            return store
+
         if subset == "":
             data_path = self.vidc_dir / "docs/chapters.json"
             assert data_path.exists(), f"Data file {data_path} does not exist."
@@ -30,13 +55,12 @@ class Chapters:
 
         data_path = self.vidc_dir / f"docs/subset_data/chapters/chapters_{subset}.json"
         if not data_path.exists():
-            video_ids = openf(self.vidc_dir / f"docs/subset_data/{subset}.json")
-            data = openf(self.vidc_dir / "docs/chapters.json")
-            data = {video_id: data[video_id] for video_id in video_ids}
-            data_path.parent.mkdir(exist_ok=True)
-            writef(data, data_path)
-        else:
-            data = openf(data_path)
+            # Stream the subset out of the full file instead of loading it
+            video_ids = self.get_subset_ids(subset)
+            extract_subsets(
+                self.vidc_dir / "docs/chapters.json", {data_path: video_ids}
+            )
+        data = openf(data_path)
         return data
 
     def __len__(self):
@@ -62,11 +86,120 @@ class Chapters:
         assert video_id in self.data, f"Video ID {video_id} not found in data."
         return self.data[video_id]
 
+    def find_index(self, video_id):
+        """Position of `video_id` in `self.video_ids` (-1 if missing)."""
+        if isinstance(self.data, ChaptersStore):
+            return self.data.find_index(video_id)
+        if "index" not in self._tables:
+            self._tables["index"] = {
+                vid_id: i for i, vid_id in enumerate(self.video_ids)
+            }
+        return self._tables["index"].get(video_id, -1)
+
+    def get_all_chapter_times(self):
+        """Chapter start times (seconds) of all videos as a CSR `(times, offsets)`."""
+        if isinstance(self.data, ChaptersStore):
+            return self.data.get_all_chapter_times()
+        times, offsets = [], [0]
+        for video_id in self.video_ids:
+            vid_chapters = self.get_video_info(video_id).get("chapters", {})
+            times.extend(hms_to_sec(time) for time in vid_chapters)
+            offsets.append(len(times))
+        return np.array(times, dtype=np.float64), np.array(offsets, dtype=np.int64)
+
+    def get_all_labels(self):
+        """Chapter titles of all videos, aligned with `get_all_chapter_times`."""
+        if isinstance(self.data, ChaptersStore):
+            return self.data.get_all_labels()
+        return [
+            label
+            for video_id in self.video_ids
+            for label in self.get_video_info(video_id).get("chapters", {}).values()
+        ]
+
+    def get_all_durations(self):
+        if isinstance(self.data, ChaptersStore):
+            return self.data.get_all_durations()
+        durations = [self.get_duration(video_id) for video_id in self.video_ids]
+        return np.array(durations, dtype=np.float64)
+
+    def _build_table(self, values, offsets, dtype):
+        return RaggedTable(
+            values.astype(dtype), offsets, self.video_ids, find_index=self.find_index
+        )
+
+    def get_timestamp_table(self, zero_handling="default", duration_handling="default"):
+        """`get_timestamps` of all videos, built once as a `RaggedTable`."""
+        key = ("timestamps", zero_handling, duration_handling)
+        if key not in self._tables:
+            times, offsets = self.get_all_chapter_times()
+            values, offsets = build_timestamps(
+                times,
+                offsets,
+                self.get_all_durations(),
+                zero_handling=zero_handling,
+                duration_handling=duration_handling,
+            )
+            self._tables[key] = self._build_table(values, offsets, np.float64)
+        return self._tables[key]
+
+    def get_segment_table(self, zero_handling="add"):
+        """`get_gt_segments` of all videos, built once as a float32 `RaggedTable`."""
+        key = ("gt_segments", zero_handling)
+        if key not in self._tables:
+            timestamps = self.get_timestamp_table(zero_handling=zero_handling)
+            values, offsets = boundaries_to_segments(
+                timestamps.values,
+                timestamps.offsets,
+                self.get_all_durations(),
+                zero_handling=zero_handling,
+            )
+            self._tables[key] = self._build_table(values, offsets, np.float32)
+        return self._tables[key]
+
+    def get_chapter_segment_table(self):
+        """`get_chapters(segments=True)` of all videos (without the labels)."""
+        key = ("chapter_segments",)
+        if key not in self._tables:
+            times, offsets = self.get_all_chapter_times()
+            values, offsets = chapters_to_segments(
+                times, offsets, self.get_all_durations()
+            )
+            self._tables[key] = self._build_table(values, offsets, np.float32)
+        return self._tables[key]
+
+    def get_label_table(self):
+        """Chapter titles of all videos as a `RaggedTable` (of python strings)."""
+        key = ("labels",)
+        if key not in self._tables:
+            _, offsets = self.get_all_chapter_times()
+            labels = np.empty(offsets[-1], dtype=object)
+            labels[:] = self.get_all_labels()
+            self._tables[key] = self._build_table(labels, offsets, object)
+        return self._tables[key]
+
+    def get_subset_chapter_segments(self, video_ids):
+        """
+        `get_chapters(segments=True)` of `video_ids`, as `{video_id: chapters}`,
+        gathered from the tables at once instead of video by video.
+        """
+        video_ids = list(video_ids)
+        segments = self.get_chapter_segment_table().subset(video_ids)
+        labels = self.get_label_table().subset(video_ids).values.tolist()
+        keys = list(map(tuple, segments.values.tolist()))
+        offsets = segments.offsets.tolist()
+        return {
+            video_id: dict(zip(keys[start:end], labels[start:end]))
+            for video_id, start, end in zip(video_ids, offsets[:-1], offsets[1:])
+        }
+
     def get_chapters(self, video_id, hms=False, segments=False):
         """Retrieve chapters for a specific video ID."""
-        video_info = self.get_video_info(video_id)
-
-        vid_chapters = video_info.get("chapters", {})
+        if isinstance(self.data, ChaptersStore):
+            vid_chapters = self.data.get_chapters(video_id)
+        else:
+            video_info = self.get_video_info(video_id)
+            vid_chapters = video_info.get("chapters", {})
         chapter_timestamps = {}
         for time, label in vid_chapters.items():
             time = sec_to_hms(time) if hms else hms_to_sec(time)
@@ -76,16 +209,8 @@ class Chapters:
 
         # If segments is True, we return the timestamps as segments
         assert not hms, "hms must be False if segments is True."
-        timestamps = list(chapter_timestamps.keys())
-        start_times = timestamps
-        end_times = timestamps[1:] + [self.get_duration(video_id)]
-        segmented_chapters = {}
-
-        for start_time, end_time in zip(start_times, end_times):
-            segment = (start_time, end_time)
-            segmented_chapters[segment] = chapter_timestamps[start_time]
-
-        return segmented_chapters
+        segments = self.get_chapter_segment_table()[video_id].tolist()
+        return dict(zip(map(tuple, segments), chapter_timestamps.values()))
 
     def get_labels(self, video_id):
         """Retrieve a list of chapter labels for a specific video ID."""
@@ -96,39 +221,10 @@ class Chapters:
         self, video_id, zero_handling="default", duration_handling="default"
     ):
         """Retrieve a list of chapter timestamps for a specific video ID."""
-        assert zero_handling in [
-            "default",
-            "add",
-            "remove",
-        ], f"Invalid zero handling {zero_handling}."
-
-        assert duration_handling in [
-            "default",
-            "add",
-            "remove",
-        ], f"Invalid duration handling {duration_handling}."
-
-        chapters = self.get_chapters(video_id)
-        timestamps = [int(time) for time in chapters]
-
-        # Handle zero timestamps based on the flag
-        if zero_handling == "add":
-            timestamps = (
-                [0] + timestamps if timestamps and timestamps[0] != 0 else timestamps
-            )
-        elif zero_handling == "remove":
-            timestamps = [time for time in timestamps if time != 0]
-
-        if duration_handling == "add":
-            duration = self.get_duration(video_id)
-            timestamps = (
-                timestamps + [duration] if timestamps[-1] != duration else timestamps
-            )
-        elif duration_handling == "remove":
-            duration = self.get_duration(video_id)
-            timestamps = timestamps[:-1] if timestamps[-1] == duration else timestamps
-
-        return timestamps
+        table = self.get_timestamp_table(
+            zero_handling=zero_handling, duration_handling=duration_handling
+        )
+        return [int(t) if t.is_integer() else t for t in table[video_id].tolist()]
 
     def get_n_timestamps(self, video_id, zero_handling="default"):
         """Retrieve the number of chapter timestamps for a specific video ID."""
@@ -142,8 +238,11 @@ class Chapters:
 
     def get_duration(self, video_id, hms=False):
         """Retrieve the duration of a specific video ID."""
-        video_info = self.get_video_info(video_id)
-        duration = video_info.get("duration")
+        if isinstance(self.data, ChaptersStore):
+            duration = self.data.get_duration(video_id)
+        else:
+            video_info = self.get_video_info(video_id)
+            duration = video_info.get("duration")
         if hms:
             return sec_to_hms(duration)
         return duration
@@ -195,11 +294,8 @@ class Chapters:
 
     def get_gt_segments(self, video_id, zero_handling="add"):
         """Generate ground truth segments based on video ID with options to adjust zero timestamps."""
-        timestamps = self.get_timestamps(video_id, zero_handling=zero_handling)
-        segments = boundary2seg(
-            timestamps, self.get_duration(video_id), zero_handling=zero_handling
-        )
-        return segments
+        segments = self.get_segment_table(zero_handling=zero_handling)[video_id]
+        return list(map(tuple, segments.tolist()))
 
     def get_segments(self, video_id, zero_handling="add"):
         return self.get_gt_segments(
@@ -209,10 +305,7 @@ class Chapters:
 
     def get_all_gt_segments(self, zero_handling="add"):
         """Generate ground truth segments for all video IDs."""
-        return {
-            video_id: self.get_gt_segments(video_id, zero_handling=zero_handling)
-            for video_id in self.video_ids
-        }
+        return self.get_segment_table(zero_handling=zero_handling).to_dict()
 
     def get_pred_segments(self, vid_id, vid_preds, zero_handling="add"):
         duration = self.get_duration(vid_id)
@@ -279,51 +372,6 @@ def boundary2seg(boundaries, duration, zero_handling="add"):
     return gt
 
 
-def sec_to_hms(seconds, string=True, short=False):
-    """Convert seconds to hours, minutes, and seconds."""
-    if isinstance(seconds, str) and ":" in seconds:
-        return sec_to_hms(hms_to_sec(seconds), string=string, short=short)
-    if isinstance(seconds, str) and seconds.isdigit() or isinstance(seconds, float):
-        seconds = int(seconds)
-    m, s = divmod(seconds, 60)
-    h, m = divmod(m, 60)
-    if string:
-        if h == 0 and short:
-            return f"{m:02d}:{s:02d}"
-        return f"{h:02d}:{m:02d}:{s:02d}"
-    return h, m, s
-
-
-def hms_to_sec(time_str, enable_single_part=False):
-    """Convert hours, minutes, and seconds to total seconds."""
-    if isinstance(time_str, (int, float)):
-        return time_str
-    if isinstance(time_str, str) and time_str.isdigit():
-        return int(time_str)
-
-    parts = time_str.split(":")
-    if len(parts) == 3:
-        hours, minutes, seconds = parts
-        seconds = float(seconds) if "." in seconds else int(seconds)
-        minutes = int(minutes)
-        if minutes >= 60 or seconds >= 60:
-            return False
-        total_seconds = int(hours) * 3600 + minutes * 60 + seconds
-    elif len(parts) == 2:
-        minutes, seconds = parts
-        seconds = float(seconds) if "." in seconds else int(seconds)
-        minutes = int(minutes)
-        if seconds >= 60:
-            return False
-        total_seconds = int(minutes) * 60 + seconds
-    elif len(parts) == 1 and enable_single_part:
-        seconds = float(parts[0]) if "." in parts[0] else int(parts[0])
-        total_seconds = seconds
-    else:
-        raise ValueError("Invalid time format")
-    return total_seconds
-
-
 def clean_segment(segment, zero_handling="add"):
     if zero_handling == "add" and segment[0][0] != 0.0:
         segment.insert(0, [0.0, segment[0][0]])
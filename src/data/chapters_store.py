@@ -0,0 +1,168 @@
+import json
+from pathlib import Path
+
+import numpy as np
+from lutils import openf
+
+from src.data.segments import gather_ragged
+from src.data.store import MmapStore, pack_strings, unpack_strings, write_store
+from src.data.timestamps import hms_to_sec, sec_to_hms
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+
+class ChaptersStore(MmapStore):
+    """
+    Memory-mapped view of a compiled ``docs/chapters.json``.
+
+    Video ids, durations, chapter times and chapter titles are kept in flat
+    arrays (see ``compile_chapters_store``); the remaining fields of a video
+    (title, description, ...) are stored as one small JSON string per video
+    and only parsed when that video's info is requested.
+    """
+
+    VERSION = 1
+    ARRAYS = [
+        "durations",
+        "chapter_offsets",
+        "chapter_times",
+        "label_offsets",
+        "labels",
+        "meta_offsets",
+        "meta",
+    ]
+
+    def __getitem__(self, video_id):
+        """Rebuild the `chapters.json` entry of a single video."""
+        row = self.get_row(video_id)
+        video_info = self._get_meta(row)
+        video_info["duration"] = _to_number(self._durations[row])
+        video_info["chapters"] = self._get_chapters(row)
+        return video_info
+
+    def get_duration(self, video_id):
+        return _to_number(self._durations[self.get_row(video_id)])
+
+    def get_chapters(self, video_id):
+        """Return the `{hh:mm:ss: title}` chapters of a video."""
+        return self._get_chapters(self.get_row(video_id))
+
+    def get_chapter_times(self, video_id):
+        """Return the chapter start times (seconds) of a video as a numpy view."""
+        row = self.get_row(video_id)
+        start, end = self._chapter_offsets[row], self._chapter_offsets[row + 1]
+        return self._chapter_times[start:end]
+
+    def get_all_durations(self):
+        """Durations of all the videos of this view (NaN if missing)."""
+        return np.asarray(self._durations[self.rows], dtype=np.float64)
+
+    def get_all_chapter_times(self):
+        """Chapter start times of this view as a CSR `(times, offsets)` pair."""
+        if self._rows is None:
+            return np.asarray(self._chapter_times), np.asarray(self._chapter_offsets)
+        return gather_ragged(self._chapter_times, self._chapter_offsets, self._rows)
+
+    def get_all_labels(self):
+        """Chapter titles of this view, aligned with `get_all_chapter_times`."""
+        if self._rows is None:
+            n_labels = len(self._label_offsets) - 1
+            return unpack_strings(self._labels, self._label_offsets, 0, n_labels)
+        labels = []
+        for row in self._rows.tolist():
+            start, end = self._chapter_offsets[row], self._chapter_offsets[row + 1]
+            labels.extend(unpack_strings(self._labels, self._label_offsets, start, end))
+        return labels
+
+    def _get_chapters(self, row):
+        start, end = self._chapter_offsets[row], self._chapter_offsets[row + 1]
+        times = self._chapter_times[start:end].tolist()
+        labels = unpack_strings(self._labels, self._label_offsets, start, end)
+        return {
+            sec_to_hms(_to_number(time)): label for time, label in zip(times, labels)
+        }
+
+    def _get_meta(self, row):
+        start, end = self._meta_offsets[row], self._meta_offsets[row + 1]
+        return json.loads(self._meta[start:end].tobytes().decode())
+
+
+def _to_number(value):
+    value = float(value)
+    if np.isnan(value):
+        return None
+    return int(value) if value.is_integer() else value
+
+
+def compile_chapters_store(json_path, store_dir):
+    """
+    Compile a `chapters.json`-like file into a `ChaptersStore` directory.
+
+    This is the only step that parses the full JSON.
+    """
+    json_path, store_dir = Path(json_path), Path(store_dir)
+    log.info(f"Compiling {json_path} into {store_dir}")
+    data = openf(json_path)
+
+    durations = np.zeros(len(data), dtype=np.float64)
+    chapter_offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    chapter_times = []
+    labels = []
+    metas = []
+    for row, video_info in enumerate(data.values()):
+        video_info = dict(video_info)
+        vid_chapters = video_info.pop("chapters", {}) or {}
+        duration = video_info.pop("duration", None)
+
+        durations[row] = np.nan if duration is None else duration
+        chapter_offsets[row + 1] = chapter_offsets[row] + len(vid_chapters)
+        for time, label in vid_chapters.items():
+            chapter_times.append(hms_to_sec(time))
+            labels.append(label)
+        metas.append(json.dumps(video_info, ensure_ascii=False))
+
+    label_offsets, labels = pack_strings(labels)
+    meta_offsets, meta = pack_strings(metas)
+    arrays = {
+        "durations": durations,
+        "chapter_offsets": chapter_offsets,
+        "chapter_times": np.array(chapter_times, dtype=np.float64),
+        "label_offsets": label_offsets,
+        "labels": labels,
+        "meta_offsets": meta_offsets,
+        "meta": meta,
+    }
+    write_store(
+        store_dir,
+        data.keys(),
+        arrays,
+        version=ChaptersStore.VERSION,
+        source=str(json_path),
+    )
+    log.info(f"Compiled {len(data)} videos and {len(chapter_times)} chapters")
+    return store_dir
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(
+        description="Compile docs/chapters.json into a memory-mapped ChaptersStore."
+    )
+    parser.add_argument("--vidc_dir", type=Path, default=Path("dataset/"))
+    parser.add_argument("--json_path", type=Path, default=None)
+    parser.add_argument("--store_dir", type=Path, default=None)
+    args = parser.parse_args()
+
+    json_path = args.json_path or args.vidc_dir / "docs/chapters.json"
+    store_dir = args.store_dir or args.vidc_dir / "docs/chapters_store"
+    compile_chapters_store(json_path, store_dir)
+
+    start = time.perf_counter()
+    store = ChaptersStore(store_dir)
+    vid_id = store.video_ids[len(store) // 2]
+    video_info = store[vid_id]
+    print(f"Opened {len(store)} videos in {time.perf_counter() - start:.3f}s")
+    print(vid_id, video_info["duration"], video_info["chapters"])
@@ -0,0 +1,218 @@
+import numpy as np
+
+ZERO_HANDLINGS = ["default", "add", "remove"]
+DURATION_HANDLINGS = ["default", "add", "remove"]
+
+
+class RaggedTable:
+    """
+    CSR-style table with a variable number of entries per video.
+
+    `values` holds the entries of all videos back to back (shape `(N,)` for
+    timestamps, `(N, 2)` for `(start, end)` segments) and the entries of the
+    i-th video are `values[offsets[i] : offsets[i + 1]]`. Per-video accessors
+    return numpy views, so nothing is copied or rebuilt per call.
+    """
+
+    def __init__(self, values, offsets, video_ids, find_index=None):
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.video_ids = video_ids
+        assert len(self.offsets) == len(video_ids) + 1, (
+            f"len(offsets)= {len(self.offsets)} != len(ids) + 1= {len(video_ids) + 1}."
+        )
+        if find_index is None:
+            index = {vid_id: i for i, vid_id in enumerate(video_ids)}
+
+            def find_index(video_id):
+                return index.get(video_id, -1)
+
+        self.find_index = find_index
+
+    def __len__(self):
+        return len(self.video_ids)
+
+    def __contains__(self, video_id):
+        return self.find_index(video_id) >= 0
+
+    def __getitem__(self, video_id):
+        idx = self.find_index(video_id)
+        assert idx >= 0, f"Video ID {video_id} not found in table."
+        return self.values[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def get(self, video_id):
+        return self[video_id]
+
+    @property
+    def counts(self):
+        """Number of entries per video."""
+        return np.diff(self.offsets)
+
+    def subset(self, video_ids):
+        """Return a new table with the rows of `video_ids` (in that order)."""
+        video_ids = list(video_ids)
+        rows = np.array([self.find_index(vid_id) for vid_id in video_ids], dtype=int)
+        assert (rows >= 0).all(), "Some video IDs are not in the table."
+        values, offsets = gather_ragged(self.values, self.offsets, rows)
+        return RaggedTable(values, offsets, video_ids)
+
+    def to_dict(self):
+        """Convert to `{video_id: [entry, ...]}` with python types."""
+        values = self.values.tolist()
+        offsets = self.offsets.tolist()
+        to_entry = tuple if self.values.ndim == 2 else _to_number
+        return {
+            vid_id: [to_entry(v) for v in values[offsets[i] : offsets[i + 1]]]
+            for i, vid_id in enumerate(self.video_ids)
+        }
+
+
+def gather_ragged(values, offsets, rows):
+    """Gather the rows `rows` of a CSR `(values, offsets)` array without a loop."""
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.asarray(offsets[rows], dtype=np.int64)
+    counts = np.asarray(offsets[rows + 1], dtype=np.int64) - starts
+    new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(counts, out=new_offsets[1:])
+    idx = np.repeat(starts - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    return np.asarray(values[idx]), new_offsets
+
+
+def _segment_ids(offsets):
+    """Video index of every entry of a CSR array."""
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def _offsets_from_mask(offsets, keep):
+    """Recompute CSR offsets after dropping the entries where `keep` is False."""
+    counts = np.bincount(_segment_ids(offsets)[keep], minlength=len(offsets) - 1)
+    new_offsets = np.zeros_like(offsets)
+    np.cumsum(counts, out=new_offsets[1:])
+    return new_offsets
+
+
+def _insert_first(values, offsets, value, where):
+    """Insert `value` at the start of the videos selected by the boolean `where`."""
+    counts = np.diff(offsets) + where
+    new_offsets = np.zeros_like(offsets)
+    np.cumsum(counts, out=new_offsets[1:])
+    new_values = np.empty(new_offsets[-1], dtype=values.dtype)
+    ids = _segment_ids(offsets)
+    pos = np.arange(len(values)) - offsets[ids] + new_offsets[ids] + where[ids]
+    new_values[pos] = values
+    new_values[new_offsets[:-1][where]] = value
+    return new_values, new_offsets
+
+
+def _append_last(values, offsets, last_values, where):
+    """Append `last_values[i]` at the end of the videos selected by `where`."""
+    counts = np.diff(offsets) + where
+    new_offsets = np.zeros_like(offsets)
+    np.cumsum(counts, out=new_offsets[1:])
+    new_values = np.empty(new_offsets[-1], dtype=values.dtype)
+    ids = _segment_ids(offsets)
+    pos = np.arange(len(values)) - offsets[ids] + new_offsets[ids]
+    new_values[pos] = values
+    new_values[new_offsets[1:][where] - 1] = last_values[where]
+    return new_values, new_offsets
+
+
+def _first_last(values, offsets):
+    """First/last value of every video (NaN for videos without entries)."""
+    counts = np.diff(offsets)
+    nonempty = counts > 0
+    first = np.full(len(counts), np.nan)
+    last = np.full(len(counts), np.nan)
+    first[nonempty] = values[offsets[:-1][nonempty]]
+    last[nonempty] = values[offsets[1:][nonempty] - 1]
+    return first, last
+
+
+def build_timestamps(
+    times, offsets, durations, zero_handling="default", duration_handling="default"
+):
+    """
+    Vectorized `Chapters.get_timestamps` for all videos at once.
+
+    `times` and `offsets` are the CSR chapter start times of all the videos and
+    `durations` their durations. Returns the CSR `(timestamps, offsets)`.
+    """
+    assert zero_handling in ZERO_HANDLINGS, f"Invalid zero handling {zero_handling}."
+    assert duration_handling in DURATION_HANDLINGS, (
+        f"Invalid duration handling {duration_handling}."
+    )
+    values = np.trunc(np.asarray(times, dtype=np.float64))
+    offsets = np.asarray(offsets, dtype=np.int64)
+    durations = np.asarray(durations, dtype=np.float64)
+
+    if zero_handling == "add":
+        first, _ = _first_last(values, offsets)
+        where = (first != 0) & ~np.isnan(first)
+        values, offsets = _insert_first(values, offsets, 0, where)
+    elif zero_handling == "remove":
+        keep = values != 0
+        values, offsets = values[keep], _offsets_from_mask(offsets, keep)
+
+    if duration_handling == "add":
+        _, last = _first_last(values, offsets)
+        where = (last != durations) & ~np.isnan(last)
+        values, offsets = _append_last(values, offsets, durations, where)
+    elif duration_handling == "remove":
+        _, last = _first_last(values, offsets)
+        keep = np.ones(len(values), dtype=bool)
+        keep[offsets[1:][last == durations] - 1] = False
+        values, offsets = values[keep], _offsets_from_mask(offsets, keep)
+
+    return values, offsets
+
+
+def boundaries_to_segments(boundaries, offsets, durations, zero_handling="add"):
+    """
+    Vectorized `boundary2seg` for all videos at once.
+
+    Each boundary starts a segment that ends at the next boundary, the last one
+    ends at the video duration (and is dropped if it equals the duration).
+    Returns the CSR `(segments, offsets)` with `segments` of shape `(N, 2)`.
+    """
+    boundaries = np.asarray(boundaries, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    durations = np.asarray(durations, dtype=np.float64)
+
+    if zero_handling == "add":
+        first, _ = _first_last(boundaries, offsets)
+        where = (first != 0) & ~np.isnan(first)
+        boundaries, offsets = _insert_first(boundaries, offsets, 0, where)
+
+    ids = _segment_ids(offsets)
+    is_last = np.zeros(len(boundaries), dtype=bool)
+    is_last[offsets[1:][np.diff(offsets) > 0] - 1] = True
+    ends = np.empty_like(boundaries)
+    ends[:-1] = boundaries[1:]
+    ends[is_last] = durations[ids[is_last]]
+
+    keep = ~(is_last & (boundaries == durations[ids]))
+    segments = np.stack([boundaries[keep], ends[keep]], axis=1)
+    return segments, _offsets_from_mask(offsets, keep)
+
+
+def chapters_to_segments(times, offsets, durations):
+    """
+    Vectorized `Chapters.get_chapters(segments=True)` (without the labels).
+
+    Every chapter ends where the next one starts, the last one at the duration.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    durations = np.asarray(durations, dtype=np.float64)
+
+    ids = _segment_ids(offsets)
+    is_last = np.zeros(len(times), dtype=bool)
+    is_last[offsets[1:][np.diff(offsets) > 0] - 1] = True
+    ends = np.empty_like(times)
+    ends[:-1] = times[1:]
+    ends[is_last] = durations[ids[is_last]]
+    return np.stack([times, ends], axis=1), offsets
+
+
+def _to_number(value):
+    return int(value) if float(value).is_integer() else value
@@ -0,0 +1,232 @@
+import json
+import os
+import shutil
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+
+import numpy as np
+from lutils import openf
+
+INDEX_ARRAYS = ["ids", "sorted_ids", "sorted_rows"]
+
+
+class MmapStore(Mapping):
+    """
+    Read-only, memory-mapped mapping from video id to per-video data.
+
+    A store is a directory of ``.npy`` files plus an ``info.json``. Nothing is
+    parsed when the store is opened: arrays are mapped with ``mmap_mode="r"``
+    and only the rows that are accessed are read from disk, so the pages are
+    shared between DataLoader workers instead of being copied in each of them.
+
+    Lookups by video id use a binary search over the pre-sorted id array.
+    Subsets are views over a set of rows and do not copy any data.
+
+    Subclasses list their own arrays in `ARRAYS` and implement `__getitem__`.
+    """
+
+    VERSION = 1
+    ARRAYS = []
+
+    def __init__(self, store_dir, rows=None):
+        self.store_dir = Path(store_dir)
+        assert self.store_dir.exists(), f"Store {self.store_dir} does not exist."
+
+        info = openf(self.store_dir / "info.json")
+        assert info["version"] == self.VERSION, (
+            f"Store version {info['version']} != {self.VERSION}, recompile it."
+        )
+        self.info = info
+
+        for name in INDEX_ARRAYS + self.ARRAYS:
+            setattr(self, f"_{name}", load_array(self.store_dir / f"{name}.npy"))
+
+        self._rows = None
+        if rows is not None:
+            self._rows = np.asarray(rows, dtype=np.int64)
+            self._view_order = np.argsort(self._rows, kind="stable")
+            self._sorted_view_rows = self._rows[self._view_order]
+
+    @classmethod
+    def exists(cls, store_dir):
+        return (Path(store_dir) / "info.json").exists()
+
+    def subset(self, video_ids, strict=True):
+        """
+        Return a view of the store restricted to (and ordered as) `video_ids`.
+
+        With `strict=False`, ids that are not in the store are skipped.
+        """
+        video_ids = list(video_ids)
+        rows = self.find_rows(video_ids)
+        if strict:
+            missing = [vid_id for vid_id, row in zip(video_ids, rows) if row < 0]
+            assert not missing, (
+                f"{len(missing)} video IDs not found, e.g. {missing[:5]}."
+            )
+        return type(self)(self.store_dir, rows=rows[rows >= 0])
+
+    def find_rows(self, video_ids):
+        """Vectorized lookup of the global rows of `video_ids` (-1 if missing)."""
+        keys = np.array([vid_id.encode() for vid_id in video_ids])
+        if len(keys) == 0 or len(self._sorted_ids) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        too_long = np.char.str_len(keys) > self._sorted_ids.itemsize
+        keys = keys.astype(self._sorted_ids.dtype)
+        pos = np.searchsorted(self._sorted_ids, keys)
+        pos_clip = np.minimum(pos, len(self._sorted_ids) - 1)
+        found = (self._sorted_ids[pos_clip] == keys) & (pos < len(self._sorted_ids))
+        found &= ~too_long
+        return np.where(found, self._sorted_rows[pos_clip], -1).astype(np.int64)
+
+    def find_row(self, video_id):
+        """Return the global row of `video_id`, or -1 if it is not in this view."""
+        key = video_id.encode()
+        if len(key) > self._sorted_ids.itemsize:
+            return -1
+        pos = int(np.searchsorted(self._sorted_ids, key))
+        if pos == len(self._sorted_ids) or self._sorted_ids[pos] != key:
+            return -1
+        row = int(self._sorted_rows[pos])
+        if self._rows is not None:
+            pos = int(np.searchsorted(self._sorted_view_rows, row))
+            if pos == len(self._sorted_view_rows) or self._sorted_view_rows[pos] != row:
+                return -1
+        return row
+
+    def find_index(self, video_id):
+        """Return the position of `video_id` in this view, or -1 if missing."""
+        row = self.find_row(video_id)
+        if row < 0 or self._rows is None:
+            return row
+        pos = int(np.searchsorted(self._sorted_view_rows, row))
+        return int(self._view_order[pos])
+
+    def get_row(self, video_id):
+        row = self.find_row(video_id)
+        if row < 0:
+            raise KeyError(video_id)
+        return row
+
+    @property
+    def rows(self):
+        """Global rows covered by this view, in iteration order."""
+        if self._rows is None:
+            return np.arange(len(self._ids), dtype=np.int64)
+        return self._rows
+
+    @property
+    def video_ids(self):
+        return VideoIds(self)
+
+    def keys(self):
+        return self.video_ids
+
+    def __len__(self):
+        return len(self._ids) if self._rows is None else len(self._rows)
+
+    def __iter__(self):
+        return iter(self.video_ids)
+
+    def __contains__(self, video_id):
+        return isinstance(video_id, str) and self.find_row(video_id) >= 0
+
+    def __getitem__(self, video_id):
+        raise NotImplementedError("Subclasses must implement '__getitem__'.")
+
+    def _get_id(self, row):
+        return self._ids[row].decode()
+
+
+class VideoIds(Sequence):
+    """Lazy sequence of the video ids of a `MmapStore` (decoded on access)."""
+
+    def __init__(self, store: MmapStore):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.store._get_id(row) for row in self.store.rows[idx]]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        if self.store._rows is None:
+            return self.store._get_id(idx)
+        return self.store._get_id(self.store._rows[idx])
+
+    def __iter__(self):
+        rows = self.store.rows
+        for start in range(0, len(rows), 65_536):
+            for vid_id in self.store._ids[rows[start : start + 65_536]]:
+                yield vid_id.decode()
+
+    def __contains__(self, video_id):
+        return video_id in self.store
+
+
+def load_array(path):
+    """Memory-map a `.npy` file (empty arrays cannot be mapped, so load them)."""
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        return np.load(path)
+
+
+def pack_strings(strings):
+    """Concatenate UTF-8 encoded strings into a blob with (n + 1) offsets."""
+    encoded = [s.encode() for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return offsets, blob
+
+
+def unpack_strings(blob, offsets, start, end):
+    """Decode the strings `start:end` of a blob packed with `pack_strings`."""
+    offsets = offsets[start : end + 1].tolist()
+    data = blob[offsets[0] : offsets[-1]].tobytes()
+    base = offsets[0]
+    return [
+        data[offsets[i] - base : offsets[i + 1] - base].decode()
+        for i in range(len(offsets) - 1)
+    ]
+
+
+def write_store(store_dir, video_ids, arrays, version=1, overwrite=True, **info):
+    """
+    Write a store directory with the id index and `arrays`.
+
+    It is written to a temporary directory first and then renamed, so
+    concurrent readers never see a partial store. With `overwrite=False`, a
+    store written concurrently by another process is kept as is.
+    """
+    store_dir = Path(store_dir)
+    ids = np.array([vid_id.encode() for vid_id in video_ids])
+    sorted_rows = np.argsort(ids, kind="stable").astype(np.int64)
+    arrays = {
+        "ids": ids,
+        "sorted_ids": ids[sorted_rows],
+        "sorted_rows": sorted_rows,
+        **arrays,
+    }
+
+    tmp_dir = store_dir.with_name(f"{store_dir.name}.tmp{os.getpid()}")
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+    for name, arr in arrays.items():
+        np.save(tmp_dir / f"{name}.npy", arr)
+    info = {"version": version, "n_videos": len(ids), **info}
+    (tmp_dir / "info.json").write_text(json.dumps(info))
+
+    if store_dir.exists():
+        if not overwrite:
+            shutil.rmtree(tmp_dir)
+            return store_dir
+        shutil.rmtree(store_dir)
+    tmp_dir.rename(store_dir)
+    return store_dir
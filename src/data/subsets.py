@@ -0,0 +1,183 @@
+"""
+Streaming extraction of subsets from the full `chapters.json` / `asrs.json`.
+
+The source is a single JSON object `{video_id: value, ...}` of several GB.
+`iter_json_items` scans it with a small buffer and yields one entry at a
+time, so memory is bounded by the largest single entry and not by the file.
+`extract_subsets` writes any number of subsets in one pass over the source.
+"""
+
+import json
+import shutil
+import tempfile
+from contextlib import ExitStack
+from pathlib import Path
+
+from lutils import openf
+
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+CHUNK_SIZE = 1 << 20
+WHITESPACE = " \t\n\r"
+DELIMITERS = WHITESPACE + ",:]}"
+
+
+def iter_json_items(json_path, raw=False, chunk_size=CHUNK_SIZE):
+    """
+    Yield the `(key, value)` pairs of a top-level JSON object one by one.
+
+    With `raw=True`, values are returned as their JSON text (not parsed into
+    python objects), which is enough to copy them to another file.
+    """
+    decoder = json.JSONDecoder()
+    with open(json_path, encoding="utf-8") as f:
+        buffer, pos, eof = "", 0, False
+        read_size = chunk_size
+
+        def skip_whitespace():
+            nonlocal buffer, pos, eof
+            while True:
+                while pos < len(buffer) and buffer[pos] in WHITESPACE:
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return
+                buffer, pos = f.read(chunk_size), 0
+                eof = not buffer
+
+        def expect(chars):
+            nonlocal pos
+            skip_whitespace()
+            if pos == len(buffer) or buffer[pos] not in chars:
+                found = buffer[pos : pos + 20] if pos < len(buffer) else "EOF"
+                raise ValueError(f"Expected one of {chars!r} in {json_path}: {found!r}")
+            pos += 1
+            return buffer[pos - 1]
+
+        def decode():
+            # Parse the next JSON value, reading more data while it is incomplete
+            nonlocal buffer, pos, eof, read_size
+            skip_whitespace()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                else:
+                    # A number can be cut at the end of the buffer ("12" of "12.5")
+                    if eof or end < len(buffer) and buffer[end] in DELIMITERS:
+                        break
+                chunk = f.read(read_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                read_size *= 2
+            read_size = chunk_size
+            text = buffer[pos:end]
+            pos = end
+            return value, text
+
+        expect("{")
+        skip_whitespace()
+        if pos < len(buffer) and buffer[pos] == "}":
+            return
+        while True:
+            key, _ = decode()
+            expect(":")
+            value, text = decode()
+            yield key, text if raw else value
+            if expect(",}") == "}":
+                return
+            if pos > chunk_size:
+                # Drop what has already been consumed
+                buffer, pos = buffer[pos:], 0
+
+
+def extract_subsets(json_path, subsets, only_present=False):
+    """
+    Write several subsets of a `{video_id: value}` JSON file in a single pass.
+
+    `subsets` maps each output path to the list of video ids to keep. Entries
+    are copied verbatim and written in the order of the ids. Ids that are
+    not in the source are skipped (with a warning unless `only_present`).
+    """
+    json_path = Path(json_path)
+    subsets = {Path(out_path): list(ids) for out_path, ids in subsets.items()}
+    for out_path in subsets:
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+    id2outs = {}
+    for out_path, ids in subsets.items():
+        for vid_id in ids:
+            id2outs.setdefault(vid_id, []).append(out_path)
+
+    log.info(f"Extracting {len(subsets)} subsets from {json_path}")
+    tmp_dir = tempfile.TemporaryDirectory(dir=next(iter(subsets)).parent)
+    with tmp_dir, ExitStack() as stack:
+        # Matching values are appended to one scratch file per subset, and only
+        # their (offset, length) is kept in memory to reorder them afterwards.
+        scratch = {
+            out_path: stack.enter_context(open(Path(tmp_dir.name) / f"{i}", "w+b"))
+            for i, out_path in enumerate(subsets)
+        }
+        spans = {out_path: {} for out_path in subsets}
+        for vid_id, text in iter_json_items(json_path, raw=True):
+            for out_path in id2outs.get(vid_id, []):
+                f = scratch[out_path]
+                start = f.tell()
+                f.write(text.encode())
+                spans[out_path][vid_id] = (start, f.tell() - start)
+
+        for out_path, ids in subsets.items():
+            _write_subset(out_path, ids, spans[out_path], scratch[out_path])
+            n_missing = len(set(ids) - spans[out_path].keys())
+            if n_missing and not only_present:
+                log.warning(f"{n_missing} video IDs of {out_path} not found.")
+    return list(subsets)
+
+
+def _write_subset(out_path, ids, spans, scratch):
+    tmp_path = out_path.with_name(f"{out_path.name}.tmp")
+    written = set()
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("{")
+        for vid_id in ids:
+            if vid_id not in spans or vid_id in written:
+                continue
+            start, length = spans[vid_id]
+            scratch.seek(start)
+            f.write(", " if written else "")
+            f.write(f"{json.dumps(vid_id)}: ")
+            f.write(scratch.read(length).decode())
+            written.add(vid_id)
+        f.write("}")
+    shutil.move(tmp_path, out_path)
+    log.info(f"Wrote {len(written)} videos to {out_path}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Extract the chapters/ASR of several subsets from the full JSON files "
+            "in a single streaming pass."
+        )
+    )
+    parser.add_argument("subset_files", type=Path, nargs="+")
+    parser.add_argument("--vidc_dir", type=Path, default=Path("dataset/"))
+    parser.add_argument(
+        "--data", nargs="+", choices=["chapters", "asrs"], default=["chapters", "asrs"]
+    )
+    args = parser.parse_args()
+
+    subset_ids = {path.stem: openf(path) for path in args.subset_files}
+    for data in args.data:
+        out_dir = args.vidc_dir / f"docs/subset_data/{data}"
+        extract_subsets(
+            args.vidc_dir / f"docs/{data}.json",
+            {out_dir / f"{data}_{name}.json": ids for name, ids in subset_ids.items()},
+            # Not every video has an ASR
+            only_present=data == "asrs",
+        )
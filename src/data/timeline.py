@@ -0,0 +1,118 @@
+"""
+Timeline records shared by the multi-modal prompts.
+
+The data classes return the lines of their transcripts (ASR segments,
+frame captions, frames) as `Record`s, already sorted by time. The merge
+strategies combine them with a linear k-way merge and render the text once,
+instead of rendering every source to a string and parsing it back.
+"""
+
+import heapq
+import re
+from typing import NamedTuple, Optional
+
+from src.data.timestamps import hms_to_sec, sec_to_hms_list
+
+PREFIXES = {"asr": "ASR ", "caption": "Caption ", "frame": "Frame "}
+LINE_PATTERN = re.compile(r"(\d{2}:\d{2}:\d{2}):\s*(.*)")
+
+
+class Record(NamedTuple):
+    seconds: int
+    source: str
+    text: str
+    end: Optional[int] = None
+
+
+def make_records(seconds, source, texts, ends=None):
+    """Build the records of one source from parallel lists."""
+    if ends is None:
+        return [Record(s, source, t) for s, t in zip(seconds, texts)]
+    return [Record(s, source, t, e) for s, t, e in zip(seconds, texts, ends)]
+
+
+def parse_records(input_str, source):
+    """Parse a rendered "hh:mm:ss: text" transcript back into records."""
+    return _parse_lines(input_str.strip().split("\n"), source)
+
+
+def _parse_lines(lines, source):
+    records = []
+    for line in lines:
+        match = LINE_PATTERN.match(line)
+        if match:
+            timestamp, content = match.groups()
+            records.append(Record(hms_to_sec(timestamp), source, content))
+    return records
+
+
+def line_records(records):
+    """
+    The records as `parse_records` reads them back from their rendered lines.
+
+    The merges used to render every source and parse it line by line, which
+    drops the "hh:mm:ss - hh:mm:ss: text" lines (records with an `end`) and
+    the continuation lines of a multi-line text, except the ones that start
+    with a timestamp. The prompts keep that output.
+    """
+    lines = []
+    for record in records:
+        text = record.text
+        if record.end is None and "\n" not in text and not text[:1].isspace():
+            lines.append(record)
+            continue
+        first, *rest = text.split("\n")
+        if record.end is None:
+            lines.append(record._replace(text=first.lstrip()))
+        lines.extend(_parse_lines(rest, record.source))
+    return lines
+
+
+def as_records(data, source):
+    """Accept either records or a rendered transcript string."""
+    if data is None:
+        return None
+    if isinstance(data, str):
+        return parse_records(data, source)
+    return line_records(data)
+
+
+def merge_records(*sources):
+    """
+    Merge time-ordered lists of records into one (linear k-way merge).
+
+    Ties are broken by the order of `sources`, like a stable sort of their
+    concatenation. `None` sources are skipped.
+    """
+    sources = [_sorted(records) for records in sources if records is not None]
+    if len(sources) == 1:
+        return sources[0]
+    return list(heapq.merge(*sources, key=lambda record: record.seconds))
+
+
+def _sorted(records):
+    # Sources are produced in time order, only re-sort if that is not the case
+    if all(a.seconds <= b.seconds for a, b in zip(records, records[1:])):
+        return records
+    return sorted(records, key=lambda record: record.seconds)
+
+
+def render_records(records, add_data_prefix=True):
+    """Render records as "<prefix>hh:mm:ss: text" lines."""
+    if not records:
+        return ""
+    starts = sec_to_hms_list([record.seconds for record in records])
+    ends = sec_to_hms_list([record.end or 0 for record in records])
+    lines = []
+    for record, start, end in zip(records, starts, ends):
+        prefix = PREFIXES[record.source] if add_data_prefix else ""
+        if record.end is None:
+            lines.append(f"{prefix}{start}: {record.text}")
+        else:
+            lines.append(f"{prefix}{start} - {end}: {record.text}")
+    return "\n".join(lines)
+
+
+def filter_images(records):
+    # Placeholder frames are rendered as "image" and are not shown to the model
+    return [record for record in records if "image" not in record.text]
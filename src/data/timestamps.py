@@ -0,0 +1,195 @@
+"""
+Timestamp codec for "hh:mm:ss" strings.
+
+`sec_to_hms` and `hms_to_sec` keep the behaviour of the original helpers from
+`src.data.chapters` but take a fast path for the common cases (integer-like
+seconds within a day, well-formed "hh:mm:ss" strings). The batch API converts
+numpy arrays of seconds to fixed-width "hh:mm:ss" byte strings (and back)
+through a lookup table for 0-86399 s, without any per-element Python call.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+DAY_SECONDS = 86_400
+HMS_DTYPE = np.dtype("S8")
+
+
+@lru_cache(maxsize=None)
+def hms_table():
+    """Lookup table with the "hh:mm:ss" string of every second of a day."""
+    return [
+        f"{h:02d}:{m:02d}:{s:02d}"
+        for h in range(24)
+        for m in range(60)
+        for s in range(60)
+    ]
+
+
+@lru_cache(maxsize=None)
+def hms_bytes_table():
+    """`hms_table` as a `(86400,)` array of `S8` byte strings."""
+    return np.array(hms_table(), dtype=HMS_DTYPE)
+
+
+def sec_to_hms(seconds, string=True, short=False):
+    """Convert seconds to hours, minutes, and seconds."""
+    if string and not short:
+        if type(seconds) is int:
+            if 0 <= seconds < DAY_SECONDS:
+                return hms_table()[seconds]
+        elif isinstance(seconds, float) and 0 <= seconds < DAY_SECONDS:
+            return hms_table()[int(seconds)]
+    return _sec_to_hms(seconds, string=string, short=short)
+
+
+def _sec_to_hms(seconds, string=True, short=False):
+    if isinstance(seconds, str) and ":" in seconds:
+        return sec_to_hms(hms_to_sec(seconds), string=string, short=short)
+    if isinstance(seconds, str) and seconds.isdigit() or isinstance(seconds, float):
+        seconds = int(seconds)
+    m, s = divmod(seconds, 60)
+    h, m = divmod(m, 60)
+    if string:
+        if h == 0 and short:
+            return f"{m:02d}:{s:02d}"
+        return f"{h:02d}:{m:02d}:{s:02d}"
+    return h, m, s
+
+
+def hms_to_sec(time_str, enable_single_part=False):
+    """Convert hours, minutes, and seconds to total seconds."""
+    if (
+        type(time_str) is str
+        and len(time_str) == 8
+        and time_str[2] == ":"
+        and time_str[5] == ":"
+    ):
+        hours, minutes, seconds = time_str[:2], time_str[3:5], time_str[6:]
+        if hours.isdigit() and minutes.isdigit() and seconds.isdigit():
+            minutes, seconds = int(minutes), int(seconds)
+            if minutes >= 60 or seconds >= 60:
+                return False
+            return int(hours) * 3600 + minutes * 60 + seconds
+    return _hms_to_sec(time_str, enable_single_part=enable_single_part)
+
+
+def _hms_to_sec(time_str, enable_single_part=False):
+    if isinstance(time_str, (int, float)):
+        return time_str
+    if isinstance(time_str, str) and time_str.isdigit():
+        return int(time_str)
+
+    parts = time_str.split(":")
+    if len(parts) == 3:
+        hours, minutes, seconds = parts
+        seconds = float(seconds) if "." in seconds else int(seconds)
+        minutes = int(minutes)
+        if minutes >= 60 or seconds >= 60:
+            return False
+        total_seconds = int(hours) * 3600 + minutes * 60 + seconds
+    elif len(parts) == 2:
+        minutes, seconds = parts
+        seconds = float(seconds) if "." in seconds else int(seconds)
+        minutes = int(minutes)
+        if seconds >= 60:
+            return False
+        total_seconds = int(minutes) * 60 + seconds
+    elif len(parts) == 1 and enable_single_part:
+        seconds = float(parts[0]) if "." in parts[0] else int(parts[0])
+        total_seconds = seconds
+    else:
+        raise ValueError("Invalid time format")
+    return total_seconds
+
+
+def sec_to_hms_list(seconds):
+    """Convert a sequence of seconds to a list of "hh:mm:ss" strings."""
+    seconds = np.asarray(seconds)
+    if seconds.size == 0:
+        return []
+    seconds = seconds.astype(np.int64)
+    if seconds.min() >= 0 and seconds.max() < DAY_SECONDS:
+        table = hms_table()
+        return [table[s] for s in seconds.tolist()]
+    return [sec_to_hms(s) for s in seconds.tolist()]
+
+
+def sec_to_hms_bytes(seconds):
+    """Convert an array of seconds to an array of "hh:mm:ss" byte strings."""
+    seconds = np.asarray(seconds).astype(np.int64)
+    in_range = (seconds >= 0) & (seconds < DAY_SECONDS)
+    if in_range.all():
+        return hms_bytes_table()[seconds]
+    # Rare: negative values or videos longer than a day
+    hms = [sec_to_hms(s).encode() for s in seconds.ravel().tolist()]
+    return np.array(hms).reshape(seconds.shape)
+
+
+def hms_bytes_to_sec(hms):
+    """
+    Convert an array of "hh:mm:ss" strings (bytes or str) to an int64 array.
+
+    Entries that are not well-formed or have minutes/seconds >= 60 are -1.
+    """
+    hms = np.asarray(hms)
+    if hms.dtype.kind == "U":
+        hms = np.char.encode(hms, "ascii")
+    hms = hms.astype(HMS_DTYPE)
+    chars = hms.reshape(-1).view(np.uint8).reshape(-1, 8).astype(np.int64)
+    digits = chars - ord("0")
+    is_digit = (digits >= 0) & (digits <= 9)
+    valid = is_digit[:, [0, 1, 3, 4, 6, 7]].all(axis=1)
+    valid &= (chars[:, 2] == ord(":")) & (chars[:, 5] == ord(":"))
+
+    hours = digits[:, 0] * 10 + digits[:, 1]
+    minutes = digits[:, 3] * 10 + digits[:, 4]
+    seconds = digits[:, 6] * 10 + digits[:, 7]
+    valid &= (minutes < 60) & (seconds < 60)
+    total = hours * 3600 + minutes * 60 + seconds
+    return np.where(valid, total, -1).reshape(hms.shape)
+
+
+if __name__ == "__main__":
+    import timeit
+
+    # Hour-long transcript with one ASR line every ~2 s
+    rng = np.random.default_rng(0)
+    starts = np.sort(rng.uniform(0, 3600, 1800)).round(2)
+    ends = starts + rng.uniform(0.5, 4, len(starts)).round(2)
+    texts = [f" line {i} " for i in range(len(starts))]
+    starts_list, ends_list = starts.tolist(), ends.tolist()
+
+    def render_reference():
+        lines = []
+        for t, s, e in zip(texts, starts_list, ends_list):
+            lines.append(f"{_sec_to_hms(s)} - {_sec_to_hms(e)}: {t.strip()}")
+        return "\n".join(lines) + "\n"
+
+    def render_codec():
+        s_hms, e_hms = sec_to_hms_list(starts), sec_to_hms_list(ends)
+        lines = [f"{s} - {e}: {t.strip()}" for t, s, e in zip(texts, s_hms, e_hms)]
+        return "\n".join(lines) + "\n"
+
+    assert render_reference() == render_codec()
+
+    def bench(name, reference, codec, number=200):
+        t_ref = timeit.timeit(reference, number=number) / number
+        t_new = timeit.timeit(codec, number=number) / number
+        speedup = t_ref / t_new
+        print(f"{name}: {t_ref * 1e3:.2f} ms -> {t_new * 1e3:.2f} ms ({speedup:.1f}x)")
+
+    hms = sec_to_hms_bytes(starts)
+    hms_list = hms.astype(str).tolist()
+    bench(f"render transcript ({len(starts)} lines)", render_reference, render_codec)
+    bench(
+        "format timestamps",
+        lambda: [_sec_to_hms(s) for s in starts_list],
+        lambda: sec_to_hms_bytes(starts),
+    )
+    bench(
+        "parse timestamps",
+        lambda: [_hms_to_sec(h) for h in hms_list],
+        lambda: hms_bytes_to_sec(hms),
+    )
@@ -1,7 +1,15 @@
-from lutils import openf, writef
+from pathlib import Path
 
-from src.data.chapters import Chapters, sec_to_hms
+import numpy as np
+from lutils import openf
+
+from src.data.asr_store import ASRStore
+from src.data.cache import TranscriptCache
+from src.data.chapters import Chapters
 from src.data.prompt import Prompt
+from src.data.subsets import extract_subsets
+from src.data.timeline import make_records
+from src.data.timestamps import sec_to_hms_list
 from src.utils import RankedLogger
 
 log = RankedLogger(__name__, rank_zero_only=True)
@@ -12,6 +20,8 @@ class ChaptersASR(Chapters):
         super().__init__(vidc_dir=vidc_dir, subset=subset)
 
         self._asrs = None
+        self._asr_source = None
+        self._transcripts = None
 
     @property
     def asrs(self):
@@ -23,8 +33,19 @@ class ChaptersASR(Chapters):
         if self._asrs is not None:
             return
 
+        # Use the compiled store if available (python -m src.data.asr_store)
+        store_dir = self.vidc_dir / "docs/asrs_store"
+        if ASRStore.exists(store_dir):
+            store = ASRStore(store_dir)
+            if self.subset:
+                store = store.subset(self.video_ids, strict=False)
+            self._asrs = store
+            self._asr_source = store_dir / "info.json"
+            return
+
         if self.subset:
             asr_pth = self.vidc_dir / f"docs/subset_data/asrs/asrs_{self.subset}.json"
+            self._asr_source = asr_pth
             if asr_pth.exists():
                 self._asrs = openf(asr_pth)
             else:
@@ -33,37 +54,84 @@ class ChaptersASR(Chapters):
                 asr_train_pth = self.vidc_dir / "docs/subset_data/asrs/asrs_train.json"
                 if "val" in self.subset and asr_val_pth.exists():
                     log.info("Loading from ASR validation file.")
-                    asrs = openf(asr_val_pth)
+                    source_pth = asr_val_pth
                 elif "train" in self.subset and asr_train_pth.exists():
                     log.info("Loading from ASR training file.")
-                    asrs = openf(asr_train_pth)
+                    source_pth = asr_train_pth
                 else:
                     log.info("Loading from ASR file.")
-                    asrs = openf(self.vidc_dir / "docs/asrs.json")
-                video_ids = set(self.video_ids) & set(asrs.keys())
-                self._asrs = {vid_id: asrs[vid_id] for vid_id in video_ids}
-                asr_pth.parent.mkdir(exist_ok=True)
-                writef(asr_pth, self._asrs)
+                    source_pth = self.vidc_dir / "docs/asrs.json"
+                # Stream the subset out of the source instead of loading it
+                extract_subsets(
+                    source_pth, {asr_pth: list(self.video_ids)}, only_present=True
+                )
+                self._asrs = openf(asr_pth)
         else:
-            self._asrs = openf(self.vidc_dir / "docs/asrs.json")
+            self._asr_source = self.vidc_dir / "docs/asrs.json"
+            self._asrs = openf(self._asr_source)
+
+    @property
+    def transcripts(self):
+        """
+        Cache of the rendered transcripts (see `TranscriptCache`).
+
+        Subsets also get an on-disk tier in `docs/subset_data/transcripts/`,
+        rendered once for all the videos of the subset on first access.
+        """
+        if self._transcripts is None:
+            self.load_asr_data()
+            source = Path(self._asr_source)
+            stat = source.stat()
+            self._transcripts = TranscriptCache(
+                cache_dir=(
+                    self.vidc_dir / "docs/subset_data/transcripts"
+                    if self.subset
+                    else None
+                ),
+                name=f"asrs_{self.subset}",
+                source=[
+                    str(source.resolve()),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    len(self),
+                ],
+                render=self.render_asr,
+                video_ids=lambda: self.asrs.keys(),
+            )
+        return self._transcripts
 
     def get_asr(self, video_id, add_end=False):
+        if video_id not in self.asrs:
+            return None
+        return self.transcripts.get(video_id, add_end)
+
+    def render_asr(self, video_id, add_end=False):
         if video_id not in self.asrs:
             return None
 
         asr = self.asrs[video_id]
-        asr_clean = []
-        for t, s, e in zip(asr["text"], asr["start"], asr["end"]):
-            t = t.strip()
-            s = sec_to_hms(s)
-            e = sec_to_hms(e)
-            if add_end:
-                asr_clean.append(f"{s} - {e}: {t}")
-            else:
-                asr_clean.append(f"{s}: {t}")
+        starts = sec_to_hms_list(asr["start"])
+        if add_end:
+            ends = sec_to_hms_list(asr["end"])
+            asr_clean = [
+                f"{s} - {e}: {t.strip()}" for t, s, e in zip(asr["text"], starts, ends)
+            ]
+        else:
+            asr_clean = [f"{s}: {t.strip()}" for t, s in zip(asr["text"], starts)]
 
         return "\n".join(asr_clean) + "\n"
 
+    def get_asr_records(self, video_id, add_end=False):
+        """ASR segments of a video as timeline records (see `src.data.timeline`)."""
+        if video_id not in self.asrs:
+            return None
+
+        asr = self.asrs[video_id]
+        starts = np.asarray(asr["start"]).astype(np.int64).tolist()
+        ends = np.asarray(asr["end"]).astype(np.int64).tolist() if add_end else None
+        texts = [t.strip() for t in asr["text"]]
+        return make_records(starts, "asr", texts, ends)
+
     def __contains__(self, vid_id):
         return vid_id in self.asrs
 
@@ -1,9 +1,13 @@
 from pathlib import Path
 
+import numpy as np
 from lutils import openf
 
-from src.data.chapters import Chapters, sec_to_hms
+from src.data.captions_pack import CaptionsPack, sort_captions
+from src.data.chapters import Chapters
+from src.data.timeline import make_records
 from src.data.prompt import Prompt
+from src.data.timestamps import sec_to_hms_list
 from src.utils import RankedLogger
 
 log = RankedLogger(__name__, rank_zero_only=True)
@@ -17,8 +21,16 @@ class ChaptersCaptions(Chapters):
         assert (
             self.captions_dir.exists()
         ), f"Captions directory does not exist: {self.captions_dir}"
-        captions_pths = list(self.captions_dir.glob("*/*.json"))
-        captions_ids = {p.stem for p in captions_pths}
+
+        # Use the pack if available (python -m src.data.captions_pack captions_dir)
+        pack_dir = CaptionsPack.pack_dir(self.captions_dir)
+        if CaptionsPack.exists(pack_dir):
+            self.captions_pack = CaptionsPack(pack_dir)
+            captions_ids = set(self.captions_pack.video_ids)
+        else:
+            self.captions_pack = None
+            captions_pths = list(self.captions_dir.glob("*/*.json"))
+            captions_ids = {p.stem for p in captions_pths}
         assert (
             len(captions_ids) > 0
         ), f"No captions found in directory {self.captions_dir}"
@@ -26,22 +38,47 @@ class ChaptersCaptions(Chapters):
         self.captions_ids = captions_ids
 
     def get_caption(self, video_id):
-        vid_captions = openf(self.captions_dir / f"{video_id[:2]}" / f"{video_id}.json")
         vid_duration = self.get_duration(video_id)
+        if self.captions_pack is not None:
+            frames, captions = self.captions_pack[video_id]
+            return self.render_captions(frames, captions, vid_duration)
 
+        vid_captions = openf(self.captions_dir / f"{video_id[:2]}" / f"{video_id}.json")
         vid_captions = self.prepare_captions(vid_captions, vid_duration)
         return vid_captions
 
+    def get_caption_records(self, video_id):
+        """Captions of a video as timeline records (see `src.data.timeline`)."""
+        if self.captions_pack is not None:
+            frames, captions = self.captions_pack[video_id]
+        else:
+            vid_captions = openf(
+                self.captions_dir / f"{video_id[:2]}" / f"{video_id}.json"
+            )
+            frames, captions = sort_captions(vid_captions)
+        if len(captions) == 0:
+            return []
+
+        vid_duration = self.get_duration(video_id)
+        seconds = (vid_duration * frames[:, 0] / frames[:, 1]).astype(np.int64)
+        # The rendered captions are stripped, `as_records` strips each line
+        texts = list(captions)
+        texts[-1] = texts[-1].rstrip()
+        return make_records(seconds.tolist(), "caption", texts)
+
     @staticmethod
     def prepare_captions(vid_captions, vid_duration):
-        caption_clean = ""
-        vid_timestamps = sorted(vid_captions, key=lambda x: int(x.split("/")[0]))
-        for frame_pct in vid_timestamps:
-            frame_idx, n_frames = frame_pct.split("/")
-            frame_time = vid_duration * int(frame_idx) / int(n_frames)
-            frame_time = sec_to_hms(frame_time)
-            caption = vid_captions[frame_pct]
-            caption_clean += f"{frame_time}: {caption}\n"
+        frames, captions = sort_captions(vid_captions)
+        return ChaptersCaptions.render_captions(frames, captions, vid_duration)
+
+    @staticmethod
+    def render_captions(frames, captions, vid_duration):
+        """Render the captions sorted by frame, `frames` being `(index, n_frames)`."""
+        frame_times = sec_to_hms_list(vid_duration * frames[:, 0] / frames[:, 1])
+        caption_clean = "\n".join(
+            f"{frame_time}: {caption}"
+            for frame_time, caption in zip(frame_times, captions)
+        )
 
         caption_clean = caption_clean.strip()
         return caption_clean
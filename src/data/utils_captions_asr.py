@@ -1,7 +1,6 @@
-import re
-from datetime import datetime
 from pathlib import Path
 
+from src.data.timeline import as_records, merge_records, render_records
 from src.data.utils_asr import ChaptersASR
 from src.data.utils_captions import ChaptersCaptions, PromptCaptions
 from src.utils import RankedLogger
@@ -46,40 +45,29 @@ class PromptCaptionsASR(PromptCaptions):
         return "use the provided captions and ASR transcript to identify distinct chapters based on content shifts.\n"
 
     def get_transcript(self, vid_id):
-        caption = self.chapters.get_caption(vid_id)
-        asr = self.chapters.get_asr(vid_id, add_end=self.add_end)
-        return self.merging_method(asr, caption, add_data_prefix=self.add_data_prefix)
-
-
-def parse_timestamp(timestamp):
-    return datetime.strptime(timestamp, "%H:%M:%S")
-
+        return self.merge_transcript(
+            vid_id, add_end=self.add_end, add_data_prefix=self.add_data_prefix
+        )
 
-def parse_input(input_str, prefix, suffix=""):
-    lines = input_str.strip().split("\n")
-    parsed = []
-    for line in lines:
-        match = re.match(r"(\d{2}:\d{2}:\d{2}):\s*(.*)", line)
-        if match:
-            timestamp, content = match.groups()
-            parsed.append(
-                (parse_timestamp(timestamp), f"{prefix}{timestamp}: {content}{suffix}")
-            )
-    return parsed
+    def merge_transcript(self, vid_id, add_end=False, add_data_prefix=True):
+        if self.merging_method is interleave_asr_and_captions:
+            # Merge the timeline records directly, without rendering them first
+            caption = self.chapters.get_caption_records(vid_id)
+            asr = self.chapters.get_asr_records(vid_id, add_end=add_end)
+        else:
+            caption = self.chapters.get_caption(vid_id)
+            asr = self.chapters.get_asr(vid_id, add_end=add_end)
+        return self.merging_method(asr, caption, add_data_prefix=add_data_prefix)
 
 
 def interleave_asr_and_captions(asr_input, captions_input, add_data_prefix=True):
-    prefix = "Caption " if add_data_prefix else ""
-    captions_data = parse_input(captions_input, f"{prefix}")
-
-    if asr_input is None:
-        combined = captions_data
-    else:
-        prefix = "ASR " if add_data_prefix else ""
-        asr_data = parse_input(asr_input, f"{prefix}")
-        combined = sorted(asr_data + captions_data, key=lambda x: x[0])
-
-    return "\n".join(item[1] for item in combined)
+    captions_data = as_records(captions_input, "caption")
+    asr_data = as_records(asr_input, "asr")
+    if asr_data is None:
+        # A single source is rendered in its own order, without re-sorting
+        return render_records(captions_data, add_data_prefix=add_data_prefix)
+    combined = merge_records(asr_data, captions_data)
+    return render_records(combined, add_data_prefix=add_data_prefix)
 
 
 def concatenate_asr_and_captions(asr_input, captions_input, **kwargs):
@@ -1,35 +1,17 @@
-from collections import OrderedDict
 from pathlib import Path
 
 import numpy as np
 import torch
 
-from src.data.chapters import Chapters, sec_to_hms
+from src.data.cache import LRUCache
+from src.data.chapters import Chapters
 from src.data.prompt import Prompt
+from src.data.timeline import make_records, render_records
 from src.utils import RankedLogger
 
 log = RankedLogger(__name__, rank_zero_only=True)
 
 
-class LRUCache(OrderedDict):
-    def __init__(self, maxsize=32):
-        super().__init__()
-        self.maxsize = maxsize
-
-    def get(self, key):
-        if key not in self:
-            return None
-        self.move_to_end(key)
-        return self[key]
-
-    def put(self, key, value):
-        if key in self:
-            self.move_to_end(key)
-        self[key] = value
-        if len(self) > self.maxsize:
-            self.popitem(last=False)
-
-
 class ChaptersFrames(Chapters):
     def __init__(
         self,
@@ -121,15 +103,14 @@ class ChaptersFrames(Chapters):
             return len(frames)
         return min(len(frames), self.max_frames)
 
-    def get_frames_transcript(self, vid_id):
+    def get_frames_records(self, vid_id):
+        """Frames of a video as timeline records (see `src.data.timeline`)."""
         vid_frames = self.get_frames(vid_id)
         frames = vid_frames["frames"]
         total_frames = vid_frames["total_frames"]
         total_time = vid_frames["total_time"]
 
-        frame_times = [
-            sec_to_hms(round(frame * total_time / total_frames)) for frame in frames
-        ]
+        frame_times = [round(frame * total_time / total_frames) for frame in frames]
 
         num_frames = len(frame_times)
         if self.max_frames is not None and num_frames > self.max_frames:
@@ -139,14 +120,19 @@ class ChaptersFrames(Chapters):
         else:
             special_indices = set(range(num_frames))
 
-        frames_transcript = ""
-        for i, frame_time in enumerate(frame_times):
-            if self.max_frames is None or i in special_indices:
-                frames_transcript += f"{frame_time}: <|reserved_special_token_0|>\n"
-            else:
-                frames_transcript += f"{frame_time}: image\n"
+        texts = [
+            "<|reserved_special_token_0|>"
+            if self.max_frames is None or i in special_indices
+            else "image"
+            for i in range(num_frames)
+        ]
+        return make_records(frame_times, "frame", texts)
 
-        return frames_transcript
+    def get_frames_transcript(self, vid_id):
+        records = self.get_frames_records(vid_id)
+        if not records:
+            return ""
+        return render_records(records, add_data_prefix=False) + "\n"
 
     def __contains__(self, vid_id):
         return vid_id in self.frames_ids
@@ -1,5 +1,5 @@
+from src.data.timeline import as_records, filter_images, merge_records, render_records
 from src.data.utils_asr import ChaptersASR
-from src.data.utils_captions_asr import parse_input
 from src.data.utils_frames import ChaptersFrames, PromptFrames
 from src.utils import RankedLogger
 
@@ -61,8 +61,8 @@ class PromptFramesASR(PromptFrames):
         return "use the provided frames and ASR transcript to identify distinct chapters based on content shifts.\n"
 
     def get_transcript(self, vid_id):
-        frames = self.chapters.get_frames_transcript(vid_id)
-        asr = self.chapters.get_asr(vid_id, add_end=self.add_end)
+        frames = self.chapters.get_frames_records(vid_id)
+        asr = self.chapters.get_asr_records(vid_id, add_end=self.add_end)
         return self.merging_method(frames, asr, add_data_prefix=self.add_data_prefix)
 
     def get_frames_features(self, vid_id):
@@ -74,29 +74,23 @@ class PromptFramesASR(PromptFrames):
 
 
 def interleave_frames_and_asr(frames_input, asr_input, add_data_prefix=True):
-    prefix = "Frame " if add_data_prefix else ""
-    frames_data = parse_input(frames_input, f"{prefix}")
-
-    if asr_input is None:
-        combined = frames_data
-    else:
-        prefix = "ASR " if add_data_prefix else ""
-        asr_data = parse_input(asr_input, f"{prefix}")
-        combined = sorted(asr_data + frames_data, key=lambda x: x[0])
-
-    return "\n".join(item[1] for item in combined)
+    frames_data = as_records(frames_input, "frame")
+    asr_data = as_records(asr_input, "asr")
+    if asr_data is None:
+        # A single source is rendered in its own order, without re-sorting
+        return render_records(frames_data, add_data_prefix=add_data_prefix)
+    combined = merge_records(asr_data, frames_data)
+    return render_records(combined, add_data_prefix=add_data_prefix)
 
 
 def concatenate_frames_and_asr(frames_input, asr_input, add_data_prefix=True):
-    prefix = "Frame " if add_data_prefix else ""
-    frames_data = parse_input(frames_input, f"{prefix}")
-    frames_data = "\n".join([line[1] for line in frames_data if "image" not in line[1]])
+    frames_data = filter_images(as_records(frames_input, "frame"))
+    frames_data = render_records(frames_data, add_data_prefix=add_data_prefix)
 
     if asr_input is None:
         return frames_data
-    prefix = "ASR " if add_data_prefix else ""
-    asr_data = parse_input(asr_input, f"{prefix}")
-    asr_data = "\n".join([line[1] for line in asr_data])
+    asr_data = as_records(asr_input, "asr")
+    asr_data = render_records(asr_data, add_data_prefix=add_data_prefix)
 
     return frames_data + "\n\n" + asr_data
 
@@ -105,14 +99,12 @@ def concatenate_asr_and_frames(frames_input, asr_input, add_data_prefix=True):
     if asr_input is None:
         asr_data = ""
     else:
-        prefix = "ASR " if add_data_prefix else ""
-        asr_data = parse_input(asr_input, f"{prefix}")
-        asr_data = "\n".join([line[1] for line in asr_data])
+        asr_data = as_records(asr_input, "asr")
+        asr_data = render_records(asr_data, add_data_prefix=add_data_prefix)
         asr_data = asr_data + "\n\n"
 
-    prefix = "Frame " if add_data_prefix else ""
-    frames_data = parse_input(frames_input, f"{prefix}")
-    frames_data = "\n".join([line[1] for line in frames_data if "image" not in line[1]])
+    frames_data = filter_images(as_records(frames_input, "frame"))
+    frames_data = render_records(frames_data, add_data_prefix=add_data_prefix)
 
     return asr_data + frames_data
 
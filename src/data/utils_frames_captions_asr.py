@@ -1,8 +1,6 @@
-import re
-
+from src.data.timeline import as_records, filter_images, merge_records, render_records
 from src.data.utils_asr import ChaptersASR
 from src.data.utils_captions import ChaptersCaptions
-from src.data.utils_captions_asr import parse_input
 from src.data.utils_frames import ChaptersFrames, PromptFrames
 from src.utils import RankedLogger
 
@@ -65,9 +63,9 @@ class PromptFramesCaptionsASR(PromptFrames):
         return "use the ASR transcript and provided captions and frames to identify distinct chapters based on content shifts.\n"
 
     def get_transcript(self, vid_id):
-        frames_transcript = self.chapters.get_frames_transcript(vid_id)
-        captions = self.chapters.get_caption(vid_id)
-        asr = self.chapters.get_asr(vid_id)
+        frames_transcript = self.chapters.get_frames_records(vid_id)
+        captions = self.chapters.get_caption_records(vid_id)
+        asr = self.chapters.get_asr_records(vid_id)
         return self.merging_method(frames_transcript, asr, captions)
 
     def get_frames_features(self, vid_id):
@@ -81,62 +79,43 @@ class PromptFramesCaptionsASR(PromptFrames):
 def interleave_frames_asr_captions(
     frames_transcript, asr_input, captions_input, add_data_prefix=True
 ):
-    prefix = "Frame " if add_data_prefix else ""
-    frames_data = parse_input(frames_transcript, f"{prefix}")
     # Filter out lines containing "image", it needs to be <|reserved_special_token_0|>
-    frames_data = [line for line in frames_data if "image" not in line[1]]
-
-    prefix = "Caption " if add_data_prefix else ""
-    captions_data = parse_input(captions_input, f"{prefix}")
-
-    if asr_input is None:
-        combined = sorted(captions_data + frames_data, key=lambda x: x[0])
-    else:
-        prefix = "ASR " if add_data_prefix else ""
-        asr_data = parse_input(asr_input, f"{prefix}")
-        combined = sorted(asr_data + captions_data + frames_data, key=lambda x: x[0])
+    frames_data = filter_images(as_records(frames_transcript, "frame"))
+    captions_data = as_records(captions_input, "caption")
+    asr_data = as_records(asr_input, "asr")
 
-    return "\n".join(item[1] for item in combined)
+    combined = merge_records(asr_data, captions_data, frames_data)
+    return render_records(combined, add_data_prefix=add_data_prefix)
 
 
 def frames_interleave_captions_asr(
     frames_transcript, asr_input, captions_input, add_data_prefix=True
 ):
-    prefix = "Frame " if add_data_prefix else ""
-    frames_data = parse_input(frames_transcript, f"{prefix}")
     # Filter out lines containing "image", it needs to be <|reserved_special_token_0|>
-    frames_data = "\n".join([line[1] for line in frames_data if "image" not in line[1]])
-
-    prefix = "Caption " if add_data_prefix else ""
-    captions_data = parse_input(captions_input, f"{prefix}")
+    frames_data = filter_images(as_records(frames_transcript, "frame"))
+    frames_data = render_records(frames_data, add_data_prefix=add_data_prefix)
 
-    if asr_input is None:
-        combined = sorted(captions_data, key=lambda x: x[0])
-    else:
-        prefix = "ASR " if add_data_prefix else ""
-        asr_data = parse_input(asr_input, f"{prefix}")
-        combined = sorted(asr_data + captions_data, key=lambda x: x[0])
+    captions_data = as_records(captions_input, "caption")
+    asr_data = as_records(asr_input, "asr")
+    combined = merge_records(asr_data, captions_data)
 
-    return frames_data + "\n\n" + "\n".join(item[1] for item in combined)
+    return frames_data + "\n\n" + render_records(combined, add_data_prefix)
 
 
 def concatenate_frames_captions_asr(
     frames_transcript, asr_input, captions_input, add_data_prefix=True
 ):
-    prefix = "Frame " if add_data_prefix else ""
-    frames_data = parse_input(frames_transcript, f"{prefix}")
-    frames_data = "\n".join([line[1] for line in frames_data if "image" not in line[1]])
+    frames_data = filter_images(as_records(frames_transcript, "frame"))
+    frames_data = render_records(frames_data, add_data_prefix=add_data_prefix)
 
-    prefix = "Caption " if add_data_prefix else ""
-    captions_data = parse_input(captions_input, f"{prefix}")
-    captions_data = "\n".join([line[1] for line in captions_data])
+    captions_data = as_records(captions_input, "caption")
+    captions_data = render_records(captions_data, add_data_prefix=add_data_prefix)
 
     if asr_input is None:
         return frames_data + "\n\n" + captions_data
 
-    prefix = "ASR " if add_data_prefix else ""
-    asr_data = parse_input(asr_input, f"{prefix}")
-    asr_data = "\n".join([line[1] for line in asr_data])
+    asr_data = as_records(asr_input, "asr")
+    asr_data = render_records(asr_data, add_data_prefix=add_data_prefix)
 
     return frames_data + "\n\n" + captions_data + "\n\n" + asr_data
 
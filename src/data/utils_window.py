@@ -4,9 +4,10 @@ from pathlib import Path
 
 from transformers import AutoTokenizer
 
-from src.data.chapters import hms_to_sec, sec_to_hms
+from src.data.cache import LRUCache
+from src.data.timestamps import hms_to_sec, sec_to_hms
 from src.data.utils_captions_asr import ChaptersCaptionsASR, PromptCaptionsASR
-from src.test.vidchapters_window import get_window
+from src.test.vidchapters_window import WindowIndex, get_window
 from src.utils import RankedLogger
 
 log = RankedLogger(__name__, rank_zero_only=True)
@@ -19,6 +20,7 @@ class PromptCaptionsASRWindow(PromptCaptionsASR):
         chapters: ChaptersCaptionsASR,
         merging_method="interleave",
         window_token_size=15_000,
+        max_cached_windows=1024,
     ):
         PromptCaptionsASR.__init__(self, chapters, merging_method)
 
@@ -26,29 +28,23 @@ class PromptCaptionsASRWindow(PromptCaptionsASR):
 
         self.window_token_size = window_token_size
 
-        self.id2window = {}
+        # Bounded: the window of a video is only needed until its dialog is built
+        self.id2window = LRUCache(maxsize=max_cached_windows)
 
     def get_prompt_train(self, vid_id: str) -> str:
-        if vid_id in self.id2window:
-            return self.id2window[vid_id]["prompt"]
-
-        self.get_window_transcript(vid_id=vid_id)
-        return self.id2window[vid_id]["prompt"]
+        return self.get_window_transcript(vid_id)["prompt"]
 
     def get_transcript(self, vid_id):
-        if vid_id in self.id2window:
-            return self.id2window[vid_id]["transcript"]
-
-        self.get_window_transcript(vid_id)
-        return self.id2window[vid_id]["transcript"]
+        return self.get_window_transcript(vid_id)["transcript"]
 
-    def get_window(self, transcript, prompt, start_time=0):
+    def get_window(self, transcript, prompt, start_time=0, index=None):
         prompt, transcript, _ = get_window(
             prompt=prompt,
             transcript=transcript,
             start_time=start_time,
             tokenizer=self.tokenizer,
             window_token_size=self.window_token_size,
+            index=index,
         )
         return prompt, transcript
 
@@ -67,29 +63,21 @@ class PromptCaptionsASRWindow(PromptCaptionsASR):
         return "\n".join(answers)
 
     def get_output(self, vid_id: str) -> str:
-        if vid_id in self.id2window:
-            return self.id2window[vid_id]["output"]
-
-        self.get_window_transcript(vid_id)
-        return self.id2window[vid_id]["output"]
+        return self.get_window_transcript(vid_id)["output"]
 
     def get_window_transcript(self, vid_id):
-        if vid_id in self.id2window:
-            return self.id2window[vid_id]
+        window = self.id2window.get(vid_id)
+        if window is not None:
+            return window
 
         prompt = self.get_base_prompt(vid_id)
-        caption = self.chapters.get_caption(vid_id)
-        asr = self.chapters.get_asr(vid_id)
-        transcript = self.merging_method(asr, caption)
-        n_tokens = len(self.tokenizer.encode(transcript))
-        if n_tokens <= self.window_token_size:
+        transcript = self.merge_transcript(vid_id)
+        index = WindowIndex(transcript, self.tokenizer)
+        if index.n_tokens <= self.window_token_size:
             output = self.get_window_output(vid_id)
-            self.id2window[vid_id] = {
-                "prompt": prompt,
-                "transcript": transcript,
-                "output": output,
-            }
-            return self.id2window[vid_id]
+            window = {"prompt": prompt, "transcript": transcript, "output": output}
+            self.id2window.put(vid_id, window)
+            return window
 
         start_times = self.chapters.get_timestamps(
             vid_id, zero_handling="add", duration_handling="remove"
@@ -103,6 +91,7 @@ class PromptCaptionsASRWindow(PromptCaptionsASR):
             transcript=transcript,
             prompt=prompt,
             start_time=start_time,
+            index=index,
         )
 
         last_line = transcript.split("\n")[-1]
@@ -111,11 +100,9 @@ class PromptCaptionsASRWindow(PromptCaptionsASR):
         end_time = start_time + hms_to_sec(end_time)
         output = self.get_window_output(vid_id, start_time, end_time)
 
-        self.id2window[vid_id] = {
-            "prompt": prompt,
-            "transcript": transcript,
-            "output": output,
-        }
+        window = {"prompt": prompt, "transcript": transcript, "output": output}
+        self.id2window.put(vid_id, window)
+        return window
 
 
 if __name__ == "__main__":
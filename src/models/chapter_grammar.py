@@ -0,0 +1,301 @@
+"""
+Grammar-constrained decoding of the chapter output format.
+
+`ChapterLogitsProcessor` masks the logits so that every generated line is
+"hh:mm:ss - Title\n", with timestamps strictly increasing and below the video
+duration (and optionally restricted to the timestamps of the transcript). The
+output is then always kept by `extract_chapters` and `filter_chapters`, and
+there is no need to generate again with sampling.
+
+`ChapterGrammar` holds everything that only depends on the tokenizer and is
+built once: the text of every token, a trie of the tokens that can be part of
+the "hh:mm:ss - " header of a line (digits, ":", " ", "-") and boolean masks
+of the tokens that can start or continue a title. At each step, a header is
+extended by walking the (small) trie and a title by a precomputed mask.
+"""
+
+import re
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, replace
+from functools import lru_cache
+
+import torch
+from transformers import LogitsProcessor
+
+from src.data.timestamps import hms_to_sec
+from src.models.llama_inference import get_terminators
+
+TIMESTAMP_PATTERN = re.compile(r"\b(\d{2}):([0-5]\d):([0-5]\d)\b")
+
+# Header of a line: "hh:mm:ss - " with fixed positions
+HEADER_LEN = 11
+HEADER_CHARS = set("0123456789: -")
+SEPARATORS = {2: ":", 5: ":", 8: " ", 9: "-", 10: " "}
+# Tens of minutes and seconds
+MAX_TENS = {3: "5", 6: "5"}
+MIN_TIME = "00:00:00"
+MAX_TIME = "99:59:59"
+# At most "\n\n" before the first chapter
+MAX_LEADING_NEWLINES = 2
+
+# A title starts with a character that `extract_chapters` does not strip
+TITLE_SPACE = re.compile(r" [^\s\d:-][^\n]*\n?")
+TITLE_START = re.compile(r"[^\s\d:-][^\n]*\n?")
+TITLE = re.compile(r"[^\n]*\n?")
+NEWLINES = re.compile(r"\n+")
+
+
+class TrieNode:
+    __slots__ = ("children", "ids")
+
+    def __init__(self):
+        self.children = {}
+        self.ids = []
+
+
+@dataclass
+class LineState:
+    """Parsing state of one generated sequence."""
+
+    # "start" (before the first line), "header" or "title"
+    mode: str = "start"
+    line: str = ""
+    n_newlines: int = 0
+    last_time: int = -1
+    first_time: int = None
+    n_chapters: int = 0
+    done: bool = False
+
+
+class ChapterGrammar:
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.terminators = [t for t in get_terminators(tokenizer) if t is not None]
+        special_ids = set(tokenizer.all_special_ids)
+        special_ids.update(getattr(tokenizer, "added_tokens_decoder", {}))
+
+        self.token_texts = []
+        self.header_trie = TrieNode()
+        masks = {"newlines": [], "title_space": [], "title_start": [], "title": []}
+        for token_id in range(len(tokenizer)):
+            text = "" if token_id in special_ids else tokenizer.decode([token_id])
+            self.token_texts.append(text)
+            if text and set(text) <= HEADER_CHARS:
+                node = self.header_trie
+                for char in text:
+                    node = node.children.setdefault(char, TrieNode())
+                node.ids.append(token_id)
+            for name, pattern in [
+                ("newlines", NEWLINES),
+                ("title_space", TITLE_SPACE),
+                ("title_start", TITLE_START),
+                ("title", TITLE),
+            ]:
+                if text and pattern.fullmatch(text):
+                    masks[name].append(token_id)
+        self.masks = masks
+        self._device_masks = {}
+        self._header_cache = {}
+
+    def get_mask(self, name, vocab_size, device):
+        key = (name, vocab_size, device)
+        if key not in self._device_masks:
+            mask = torch.zeros(vocab_size, dtype=torch.bool)
+            ids = [i for i in self.masks[name] if i < vocab_size]
+            mask[ids] = True
+            self._device_masks[key] = mask.to(device)
+        return self._device_masks[key]
+
+    def advance(self, state: LineState, token_id: int):
+        """Update `state` with a generated token."""
+        if state.done or token_id in self.terminators:
+            state.done = True
+            return
+        text = self.token_texts[token_id] if token_id < len(self.token_texts) else ""
+        for char in text:
+            if state.mode == "start":
+                if char == "\n":
+                    state.n_newlines += 1
+                    continue
+                state.mode = "header"
+            if state.mode == "header":
+                if len(state.line) < HEADER_LEN:
+                    if not header_char(len(state.line), char):
+                        # Proposed by speculative decoding: it will be rejected
+                        state.done = True
+                        return
+                    state.line += char
+                    continue
+                # First character of the title: the chapter is complete
+                time = hms_to_sec(state.line[:8])
+                if state.first_time is None:
+                    state.first_time = time
+                state.last_time = time
+                state.n_chapters += 1
+                state.mode = "title"
+            if char == "\n":
+                state.mode, state.line = "header", ""
+
+    def allowed(self, state: LineState, timestamps, vocab_size, device):
+        """Boolean mask of the tokens allowed after `state`."""
+        if state.done:
+            return torch.ones(vocab_size, dtype=torch.bool, device=device)
+
+        mask = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+        if state.mode == "title":
+            mask |= self.get_mask("title", vocab_size, device)
+        elif len(state.line) == HEADER_LEN:
+            mask |= self.get_mask("title_start", vocab_size, device)
+        else:
+            if len(state.line) == HEADER_LEN - 1:
+                mask |= self.get_mask("title_space", vocab_size, device)
+            if state.mode == "start" and state.n_newlines < MAX_LEADING_NEWLINES:
+                mask |= self.get_mask("newlines", vocab_size, device)
+            ids = self.header_tokens(state.line, state.last_time, timestamps)
+            mask[[i for i in ids if i < vocab_size]] = True
+
+        at_line_end = state.mode == "title" or state.mode == "header" and not state.line
+        valid = state.n_chapters > 1 or state.n_chapters == 1 and state.first_time > 0
+        if (at_line_end and valid) or not mask.any():
+            mask[[t for t in self.terminators if t < vocab_size]] = True
+        return mask
+
+    def header_tokens(self, line, last_time, timestamps):
+        """Ids of the tokens that extend a header prefix to a valid one."""
+        key = (line, last_time, timestamps)
+        if key not in self._header_cache:
+            if len(self._header_cache) > 100_000:
+                self._header_cache.clear()
+            ids = []
+            stack = [(self.header_trie, line)]
+            while stack:
+                node, text = stack.pop()
+                for char, child in node.children.items():
+                    new_text = text + char
+                    if not valid_header(new_text, last_time, timestamps):
+                        continue
+                    ids.extend(child.ids)
+                    if len(new_text) < HEADER_LEN:
+                        stack.append((child, new_text))
+            self._header_cache[key] = ids
+        return self._header_cache[key]
+
+
+class Timestamps:
+    """Timestamps (in seconds) that can start a chapter."""
+
+    def __init__(self, before, allowed=None):
+        self.before = before
+        self.allowed = None if allowed is None else tuple(sorted(set(allowed)))
+        # Part of the cache key of every step, hash the timestamps only once
+        self._hash = hash((self.before, self.allowed))
+
+    def any_between(self, lo, hi):
+        hi = min(hi, self.before - 1)
+        if lo > hi:
+            return False
+        if self.allowed is None:
+            return True
+        return bisect_left(self.allowed, lo) < bisect_right(self.allowed, hi)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return (self.before, self.allowed) == (other.before, other.allowed)
+
+
+def header_char(pos, char):
+    """Whether `char` can be at position `pos` of a header."""
+    if pos in SEPARATORS:
+        return char == SEPARATORS[pos]
+    return "0" <= char <= MAX_TENS.get(pos, "9")
+
+
+def valid_header(text, last_time, timestamps):
+    """Whether `text` is a prefix of a valid "hh:mm:ss - " header."""
+    pos = len(text) - 1
+    if not header_char(pos, text[pos]):
+        return False
+    if pos in SEPARATORS:
+        return True
+    # The times starting with this prefix form a contiguous range
+    lo = hms_to_sec(text + MIN_TIME[len(text) :])
+    hi = hms_to_sec(text + MAX_TIME[len(text) :])
+    return timestamps.any_between(max(lo, last_time + 1), hi)
+
+
+class ChapterLogitsProcessor(LogitsProcessor):
+    """
+    Constrain the generation to "hh:mm:ss - Title" lines.
+
+    Timestamps are strictly increasing and below `vid_duration` ("hh:mm:ss"),
+    and with `allowed_timestamps` (in seconds) only those can be used. The
+    sequence can only end once its chapters are kept by `filter_chapters`.
+
+    Only the generated tokens are parsed: `states[n]` holds the state of each
+    row after `n` generated tokens, counted from the length of `input_ids` at
+    the first call. With speculative decoding, the processor is called on the
+    positions of the proposed tokens and those that are rejected are dropped
+    at the next call. It starts over when `input_ids` is not longer than at
+    the first call (new generation), so it also works on the generated ids
+    alone.
+    """
+
+    def __init__(self, grammar, vid_duration=None, allowed_timestamps=None):
+        self.grammar = grammar
+        before = hms_to_sec(vid_duration) if vid_duration else hms_to_sec(MAX_TIME) + 1
+        self.timestamps = Timestamps(before, allowed_timestamps)
+        self.states = None
+        self.start = None
+
+    def __call__(self, input_ids, scores):
+        length = input_ids.shape[1]
+        if self.states is None or length <= self.start:
+            self.start = length
+            self.states = [[LineState() for _ in range(input_ids.shape[0])]]
+        n = length - self.start
+        # The last token may differ from the one previously seen at this position
+        del self.states[max(n, 1) :]
+        while len(self.states) <= n:
+            token_ids = input_ids[:, self.start + len(self.states) - 1].tolist()
+            states = [replace(state) for state in self.states[-1]]
+            for state, token_id in zip(states, token_ids):
+                self.grammar.advance(state, token_id)
+            self.states.append(states)
+        states = self.states[n]
+
+        vocab_size = scores.shape[-1]
+        allowed = torch.stack(
+            [
+                self.grammar.allowed(state, self.timestamps, vocab_size, scores.device)
+                for state in states
+            ]
+        )
+        return scores.masked_fill(~allowed, float("-inf"))
+
+
+@lru_cache(maxsize=4)
+def get_grammar(tokenizer):
+    return ChapterGrammar(tokenizer)
+
+
+def transcript_timestamps(prompt):
+    """Seconds of all the "hh:mm:ss" timestamps that appear in a prompt."""
+    return {
+        int(h) * 3600 + int(m) * 60 + int(s)
+        for h, m, s in TIMESTAMP_PATTERN.findall(prompt)
+    }
+
+
+def chapter_processor(tokenizer, prompt=None, vid_duration=None, use_transcript=False):
+    """
+    Build the `ChapterLogitsProcessor` of a prompt.
+
+    With `use_transcript`, chapters can only start at a timestamp that
+    appears in the prompt (e.g. the start of an ASR segment).
+    """
+    allowed = transcript_timestamps(prompt) if use_transcript else None
+    return ChapterLogitsProcessor(
+        get_grammar(tokenizer), vid_duration=vid_duration, allowed_timestamps=allowed
+    )
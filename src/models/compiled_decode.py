@@ -0,0 +1,168 @@
+"""
+Static key/value cache and compiled decoding steps (`compiled_decode=True`).
+
+With a `DynamicCache`, each step of `generate` runs the model eagerly: for
+the few hundred tokens of the chapters, the Python and kernel dispatch
+overhead of these small forward passes dominates. `CompiledDecoder` keeps,
+for buckets of `prompt + max_new_tokens` lengths:
+
+- a `StaticCache` of the bucket length, preallocated once and reset between
+  requests (in place, so its tensors keep their addresses for CUDA graphs),
+- the forward pass compiled with `torch.compile` for this cache shape
+  ("reduce-overhead", i.e. with CUDA graphs, on GPU).
+
+The prompt is prefilled eagerly in the cache (`prefill`), so `generate` only
+runs the compiled forward pass on one token at a time, and its shapes only
+change with the bucket: there is one graph per bucket, compiled on the first
+request that uses it. The buckets are the powers of two from `min_bucket`
+up to `max_prompt_tokens + max_new_tokens`.
+
+Sampling, logits processors and stopping criteria are those of `generate`,
+so the outputs are the ones of the dynamic path (up to the numerics of the
+compiled kernels). Streaming, batches, assisted generation and the other
+KV caches use the dynamic path. `python -m src.models.compiled_decode`
+compares the tokens/s of the two paths.
+"""
+
+from contextlib import contextmanager
+
+import torch
+from peft import PeftModel
+from transformers import StaticCache
+
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+
+def cache_buckets(max_tokens, min_bucket=1024):
+    """Lengths of the static caches: powers of two, then `max_tokens`."""
+    buckets = []
+    length = min_bucket
+    while length < max_tokens:
+        buckets.append(length)
+        length *= 2
+    buckets.append(max_tokens)
+    return buckets
+
+
+class CompiledDecoder:
+    """Static caches and compiled forward passes of `model`, per bucket."""
+
+    def __init__(self, model, max_tokens, min_bucket=1024, mode=None):
+        self.model = model
+        # The model that `generate` calls, under the LoRA wrappers
+        self.base_model = (
+            model.get_base_model() if isinstance(model, PeftModel) else model
+        )
+        self.buckets = cache_buckets(max_tokens, min_bucket)
+        if mode is None:
+            mode = "reduce-overhead" if model.device.type == "cuda" else "default"
+        # The graphs are cached on the code of the forward pass, shared by
+        # the buckets: keep one graph per bucket
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, 2 * len(self.buckets)
+        )
+        self.forward = torch.compile(self.base_model.forward, mode=mode, dynamic=False)
+        self.caches = {}
+
+    def bucket(self, n_tokens):
+        """Shortest bucket of `n_tokens` (prompt and new tokens), None if too long."""
+        for length in self.buckets:
+            if n_tokens <= length:
+                return length
+        return None
+
+    def cache(self, length):
+        """The (empty) static cache of a bucket, allocated on its first use."""
+        cache = self.caches.get(length)
+        if cache is None:
+            config = self.base_model.config
+            cache = StaticCache(
+                config,
+                batch_size=1,
+                max_cache_len=length,
+                device=self.model.device,
+                dtype=self.base_model.dtype,
+            )
+            self.caches[length] = cache
+            log.info(f"Static KV cache of {length} tokens allocated")
+        else:
+            cache.reset()
+        return cache
+
+    @contextmanager
+    def compiled(self):
+        """Run the forward passes of `generate` with the compiled one."""
+        # `accelerate` hooks (e.g. with `device_map`) also replace `forward`
+        forward = self.base_model.__dict__.get("forward")
+        self.base_model.forward = self.forward
+        try:
+            yield
+        finally:
+            if forward is None:
+                del self.base_model.forward
+            else:
+                self.base_model.forward = forward
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from src.models.llama_inference import LlamaInference
+    from src.models.throughput import ThroughputStats
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compare the tokens/s of the compiled decoding (static cache) with the "
+            "dynamic one, on ASR prompts."
+        )
+    )
+    parser.add_argument("--ckpt_path", default="meta-llama/Meta-Llama-3.1-8B-Instruct")
+    parser.add_argument("--peft_model", default=None)
+    parser.add_argument("--device", default="auto", choices=["auto", "cpu"])
+    parser.add_argument("--subset", default=None, help="ASR prompts of a subset")
+    parser.add_argument("--n_videos", type=int, default=5)
+    parser.add_argument("--max_new_tokens", type=int, default=300)
+    parser.add_argument("--min_bucket", type=int, default=1024)
+    args = parser.parse_args()
+
+    if args.subset:
+        from src.data.utils_asr import ChaptersASR, PromptASR
+
+        chapters = ChaptersASR(subset=args.subset)
+        prompter = PromptASR(chapters=chapters)
+        vid_ids = [vid_id for vid_id in chapters if vid_id in prompter]
+        prompts = [prompter.get_prompt_test(vid_id) for vid_id in vid_ids]
+        prompts = prompts[: args.n_videos]
+    else:
+        prompts = [
+            "Generate chapters for this transcript:\n00:00:00: Hello and welcome\n"
+            f"00:01:{i:02d}: Let us start with step {i}\n"
+            for i in range(args.n_videos)
+        ]
+
+    inference = LlamaInference(
+        args.ckpt_path,
+        peft_model=args.peft_model,
+        use_fast_kernels=True,
+        device=args.device,
+        max_new_tokens=args.max_new_tokens,
+        compiled_decode=True,
+        compile_min_bucket=args.min_bucket,
+    )
+    outputs = {}
+    for mode in ["dynamic", "compiled"]:
+        decoder = inference.decoder if mode == "compiled" else None
+        # The first request of a bucket compiles its graph
+        warmup = ThroughputStats()
+        for prompt in prompts:
+            inference(prompt, decoder=decoder, throughput=warmup)
+        print(f"{mode} warm-up: {warmup}")
+        stats = ThroughputStats()
+        outputs[mode] = [
+            inference(prompt, decoder=decoder, throughput=stats) for prompt in prompts
+        ]
+        print(f"{mode}: {stats}")
+    same = sum(a == b for a, b in zip(outputs["dynamic"], outputs["compiled"]))
+    print(f"{same}/{len(prompts)} outputs identical")
@@ -0,0 +1,288 @@
+"""
+Llama on CPU, with weights quantized to int8 or int4.
+
+Decoding on CPU is bound by the memory bandwidth: each new token reads all
+the weights. `load_cpu_model` loads the model (or its merged export, see
+`src.models.merged_lora`) with the SDPA attention, merges the LoRA into the
+weights and quantizes the linear layers, weight-only:
+
+- "int8": one scale per output channel (`Int8Linear`),
+- "int4": min/max quantization by groups of `group_size` input channels
+  (`Int4Linear`), the `lm_head` and the layers that the int4 kernel does not
+  support stay in int8.
+
+The matmuls use the int8/int4 kernels of PyTorch for CPU
+(`torch._weight_int8pack_mm`, `torch._weight_int4pack_mm_for_cpu`), the
+activations stay in `torch_dtype` (bfloat16 by default). The LoRA has to be
+merged first, so other adapters cannot be loaded on a quantized model.
+
+`set_num_threads` sets the threads of these matmuls from the physical cores
+available to the process (its CPU affinity and cgroup quota), shared by the
+processes of the node. `LlamaInference(device="cpu", quantization="int8")`
+does all of this, and `python -m src.models.cpu_inference` reports the
+tokens/s of each quantization on ASR prompts.
+"""
+
+import math
+import os
+from pathlib import Path
+
+import torch
+from peft import PeftModel
+from torch import nn
+from transformers import AutoModelForCausalLM
+
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+WEIGHT_QUANTIZATIONS = ("int8", "int4")
+INT4_GROUP_SIZES = (32, 64, 128, 256)
+
+
+class Int8Linear(nn.Module):
+    """`nn.Linear` with int8 weights and a scale per output channel."""
+
+    def __init__(self, linear: nn.Linear):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        qweight = (weight / scale[:, None]).round_().clamp_(-128, 127)
+        self.register_buffer("qweight", qweight.to(torch.int8))
+        self.register_buffer("scale", scale.to(linear.weight.dtype))
+        self.bias = linear.bias
+
+    def forward(self, x):
+        out = torch._weight_int8pack_mm(
+            x.reshape(-1, self.in_features), self.qweight, self.scale.to(x.dtype)
+        )
+        out = out.reshape(*x.shape[:-1], self.out_features)
+        return out if self.bias is None else out + self.bias
+
+
+class Int4Linear(nn.Module):
+    """
+    `nn.Linear` with 4-bit weights, min/max quantized by groups of
+    `group_size` input channels, packed for the CPU kernel.
+    """
+
+    def __init__(self, linear: nn.Linear, group_size=128):
+        super().__init__()
+        if not self.supports(linear, group_size):
+            raise ValueError(
+                f"No int4 kernel for a {linear.out_features}x{linear.in_features} "
+                f"weight with groups of {group_size}"
+            )
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.group_size = group_size
+        weight = linear.weight.detach().float()
+        groups = weight.reshape(self.out_features, -1, group_size)
+        low = groups.amin(dim=-1, keepdim=True)
+        scale = (groups.amax(dim=-1, keepdim=True) - low) / 15
+        scale = scale.clamp(min=1e-6)
+        qweight = ((groups - low) / scale).round_().clamp_(0, 15)
+        qweight = qweight.to(torch.int32).reshape(weight.shape)
+        self.register_buffer(
+            "qweight", torch._convert_weight_to_int4pack_for_cpu(qweight, 8)
+        )
+        # The kernel dequantizes `(q - 8) * scale + zero`, per (group, channel)
+        scales_and_zeros = torch.cat([scale, low + 8 * scale], dim=-1)
+        self.register_buffer(
+            "scales_and_zeros",
+            scales_and_zeros.transpose(0, 1).contiguous().to(linear.weight.dtype),
+        )
+        self.bias = linear.bias
+
+    @staticmethod
+    def supports(linear, group_size):
+        return (
+            group_size in INT4_GROUP_SIZES
+            and linear.in_features % group_size == 0
+            and linear.out_features % 16 == 0
+        )
+
+    def forward(self, x):
+        out = torch._weight_int4pack_mm_for_cpu(
+            x.reshape(-1, self.in_features),
+            self.qweight,
+            self.group_size,
+            self.scales_and_zeros.to(x.dtype),
+        )
+        out = out.reshape(*x.shape[:-1], self.out_features)
+        return out if self.bias is None else out + self.bias
+
+
+def quantize_weights(model, quantization="int8", group_size=128):
+    """Replace the `nn.Linear` layers of `model` by int8 or int4 ones."""
+    if quantization not in WEIGHT_QUANTIZATIONS:
+        raise ValueError(
+            f"Unknown CPU quantization {quantization}, choose from "
+            f"{WEIGHT_QUANTIZATIONS}"
+        )
+    linears = [
+        (parent, name, child)
+        for parent in model.modules()
+        for name, child in parent.named_children()
+        if isinstance(child, nn.Linear)
+    ]
+    n_int4 = 0
+    for parent, name, linear in linears:
+        # The logits are more sensitive to the quantization
+        if (
+            quantization == "int4"
+            and name != "lm_head"
+            and Int4Linear.supports(linear, group_size)
+        ):
+            setattr(parent, name, Int4Linear(linear, group_size))
+            n_int4 += 1
+        else:
+            setattr(parent, name, Int8Linear(linear))
+    log.info(f"{len(linears)} linear layers quantized ({n_int4} in int4)")
+    return model
+
+
+def physical_cores():
+    """
+    Physical cores the process can run on: its CPU affinity with the
+    hyper-threads of a core counted once, within the cgroup CPU quota.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = os.sched_getaffinity(0)
+    else:
+        cpus = range(os.cpu_count() or 1)
+    cores = set()
+    for cpu in cpus:
+        topology = Path(f"/sys/devices/system/cpu/cpu{cpu}/topology")
+        try:
+            package = (topology / "physical_package_id").read_text().strip()
+            core = (topology / "core_id").read_text().strip()
+            cores.add((package, core))
+        except OSError:
+            cores.add(cpu)
+    n_cores = len(cores)
+
+    # Containers limit the CPU time rather than the cores
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            n_cores = min(n_cores, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, n_cores)
+
+
+def cpu_threads(num_threads=None, n_workers=None):
+    """
+    Threads of the CPU matmuls: `num_threads`, or by default the physical
+    cores shared by the `n_workers` processes of the node (its local world
+    size if None). Hyper-threads share the vector units of a core, so they
+    only add contention.
+    """
+    if num_threads is not None:
+        return num_threads
+    if n_workers is None:
+        n_workers = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    return max(1, physical_cores() // n_workers)
+
+
+def set_num_threads(num_threads=None, n_workers=None):
+    """Set the threads of PyTorch (see `cpu_threads`), returns their number."""
+    num_threads = cpu_threads(num_threads, n_workers)
+    torch.set_num_threads(num_threads)
+    log.info(f"Running on {num_threads} CPU threads")
+    return num_threads
+
+
+def load_cpu_model(
+    ckpt_path,
+    peft_model=None,
+    quantization=None,
+    group_size=128,
+    num_threads=None,
+    torch_dtype=torch.bfloat16,
+):
+    """
+    Load a Llama on CPU with the SDPA attention, merge the LoRA `peft_model`
+    (if any) into its weights and quantize them (if `quantization` is one of
+    `WEIGHT_QUANTIZATIONS`).
+    """
+    if quantization is not None and quantization not in WEIGHT_QUANTIZATIONS:
+        raise ValueError(
+            f"Unknown CPU quantization {quantization}, choose from "
+            f"{WEIGHT_QUANTIZATIONS}"
+        )
+    set_num_threads(num_threads)
+    model = AutoModelForCausalLM.from_pretrained(
+        ckpt_path,
+        torch_dtype=torch_dtype,
+        attn_implementation="sdpa",
+        low_cpu_mem_usage=True,
+    )
+    if peft_model:
+        model = PeftModel.from_pretrained(model, peft_model).merge_and_unload()
+    if quantization:
+        model = quantize_weights(model, quantization, group_size)
+    model.eval()
+    log.info(
+        f"{ckpt_path} loaded on CPU (LoRA: {peft_model or 'none'}, "
+        f"weights: {quantization or model.dtype})"
+    )
+    return model
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from src.data.utils_asr import ChaptersASR, PromptASR
+    from src.models.llama_inference import LlamaInference
+    from src.models.throughput import ThroughputStats
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmark the tokens/s of the CPU weight quantizations on ASR prompts."
+        )
+    )
+    parser.add_argument("--ckpt_path", default="meta-llama/Meta-Llama-3.1-8B-Instruct")
+    parser.add_argument("--peft_model", default=None)
+    parser.add_argument("--subset", default="sml300_val")
+    parser.add_argument("--n_videos", type=int, default=5)
+    parser.add_argument("--max_new_tokens", type=int, default=256)
+    parser.add_argument(
+        "--quantizations", nargs="+", default=["none", *WEIGHT_QUANTIZATIONS]
+    )
+    parser.add_argument("--group_size", type=int, default=128)
+    parser.add_argument("--num_threads", type=int, nargs="+", default=[None])
+    args = parser.parse_args()
+
+    chapters = ChaptersASR(subset=args.subset)
+    prompter = PromptASR(chapters=chapters)
+    vid_ids = [vid_id for vid_id in chapters if vid_id in prompter]
+    prompts = [prompter.get_prompt_test(vid_id) for vid_id in vid_ids[: args.n_videos]]
+
+    outputs = {}
+    for quantization in args.quantizations:
+        inference = LlamaInference(
+            args.ckpt_path,
+            peft_model=args.peft_model,
+            quantization=None if quantization == "none" else quantization,
+            device="cpu",
+            group_size=args.group_size,
+            max_new_tokens=args.max_new_tokens,
+        )
+        for num_threads in args.num_threads:
+            num_threads = set_num_threads(num_threads)
+            # Warm up the kernels before timing
+            inference(prompts[0], max_new_tokens=8)
+
+            stats = ThroughputStats()
+            name = f"{quantization}, {num_threads} threads"
+            outputs[name] = [inference(prompt, throughput=stats) for prompt in prompts]
+            print(f"{name}: {stats}")
+            reference = next(iter(outputs))
+            if name != reference:
+                same = sum(a == b for a, b in zip(outputs[reference], outputs[name]))
+                print(f"  {same}/{len(prompts)} outputs identical to {reference}")
+        del inference
@@ -0,0 +1,301 @@
+"""
+Fast cold start of `LlamaInference` (`fast_load=True`).
+
+The regular path (`load_model_llamarecipes`, then `AutoTokenizer` and
+`load_peft_model`) takes tens of seconds before the first chapter. Here:
+
+- the model is built on the meta device (no random initialization of the
+  weights) and the safetensors shards, which `safe_open` memory-maps, are
+  assigned in place (`load_weights`),
+- the fast tokenizer is saved once in `tokenizer_cache` and then loaded from
+  there, without resolving the checkpoint on the Hub (`load_tokenizer`),
+- the tokenizer and the adapter are read in other threads while the base
+  weights load, the LoRA is only attached at the end (`load_model_fast`).
+
+The model is loaded on a single device (the first GPU, or the CPU), without
+quantization, so `LlamaInference` only takes this path if the weights fit
+(`fits_device`). `LoadTimer` times each stage, `LlamaInference.load_times`
+keeps them, and `python -m src.models.fast_load` compares the two paths to
+track cold-start regressions.
+"""
+
+import hashlib
+import json
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from pathlib import Path
+
+import torch
+from accelerate import init_empty_weights
+from safetensors import safe_open
+from safetensors.torch import load_file
+from transformers import (
+    AutoConfig,
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    GenerationConfig,
+)
+
+from src.models.memory_policy import available_memory
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+TOKENIZER_CACHE = Path("checkpoints/tokenizers")
+INDEX_FILE = "model.safetensors.index.json"
+
+
+class LoadTimer:
+    """Wall time of each stage of a load (stages can run in other threads)."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.times = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.times[name] = self.times.get(name, 0.0) + elapsed
+
+    def stop(self):
+        self.times["total"] = time.perf_counter() - self.start
+        return self.times
+
+    def __str__(self):
+        return ", ".join(
+            f"{name} {elapsed:.2f}s" for name, elapsed in self.times.items()
+        )
+
+
+def local_checkpoint(ckpt_path):
+    """Local directory of a checkpoint (its config, weights and tokenizer)."""
+    if Path(ckpt_path).exists():
+        return Path(ckpt_path)
+    from huggingface_hub import snapshot_download
+
+    return Path(
+        snapshot_download(
+            str(ckpt_path), allow_patterns=["*.json", "*.safetensors", "tokenizer*"]
+        )
+    )
+
+
+def safetensors_shards(ckpt_dir):
+    index = ckpt_dir / INDEX_FILE
+    if index.exists():
+        with open(index) as f:
+            weight_map = json.load(f)["weight_map"]
+        return [ckpt_dir / name for name in sorted(set(weight_map.values()))]
+    shards = sorted(ckpt_dir.glob("*.safetensors"))
+    if not shards:
+        raise ValueError(f"No safetensors weights in {ckpt_dir}, use fast_load=False")
+    return shards
+
+
+def default_device():
+    return "cuda:0" if torch.cuda.is_available() else "cpu"
+
+
+def resolve_dtype(torch_dtype=None):
+    """Dtype of the model, the default one of PyTorch as in `from_pretrained`."""
+    torch_dtype = torch_dtype or torch.get_default_dtype()
+    if isinstance(torch_dtype, str):
+        torch_dtype = getattr(torch, torch_dtype)
+    return torch_dtype
+
+
+def fits_device(ckpt_path, device=None, torch_dtype=None):
+    """Whether the weights of `ckpt_path` fit in the free memory of `device`."""
+    free = available_memory(device or default_device())
+    if free is None:
+        return True
+    ckpt_dir = local_checkpoint(ckpt_path)
+    n_bytes = sum(shard.stat().st_size for shard in safetensors_shards(ckpt_dir))
+    stored_dtype = resolve_dtype(AutoConfig.from_pretrained(ckpt_dir).torch_dtype)
+    n_bytes *= resolve_dtype(torch_dtype).itemsize / stored_dtype.itemsize
+    return n_bytes < free
+
+
+def load_weights(ckpt_path, device="cpu", torch_dtype=None, attn_implementation=None):
+    """
+    Build the model of `ckpt_path` on the meta device and assign the tensors
+    of its safetensors shards, loaded directly on `device` (in `torch_dtype`,
+    see `resolve_dtype`).
+    """
+    ckpt_dir = local_checkpoint(ckpt_path)
+    torch_dtype = resolve_dtype(torch_dtype)
+    config = AutoConfig.from_pretrained(ckpt_dir)
+    # Only the parameters are on the meta device, the buffers (e.g. the
+    # rotary frequencies) are computed as usual
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(
+            config, torch_dtype=torch_dtype, attn_implementation=attn_implementation
+        )
+
+    unexpected = []
+    for shard in safetensors_shards(ckpt_dir):
+        with safe_open(shard, framework="pt", device=str(device)) as f:
+            state_dict = {}
+            for name in f.keys():  # noqa: SIM118
+                tensor = f.get_tensor(name)
+                if tensor.is_floating_point():
+                    tensor = tensor.to(torch_dtype)
+                state_dict[name] = tensor
+        result = model.load_state_dict(state_dict, strict=False, assign=True)
+        unexpected.extend(result.unexpected_keys)
+    model.tie_weights()
+
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing or unexpected:
+        raise ValueError(
+            f"Weights of {ckpt_path} do not match the model: missing {missing[:5]}, "
+            f"unexpected {unexpected[:5]}"
+        )
+    model.to(device)
+    with suppress(OSError):
+        model.generation_config = GenerationConfig.from_pretrained(ckpt_dir)
+    model.eval()
+    return model
+
+
+def tokenizer_cache_path(ckpt_path, cache_dir=TOKENIZER_CACHE):
+    """Cache directory of the tokenizer of `ckpt_path`."""
+    key = str(ckpt_path)
+    source = Path(ckpt_path) / "tokenizer.json"
+    if source.exists():
+        # A local checkpoint can change in place
+        key += f":{source.stat().st_mtime_ns}"
+    name = Path(str(ckpt_path).rstrip("/")).name
+    return Path(cache_dir) / f"{name}-{hashlib.sha256(key.encode()).hexdigest()[:16]}"
+
+
+def load_tokenizer(ckpt_path, cache_dir=TOKENIZER_CACHE):
+    """
+    Tokenizer of `ckpt_path`, from its serialized fast tokenizer in
+    `cache_dir`, which is saved there on the first load.
+    """
+    cache_path = tokenizer_cache_path(ckpt_path, cache_dir)
+    if cache_path.exists():
+        tokenizer = AutoTokenizer.from_pretrained(cache_path)
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(ckpt_path)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tokenizer.save_pretrained(tmp_path)
+        shutil.rmtree(cache_path, ignore_errors=True)
+        tmp_path.rename(cache_path)
+        log.info(f"Tokenizer of {ckpt_path} cached in {cache_path}")
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+def read_adapter(peft_model):
+    """Config and weights (on CPU) of the LoRA at `peft_model`."""
+    from peft import PeftConfig
+
+    config = PeftConfig.from_pretrained(peft_model)
+    path = Path(peft_model) / "adapter_model.safetensors"
+    if path.exists():
+        weights = load_file(path)
+    else:
+        weights = torch.load(
+            Path(peft_model) / "adapter_model.bin",
+            map_location="cpu",
+            weights_only=True,
+        )
+    return config, weights
+
+
+def attach_adapter(model, adapter):
+    """Wrap `model` with the LoRA read by `read_adapter`, as `load_peft_model`."""
+    from peft import PeftModel
+    from peft.utils import set_peft_model_state_dict
+
+    config, weights = adapter
+    config.inference_mode = True
+    # The LoRA weights are created on the meta device and assigned
+    model = PeftModel(model, config, low_cpu_mem_usage=True)
+    set_peft_model_state_dict(model, weights, low_cpu_mem_usage=True)
+    model.eval()
+    return model
+
+
+def load_model_fast(
+    ckpt_path,
+    tokenizer_path=None,
+    peft_model=None,
+    device=None,
+    torch_dtype=None,
+    attn_implementation=None,
+    tokenizer_cache=TOKENIZER_CACHE,
+    timer=None,
+):
+    """
+    Load the model of `ckpt_path` with its LoRA `peft_model` (if any), and the
+    tokenizer of `tokenizer_path` (`ckpt_path` if None). The device is the
+    first GPU if there is one, else the CPU. Returns `(model, tokenizer)`.
+    """
+    timer = timer or LoadTimer()
+    device = device or default_device()
+
+    def timed(name, fn, *args):
+        with timer.stage(name):
+            return fn(*args)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        tokenizer = pool.submit(
+            timed,
+            "tokenizer",
+            load_tokenizer,
+            tokenizer_path or ckpt_path,
+            tokenizer_cache,
+        )
+        adapter = None
+        if peft_model:
+            adapter = pool.submit(timed, "adapter", read_adapter, peft_model)
+        with timer.stage("weights"):
+            model = load_weights(ckpt_path, device, torch_dtype, attn_implementation)
+        if adapter is not None:
+            with timer.stage("attach_adapter"):
+                model = attach_adapter(model, adapter.result())
+        tokenizer = tokenizer.result()
+    return model, tokenizer
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from src.models.llama_inference import LlamaInference
+
+    parser = argparse.ArgumentParser(
+        description="Time the stages of the regular and of the fast model loads."
+    )
+    parser.add_argument("--ckpt_path", default="meta-llama/Meta-Llama-3.1-8B-Instruct")
+    parser.add_argument("--peft_model", default=None)
+    parser.add_argument("--modes", nargs="+", default=["regular", "fast"])
+    parser.add_argument("--output", default=None, help="JSON file to append to")
+    args = parser.parse_args()
+
+    results = {}
+    for mode in args.modes:
+        inference = LlamaInference(
+            args.ckpt_path, peft_model=args.peft_model, fast_load=mode == "fast"
+        )
+        results[mode] = inference.load_times
+        stages = ", ".join(f"{k} {v:.2f}s" for k, v in inference.load_times.items())
+        print(f"{mode}: {stages}")
+        del inference
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    if args.output:
+        record = {"ckpt_path": args.ckpt_path, "peft_model": args.peft_model}
+        record.update(time=time.strftime("%Y-%m-%d %H:%M:%S"), **results)
+        with open(args.output, "a") as f:
+            f.write(json.dumps(record) + "\n")
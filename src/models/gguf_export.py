@@ -0,0 +1,166 @@
+"""
+GGUF copies of the base model and of the chapter LoRAs, for llama.cpp.
+
+The llama.cpp engine (`src.models.llama_cpp_inference`) runs a quantized GGUF
+of the base model with the LoRA applied on top, so one base file serves all
+the adapters. `export_base` and `export_lora` (`python -m tools.export.gguf`)
+run the conversion scripts of a llama.cpp checkout (`convert_hf_to_gguf.py`,
+`convert_lora_to_gguf.py` and the `llama-quantize` binary), found at
+`llama_cpp_dir` or `$LLAMA_CPP_DIR`. The files are written in `gguf_dir`:
+
+- `<base model>.<quantization>.gguf` for the base model,
+- `lora-<key>.gguf` for an adapter, where the key hashes the content of the
+  adapter files as for the merged exports (`src.models.merged_lora`).
+
+A file is written under a temporary name and renamed once complete, so an
+interrupted export is never found.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+from src.models.merged_lora import adapter_sha256
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+GGUF_DIR = Path("checkpoints/gguf")
+# Types of `llama-quantize`, F16 is the unquantized conversion
+GGUF_QUANTIZATIONS = ("F16", "Q8_0", "Q6_K", "Q5_K_M", "Q4_K_M", "Q4_0")
+
+
+def base_gguf_path(ckpt_path, gguf_dir=GGUF_DIR, quantization="Q4_K_M"):
+    return (
+        Path(gguf_dir) / f"{Path(str(ckpt_path).rstrip('/')).name}.{quantization}.gguf"
+    )
+
+
+def lora_gguf_path(peft_model, gguf_dir=GGUF_DIR):
+    return Path(gguf_dir) / f"lora-{adapter_sha256(peft_model)[:16]}.gguf"
+
+
+def find_llama_cpp(llama_cpp_dir=None):
+    """Checkout of llama.cpp with the conversion scripts."""
+    llama_cpp_dir = llama_cpp_dir or os.environ.get("LLAMA_CPP_DIR")
+    if (
+        not llama_cpp_dir
+        or not (Path(llama_cpp_dir) / "convert_hf_to_gguf.py").exists()
+    ):
+        raise ValueError(
+            "llama.cpp checkout not found, set --llama_cpp_dir or $LLAMA_CPP_DIR "
+            f"(got {llama_cpp_dir})"
+        )
+    return Path(llama_cpp_dir)
+
+
+def find_quantize(llama_cpp_dir):
+    for path in [
+        llama_cpp_dir / "build" / "bin" / "llama-quantize",
+        llama_cpp_dir / "llama-quantize",
+    ]:
+        if path.exists():
+            return str(path)
+    path = shutil.which("llama-quantize")
+    if path is None:
+        raise ValueError(
+            f"llama-quantize not found, build llama.cpp in {llama_cpp_dir}"
+        )
+    return path
+
+
+def local_checkpoint(ckpt_path, allow_patterns=None):
+    """Local directory of a checkpoint, downloaded from the Hub if needed."""
+    if Path(ckpt_path).exists():
+        return str(ckpt_path)
+    from huggingface_hub import snapshot_download
+
+    return snapshot_download(ckpt_path, allow_patterns=allow_patterns)
+
+
+def run(command):
+    log.info(" ".join(command))
+    subprocess.run(command, check=True)
+
+
+def export_base(
+    ckpt_path,
+    gguf_dir=GGUF_DIR,
+    quantization="Q4_K_M",
+    llama_cpp_dir=None,
+    overwrite=False,
+):
+    """
+    Convert the base model `ckpt_path` to GGUF (F16) and quantize it to
+    `quantization`. Returns the path of the file, which is reused if it
+    already exists (unless `overwrite`).
+    """
+    if quantization not in GGUF_QUANTIZATIONS:
+        raise ValueError(
+            f"Unknown GGUF quantization {quantization}, choose from "
+            f"{GGUF_QUANTIZATIONS}"
+        )
+    output_path = base_gguf_path(ckpt_path, gguf_dir, quantization)
+    if output_path.exists() and not overwrite:
+        log.info(f"{ckpt_path} is already exported to {output_path}")
+        return output_path
+    llama_cpp_dir = find_llama_cpp(llama_cpp_dir)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    f16_path = base_gguf_path(ckpt_path, gguf_dir, "F16")
+    if not f16_path.exists() or overwrite:
+        tmp_path = f16_path.with_name(f"{f16_path.name}.tmp")
+        run(
+            [
+                sys.executable,
+                str(llama_cpp_dir / "convert_hf_to_gguf.py"),
+                local_checkpoint(ckpt_path),
+                "--outfile",
+                str(tmp_path),
+                "--outtype",
+                "f16",
+            ]
+        )
+        tmp_path.rename(f16_path)
+    if quantization != "F16":
+        tmp_path = output_path.with_name(f"{output_path.name}.tmp")
+        run([find_quantize(llama_cpp_dir), str(f16_path), str(tmp_path), quantization])
+        tmp_path.rename(output_path)
+    log.info(f"{ckpt_path} exported to {output_path}")
+    return output_path
+
+
+def export_lora(
+    peft_model, ckpt_path, gguf_dir=GGUF_DIR, llama_cpp_dir=None, overwrite=False
+):
+    """
+    Convert the LoRA `peft_model` of the base model `ckpt_path` to GGUF
+    (F16, it is small). Returns the path of the file, reused if it exists.
+    """
+    output_path = lora_gguf_path(peft_model, gguf_dir)
+    if output_path.exists() and not overwrite:
+        log.info(f"{peft_model} is already exported to {output_path}")
+        return output_path
+    llama_cpp_dir = find_llama_cpp(llama_cpp_dir)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = output_path.with_name(f"{output_path.name}.tmp")
+    run(
+        [
+            sys.executable,
+            str(llama_cpp_dir / "convert_lora_to_gguf.py"),
+            str(peft_model),
+            # Only the config of the base model is needed
+            "--base",
+            local_checkpoint(ckpt_path, allow_patterns=["*.json"]),
+            "--outfile",
+            str(tmp_path),
+            "--outtype",
+            "f16",
+        ]
+    )
+    tmp_path.rename(output_path)
+    log.info(f"{peft_model} exported to {output_path}")
+    return output_path
@@ -0,0 +1,236 @@
+"""
+Key/value cache backends of the generation, selectable per request.
+
+With 35k-token prompts, the key/value cache of Llama-3.1-8B takes several GB.
+The `kv_cache` option of `LlamaInference` trades some speed (and, when
+quantized, some accuracy) for memory:
+
+- "fp16": the default cache, in the dtype of the model,
+- "int8" / "int4": the cache is quantized per token, by groups of
+  `q_group_size` channels, except for the last `residual_length` tokens
+  (`TorchQuantizedCache`, plain PyTorch so it also runs on CPU),
+- "offloaded": the cache of every layer lives on CPU and is moved to the GPU
+  (ahead of time) only for its forward pass (needs a GPU).
+
+Quantized caches cannot be cropped, so they do not work with speculative
+decoding (draft model or prompt lookup).
+"""
+
+import math
+
+import torch
+from transformers import DynamicCache, OffloadedCache
+from transformers.cache_utils import QuantizedCache, QuantizedCacheConfig
+
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+KV_CACHES = ("fp16", "int8", "int4", "offloaded")
+QUANTIZED_BITS = {"int8": 8, "int4": 4}
+
+
+class TorchQuantizedCache(QuantizedCache):
+    """
+    `QuantizedCache` with a min/max (asymmetric) quantization in PyTorch.
+
+    Each token is quantized on its own, by groups of `q_group_size` channels
+    of a head (whatever `axis_key` and `axis_value`), with float16 scales and
+    offsets, and 4-bit values packed by two in a byte. Once there are
+    `residual_length` tokens in full precision, they are quantized and
+    appended to the quantized ones (along the tokens), so that unlike in
+    `QuantizedCache`, no token is quantized twice.
+    """
+
+    def __init__(self, cache_config: QuantizedCacheConfig):
+        super().__init__(cache_config)
+        if self.nbits not in (4, 8):
+            raise ValueError(f"nbits has to be 4 or 8, got {self.nbits}")
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[-2]
+        if len(self.key_cache) <= layer_idx:
+            self._quantized_key_cache.append(None)
+            self._quantized_value_cache.append(None)
+            self.key_cache.append(key_states)
+            self.value_cache.append(value_states)
+        else:
+            self.key_cache[layer_idx] = torch.cat(
+                [self.key_cache[layer_idx], key_states], dim=-2
+            )
+            self.value_cache[layer_idx] = torch.cat(
+                [self.value_cache[layer_idx], value_states], dim=-2
+            )
+
+        keys = self._full(
+            self._quantized_key_cache[layer_idx], self.key_cache[layer_idx]
+        )
+        values = self._full(
+            self._quantized_value_cache[layer_idx], self.value_cache[layer_idx]
+        )
+        if self.key_cache[layer_idx].shape[-2] >= self.residual_length:
+            self._quantized_key_cache[layer_idx] = self._append(
+                self._quantized_key_cache[layer_idx],
+                self._quantize(self.key_cache[layer_idx], self.axis_key),
+            )
+            self._quantized_value_cache[layer_idx] = self._append(
+                self._quantized_value_cache[layer_idx],
+                self._quantize(self.value_cache[layer_idx], self.axis_value),
+            )
+            self.key_cache[layer_idx] = self.key_cache[layer_idx][..., :0, :]
+            self.value_cache[layer_idx] = self.value_cache[layer_idx][..., :0, :]
+        return keys, values
+
+    def _full(self, q_tensor, residual):
+        """Dequantized tokens followed by the residual ones."""
+        if q_tensor is None:
+            return residual
+        tensor = self._dequantize(q_tensor).to(residual.dtype)
+        return torch.cat([tensor, residual], dim=-2)
+
+    @staticmethod
+    def _append(q_tensor, new_q_tensor):
+        if q_tensor is None:
+            return new_q_tensor
+        return tuple(torch.cat(pair, dim=2) for pair in zip(q_tensor, new_q_tensor))
+
+    def _quantize(self, tensor, axis):
+        # (batch, heads, tokens, groups, channels of a group)
+        *shape, head_dim = tensor.shape
+        group_size = math.gcd(self.q_group_size, head_dim)
+        groups = tensor.float().reshape(*shape, head_dim // group_size, group_size)
+        low = groups.amin(dim=-1, keepdim=True)
+        scale = (groups.amax(dim=-1, keepdim=True) - low) / (2**self.nbits - 1)
+        scale = scale.clamp(min=1e-6)
+        q_tensor = ((groups - low) / scale).round_().to(torch.uint8)
+        if self.nbits == 4:
+            q_tensor = q_tensor[..., ::2] | (q_tensor[..., 1::2] << 4)
+        return q_tensor, scale.half(), low.half()
+
+    def _dequantize(self, q_tensor):
+        q_tensor, scale, low = q_tensor
+        if self.nbits == 4:
+            q_tensor = torch.stack([q_tensor & 0xF, q_tensor >> 4], dim=-1)
+            q_tensor = q_tensor.flatten(-2)
+        tensor = q_tensor.to(scale.dtype) * scale + low
+        return tensor.flatten(-2)
+
+
+def make_kv_cache(kv_cache="fp16", residual_length=128, q_group_size=64):
+    """New (empty) cache of a `generate` call, for a name of `KV_CACHES`."""
+    if kv_cache not in KV_CACHES:
+        raise ValueError(f"Unknown KV cache {kv_cache}, choose from {KV_CACHES}")
+    if kv_cache == "offloaded":
+        if torch.cuda.is_available():
+            return OffloadedCache()
+        log.warning("The offloaded KV cache needs a GPU, using the fp16 one")
+    if kv_cache in QUANTIZED_BITS:
+        cache_config = QuantizedCacheConfig(
+            nbits=QUANTIZED_BITS[kv_cache],
+            q_group_size=q_group_size,
+            residual_length=residual_length,
+        )
+        return TorchQuantizedCache(cache_config)
+    return DynamicCache()
+
+
+def kv_cache_scale(kv_cache, config, dtype_bytes=2, q_group_size=64):
+    """Device memory of a `kv_cache`, relative to the one of the fp16 cache."""
+    if kv_cache in QUANTIZED_BITS:
+        # Values, plus a float16 scale and offset per group
+        value_bytes = QUANTIZED_BITS[kv_cache] / 8 + 4 / q_group_size
+        return value_bytes / dtype_bytes
+    if kv_cache == "offloaded" and torch.cuda.is_available():
+        # The layer of the forward pass and the one being prefetched
+        return min(1.0, 2 / config.num_hidden_layers)
+    return 1.0
+
+
+def cache_nbytes(cache, device=None):
+    """Bytes held by the tensors of a cache (only those on `device` if set)."""
+    tensors = []
+    for name in [
+        "key_cache",
+        "value_cache",
+        "_quantized_key_cache",
+        "_quantized_value_cache",
+    ]:
+        for item in getattr(cache, name, []):
+            tensors.extend(item if isinstance(item, tuple) else [item])
+    return sum(
+        t.nbytes
+        for t in tensors
+        if isinstance(t, torch.Tensor)
+        and (device is None or t.device == torch.device(device))
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from src.data.utils_asr import ChaptersASR, PromptASR
+    from src.models.llama_inference import LlamaInference
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmark the memory and latency of the KV cache backends on long ASR "
+            "prompts."
+        )
+    )
+    parser.add_argument("--ckpt_path", default="meta-llama/Meta-Llama-3.1-8B-Instruct")
+    parser.add_argument("--peft_model", default=None)
+    parser.add_argument("--subset", default="sml300_val")
+    parser.add_argument("--n_videos", type=int, default=10)
+    parser.add_argument("--min_prompt_tokens", type=int, default=10_000)
+    parser.add_argument("--max_new_tokens", type=int, default=1024)
+    parser.add_argument("--kv_caches", nargs="+", default=list(KV_CACHES))
+    args = parser.parse_args()
+
+    inference = LlamaInference(
+        args.ckpt_path, peft_model=args.peft_model, max_new_tokens=args.max_new_tokens
+    )
+    tokenizer = inference.tokenizer
+    device = inference.model.device
+
+    # The longest prompts, where the cache matters
+    chapters = ChaptersASR(subset=args.subset)
+    prompter = PromptASR(chapters=chapters)
+    prompts = [prompter.get_prompt_test(vid_id) for vid_id in chapters]
+    encoded = tokenizer(prompts, add_special_tokens=False)["input_ids"]
+    prompt_ids = [ids for ids in encoded if len(ids) >= args.min_prompt_tokens]
+    prompt_ids = sorted(prompt_ids, key=len, reverse=True)[: args.n_videos]
+    n_prompt = sum(len(ids) for ids in prompt_ids)
+    print(f"{len(prompt_ids)} prompts, {n_prompt / len(prompt_ids):.0f} tokens on avg")
+
+    # Warm up the kernels before timing
+    inference(prompt_ids[0][:512], max_new_tokens=8)
+
+    outputs = {}
+    for kv_cache in args.kv_caches:
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        n_bytes, n_tokens, elapsed, outputs[kv_cache] = 0, 0, 0.0, []
+        for ids in prompt_ids:
+            cache = make_kv_cache(kv_cache)
+            start = time.perf_counter()
+            output = inference(ids, past_key_values=cache)
+            elapsed += time.perf_counter() - start
+            outputs[kv_cache].append(output)
+            if isinstance(output, str):
+                n_tokens += len(
+                    tokenizer(output, add_special_tokens=False)["input_ids"]
+                )
+            n_bytes = max(n_bytes, cache_nbytes(cache, device))
+        print(f"{kv_cache}: {elapsed:.1f}s, {n_tokens / elapsed:.1f} tokens/s")
+        print(f"  largest cache on {device}: {n_bytes / 2**30:.2f} GiB")
+        if torch.cuda.is_available():
+            peak = torch.cuda.max_memory_allocated() / 2**30
+            print(f"  peak memory: {peak:.2f} GiB")
+        if kv_cache != args.kv_caches[0]:
+            reference = outputs[args.kv_caches[0]]
+            same = sum(a == b for a, b in zip(reference, outputs[kv_cache]))
+            print(
+                f"  {same}/{len(prompt_ids)} outputs identical to {args.kv_caches[0]}"
+            )
@@ -0,0 +1,302 @@
+"""
+llama.cpp engine with the interface of `LlamaInference`.
+
+For edge and CPU deployments, `LlamaCppInference` runs the GGUF exports of
+`src.models.gguf_export` (a quantized base model and the chapter LoRA applied
+on top) through the `llama_cpp` binding (`pip install llama-cpp-python`). It
+is selected with `model.engine=llama_cpp` in the configs.
+
+The prompts are tokenized by the Hugging Face tokenizer with `encode_prompt`,
+and llama.cpp is given the token ids, so the chat template is the one of
+`inference` token for token. The output is decoded the same way too
+(`parse_output`), and greedy decoding picks the most likely token at each
+step, as `generate` does. The logits processors of `generate` (e.g. the
+constrained decoding of `src.models.chapter_grammar`) are applied to the
+logits of llama.cpp. A single LoRA is applied, so requests cannot select
+another adapter, and the options of the torch engine (KV cache, speculative
+decoding, chunked prefill...) are ignored.
+
+`python -m src.models.llama_cpp_inference` compares the parsed chapters with
+the ones of the torch engine (e.g. on a tiny model).
+"""
+
+import itertools
+
+import numpy as np
+import torch
+from transformers import AutoTokenizer
+
+from src.models.cpu_inference import cpu_threads
+from src.models.gguf_export import GGUF_DIR, base_gguf_path, lora_gguf_path
+from src.models.llama_inference import (
+    decode_stream,
+    encode_prompt,
+    get_terminators,
+    parse_output,
+)
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+
+def llama_cpp_processor(logits_processor):
+    """Logits processor of `generate` (on torch tensors) for llama.cpp."""
+
+    def process(input_ids, scores):
+        input_ids = torch.from_numpy(np.asarray(input_ids, dtype=np.int64))
+        scores = torch.from_numpy(np.asarray(scores, dtype=np.float32))
+        scores = logits_processor(input_ids[None], scores[None].clone())
+        return scores[0].numpy()
+
+    return process
+
+
+class LlamaCppInference:
+    def __init__(
+        self,
+        ckpt_path,
+        peft_model=None,
+        gguf_dir: str = GGUF_DIR,
+        gguf_quantization: str = "Q4_K_M",
+        add_special_tokens: bool = True,
+        temperature: float = 1.0,
+        max_new_tokens: int = 1024,
+        top_p: float = 1.0,
+        top_k: int = 50,
+        max_padding_length: int = None,
+        do_sample: bool = False,
+        repetition_penalty: float = 1.0,
+        max_prompt_tokens: int = 35_000,
+        device: str = "auto",
+        num_threads: int = None,
+        seed: int = 0,
+        **kwargs,
+    ):
+        """
+        Load the GGUF exports of `ckpt_path` and `peft_model` from `gguf_dir`.
+        On "cpu" all the layers run on CPU, with "auto" they are offloaded to
+        the GPU if llama.cpp is built with GPU support. Other kwargs (options
+        of `LlamaInference`) are ignored.
+        """
+        from llama_cpp import Llama
+
+        model_path = base_gguf_path(ckpt_path, gguf_dir, gguf_quantization)
+        if not model_path.exists():
+            raise ValueError(
+                f"No GGUF export of {ckpt_path} at {model_path}, run "
+                f"python -m tools.export.gguf --ckpt_path {ckpt_path} "
+                f"--quantization {gguf_quantization}"
+            )
+        lora_path = None
+        if peft_model:
+            lora_path = lora_gguf_path(peft_model, gguf_dir)
+            if not lora_path.exists():
+                raise ValueError(
+                    f"No GGUF export of {peft_model} at {lora_path}, run "
+                    f"python -m tools.export.gguf {peft_model}"
+                )
+        if device not in ("auto", "cpu"):
+            raise ValueError(f"Unknown device {device}, choose from auto or cpu")
+
+        num_threads = cpu_threads(num_threads)
+        n_ctx = max_prompt_tokens + max_new_tokens if max_prompt_tokens else 0
+        self.model = Llama(
+            model_path=str(model_path),
+            lora_path=None if lora_path is None else str(lora_path),
+            # 0 is the context length of the model
+            n_ctx=n_ctx,
+            n_threads=num_threads,
+            n_threads_batch=num_threads,
+            n_gpu_layers=0 if device == "cpu" else -1,
+            seed=seed,
+            verbose=False,
+        )
+        log.info(
+            f"{model_path} loaded with llama.cpp (LoRA: {lora_path or 'none'}, "
+            f"{num_threads} threads)"
+        )
+
+        tokenizer = AutoTokenizer.from_pretrained(ckpt_path)
+        tokenizer.pad_token = tokenizer.eos_token
+
+        self.tokenizer = tokenizer
+        self.add_special_tokens = add_special_tokens
+        self.temperature = temperature
+        self.max_new_tokens = max_new_tokens
+        self.top_p = top_p
+        self.top_k = top_k
+        self.max_padding_length = max_padding_length
+        self.do_sample = do_sample
+        self.repetition_penalty = repetition_penalty
+        self.max_prompt_tokens = max_prompt_tokens
+
+    def __call__(self, prompt, **kwargs):
+        """
+        Generate for a prompt (text or token ids), as `LlamaInference`: returns
+        the output text, or the number of prompt tokens if it is too long.
+        """
+        params = self.get_params(**kwargs)
+        input_ids = self.encode(prompt, **params)
+        if isinstance(input_ids, int):
+            return input_ids
+        generated = list(self.generate_ids(input_ids, **params))
+        output_text = self.tokenizer.decode(
+            input_ids + generated, skip_special_tokens=False
+        )
+        return parse_output(output_text)
+
+    def stream(self, prompt, **kwargs):
+        """Yield the output text chunk by chunk, as `LlamaInference.stream`."""
+        params = self.get_params(**kwargs)
+        input_ids = self.encode(prompt, **params)
+        if isinstance(input_ids, int):
+            yield input_ids
+            return
+        terminators = get_terminators(self.tokenizer)
+        yield from decode_stream(
+            self.tokenizer, self.generate_ids(input_ids, **params), terminators
+        )
+
+    def generate_batch(self, prompts: list, logits_processors=None, **kwargs):
+        """One output per prompt, as `LlamaInference.generate_batch` (in turn)."""
+        logits_processors = logits_processors or [None] * len(prompts)
+        return [
+            self(prompt, logits_processor=processor, **kwargs)
+            for prompt, processor in zip(prompts, logits_processors)
+        ]
+
+    def encode(
+        self,
+        prompt,
+        add_special_tokens=True,
+        max_padding_length=None,
+        max_prompt_tokens=None,
+        **kwargs,
+    ):
+        """Token ids of a prompt, or their number if it is too long."""
+        input_ids = encode_prompt(
+            self.tokenizer, prompt, add_special_tokens, max_padding_length
+        )
+        n_tokens = len(input_ids)
+        if max_prompt_tokens is not None and n_tokens > max_prompt_tokens:
+            return n_tokens
+        return input_ids
+
+    def generate_ids(
+        self,
+        input_ids,
+        max_new_tokens=1024,
+        do_sample=False,
+        temperature=1.0,
+        top_p=1.0,
+        top_k=50,
+        repetition_penalty=1.0,
+        logits_processor=None,
+        adapter=None,
+        **kwargs,
+    ):
+        """Yield the new token ids, up to a terminator (included)."""
+        if adapter is not None:
+            raise ValueError("The llama.cpp engine has a single LoRA adapter")
+        processors = None
+        if logits_processor:
+            processors = [llama_cpp_processor(logits_processor)]
+
+        terminators = get_terminators(self.tokenizer)
+        tokens = self.model.generate(
+            input_ids,
+            # A temperature of 0 is greedy decoding
+            temp=temperature if do_sample else 0.0,
+            top_p=top_p,
+            top_k=top_k,
+            # No min-p filtering, which `generate` does not do
+            min_p=0.0,
+            repeat_penalty=repetition_penalty,
+            reset=True,
+            logits_processor=processors,
+        )
+        try:
+            for token_id in itertools.islice(tokens, max_new_tokens):
+                yield token_id
+                if token_id in terminators:
+                    break
+        finally:
+            tokens.close()
+
+    def get_params(self, **kwargs):
+        # Create a dict of default parameters from instance attributes
+        params = {
+            "add_special_tokens": self.add_special_tokens,
+            "temperature": self.temperature,
+            "max_new_tokens": self.max_new_tokens,
+            "top_p": self.top_p,
+            "top_k": self.top_k,
+            "max_padding_length": self.max_padding_length,
+            "do_sample": self.do_sample,
+            "repetition_penalty": self.repetition_penalty,
+            "max_prompt_tokens": self.max_prompt_tokens,
+        }
+        # Update with any overrides passed in kwargs
+        params.update(kwargs)
+        return params
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from src.models.llama_inference import LlamaInference
+    from src.test.utils_chapters import extract_chapters
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compare the chapters of the llama.cpp engine with the ones of the torch "
+            "engine, e.g. on a tiny model and its LoRA."
+        )
+    )
+    parser.add_argument("--ckpt_path", default="meta-llama/Meta-Llama-3.1-8B-Instruct")
+    parser.add_argument("--peft_model", default=None)
+    parser.add_argument("--gguf_dir", default=str(GGUF_DIR))
+    parser.add_argument("--gguf_quantization", default="F16")
+    parser.add_argument("--subset", default=None, help="ASR prompts of a subset")
+    parser.add_argument("--n_videos", type=int, default=5)
+    parser.add_argument("--max_new_tokens", type=int, default=256)
+    args = parser.parse_args()
+
+    if args.subset:
+        from src.data.utils_asr import ChaptersASR, PromptASR
+
+        chapters = ChaptersASR(subset=args.subset)
+        prompter = PromptASR(chapters=chapters)
+        vid_ids = [vid_id for vid_id in chapters if vid_id in prompter]
+        prompts = [prompter.get_prompt_test(vid_id) for vid_id in vid_ids]
+        prompts = prompts[: args.n_videos]
+    else:
+        prompts = [
+            "Generate chapters for this transcript:\n00:00:00: Hello and welcome\n"
+            "00:01:30: Let us start with the ingredients\n",
+        ]
+
+    torch_engine = LlamaInference(
+        args.ckpt_path,
+        peft_model=args.peft_model,
+        max_new_tokens=args.max_new_tokens,
+        device="cpu",
+        torch_dtype=torch.float32,
+    )
+    llama_cpp_engine = LlamaCppInference(
+        args.ckpt_path,
+        peft_model=args.peft_model,
+        gguf_dir=args.gguf_dir,
+        gguf_quantization=args.gguf_quantization,
+        max_new_tokens=args.max_new_tokens,
+        device="cpu",
+    )
+
+    n_outputs, n_chapters = 0, 0
+    for prompt in prompts:
+        reference = torch_engine(prompt)
+        output = llama_cpp_engine(prompt)
+        n_outputs += output == reference
+        n_chapters += extract_chapters(output) == extract_chapters(reference)
+    print(f"Outputs: {n_outputs}/{len(prompts)} identical")
+    print(f"Chapters: {n_chapters}/{len(prompts)} identical")
@@ -1,10 +1,42 @@
+import itertools
+import queue
+import threading
+from contextlib import nullcontext
+from functools import lru_cache
 from pathlib import Path
 
 import torch
 from llama_cookbook.inference.model_utils import load_model as load_model_llamarecipes
 from llama_cookbook.inference.model_utils import load_peft_model
-from transformers import AutoTokenizer
+from transformers import (
+    AutoTokenizer,
+    DynamicCache,
+    LogitsProcessor,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
+from transformers.generation.streamers import BaseStreamer
 
+from src.models.compiled_decode import CompiledDecoder
+from src.models.cpu_inference import load_cpu_model
+from src.models.fast_load import (
+    TOKENIZER_CACHE,
+    LoadTimer,
+    fits_device,
+    load_model_fast,
+)
+from src.models.kv_cache import KV_CACHES, QUANTIZED_BITS, make_kv_cache
+from src.models.memory_policy import MemoryPolicy
+from src.models.merged_lora import MERGED_DIR, find_merged
+from src.models.multi_lora import (
+    adapter_names,
+    load_adapter,
+    loaded_adapters,
+    unload_adapter,
+)
+from src.models.speculative import SpeculativeStats, load_draft_model
+from src.models.throughput import ThroughputStats
 from src.utils import RankedLogger
 
 log = RankedLogger(__name__, rank_zero_only=True)
@@ -31,6 +63,66 @@ def load_model(
     return model, tokenizer
 
 
+def format_prompt(prompt: str, add_special_tokens: bool = True) -> str:
+    if add_special_tokens:
+        prompt = f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\nCutting Knowledge Date: December 2023\nToday Date: 26 Jul 2024\n\n<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
+        # prompt = f"<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
+    return prompt
+
+
+@lru_cache(maxsize=4)
+def chat_template_ids(tokenizer):
+    """
+    Token ids that `format_prompt` adds before and after a prompt, and the
+    special tokens the tokenizer adds to any text (without the template).
+    """
+    marker = "\x00"
+    header, footer = format_prompt(marker).split(marker)
+    header_ids = tokenizer(header)["input_ids"]
+    footer_ids = tokenizer(footer, add_special_tokens=False)["input_ids"]
+    return header_ids, footer_ids, tokenizer("")["input_ids"]
+
+
+def encode_prompt(tokenizer, prompt, add_special_tokens=True, max_length=None):
+    """
+    Token ids of a prompt, as `tokenizer(format_prompt(prompt))`.
+
+    `prompt` can also be token ids already (of the text alone, without
+    special tokens), which are not tokenized again: the chat template is
+    then added at the token level, from the cached ids of `chat_template_ids`.
+    The ids are truncated to `max_length` tokens, if any.
+    """
+    if isinstance(prompt, str):
+        input_ids = tokenizer(format_prompt(prompt, add_special_tokens))["input_ids"]
+    else:
+        header_ids, footer_ids, special_ids = chat_template_ids(tokenizer)
+        if add_special_tokens:
+            input_ids = header_ids + list(prompt) + footer_ids
+        else:
+            input_ids = special_ids + list(prompt)
+    return input_ids[:max_length] if max_length else input_ids
+
+
+def as_batch(input_ids, device):
+    """`generate` inputs of a single sequence of token ids."""
+    input_ids = torch.tensor([input_ids], dtype=torch.long, device=device)
+    return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+
+def get_terminators(tokenizer):
+    return [
+        tokenizer.eos_token_id,
+        tokenizer.convert_tokens_to_ids("<|eot_id|>"),
+    ]
+
+
+def parse_output(output_text: str) -> str:
+    output = output_text.split("<|start_header_id|>assistant<|end_header_id|>")[1]
+    output = output.strip()
+    output = output.removesuffix("<|eot_id|>")
+    return output
+
+
 @torch.no_grad()
 def inference(
     model,
@@ -48,6 +140,14 @@ def inference(
     repetition_penalty: float = 1.0,
     length_penalty: int = 1,
     max_prompt_tokens: int = 35_000,
+    prompt_lookup_num_tokens: int = None,
+    max_matching_ngram_size: int = None,
+    prefill_chunk_size: int = None,
+    kv_cache: str = "fp16",
+    adapter: str = None,
+    stats: SpeculativeStats = None,
+    throughput: ThroughputStats = None,
+    decoder: CompiledDecoder = None,
     **kwargs,
 ):
     """
@@ -61,58 +161,553 @@ def inference(
     min_length: int, optional (default=None) The minimum length of the sequence to be generated input prompt + min_new_tokens
     repetition_penalty: float, optional (default=1.0) The parameter for repetition penalty. 1.0 means no penalty.
     length_penalty: int, optional (default=1) Exponential penalty to the length that is used with beam-based generation.
+    prompt_lookup_num_tokens: int, optional (default=None) Prompt lookup decoding: the maximum number of tokens copied from the prompt after a match of the last n-gram, all verified in one forward pass.
+    max_matching_ngram_size: int, optional (default=None) The size of the largest n-gram matched against the prompt in prompt lookup decoding (2 if None).
+    prefill_chunk_size: int, optional (default=None) Prefill the prompt in chunks of this many tokens (see `prefill`), in a single forward pass if None.
+    kv_cache: str, optional (default="fp16") Backend of the key/value cache: "fp16", "int8", "int4" (quantized) or "offloaded" to CPU (see `src.models.kv_cache`).
+    adapter: str, optional (default=None) Name of the LoRA adapter to generate with (see `src.models.multi_lora`), the active one if None.
+    stats: SpeculativeStats, optional (default=None) Counts the generated tokens and decoding steps (e.g. with an `assistant_model` for speculative decoding).
+    throughput: ThroughputStats, optional (default=None) Times the prefill and the decoding, for their tokens/s.
+    decoder: CompiledDecoder, optional (default=None) Decode with a static cache and a compiled forward pass (see `src.models.compiled_decode`), unless the generation is assisted, uses another KV cache or another adapter.
     """
-    if add_special_tokens:
-        prompt = f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\nCutting Knowledge Date: December 2023\nToday Date: 26 Jul 2024\n\n<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
-        # prompt = f"<|begin_of_text|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
-
-    batch = tokenizer(
-        prompt,
-        truncation=True,
-        max_length=max_padding_length,
-        return_tensors="pt",
-    )
+    input_ids = encode_prompt(tokenizer, prompt, add_special_tokens, max_padding_length)
 
     # if the input is too long, return the length of the input
-    n_tokens = len(batch["input_ids"][0])
+    n_tokens = len(input_ids)
     if max_prompt_tokens is not None and n_tokens > max_prompt_tokens:
         return n_tokens
 
-    batch = {k: v.to("cuda") for k, v in batch.items()}
+    batch = as_batch(input_ids, model.device)
 
-    terminators = [
-        tokenizer.eos_token_id,
-        tokenizer.convert_tokens_to_ids("<|eot_id|>"),
+    terminators = get_terminators(tokenizer)
+    assisted = (
+        prompt_lookup_num_tokens is not None
+        or kwargs.get("assistant_model") is not None
+    )
+    check_kv_cache(kv_cache, assisted)
+    if stats is not None:
+        add_stopping_criteria(kwargs, stats.token_counter(n_tokens, assisted))
+    if throughput is not None:
+        add_stopping_criteria(kwargs, throughput.meter(n_tokens, assisted=assisted))
+    forward_kwargs = {}
+    names = adapter_names(model, [adapter])
+    if names is not None:
+        forward_kwargs["adapter_names"] = names
+
+    try:
+        cache = kwargs.pop("past_key_values", None)
+        bucket = None
+        if (
+            decoder is not None
+            and cache is None
+            and kv_cache == "fp16"
+            and not assisted
+            and names is None
+        ):
+            bucket = decoder.bucket(n_tokens + max_new_tokens)
+        if bucket is not None:
+            # `generate` then only runs the compiled forward pass on one token
+            chunk_size = prefill_chunk_size or n_tokens
+            cache = prefill(
+                model, batch, chunk_size, decoder.cache(bucket), **forward_kwargs
+            )
+        else:
+            if cache is None and kv_cache != "fp16":
+                cache = make_kv_cache(kv_cache)
+            if prefill_chunk_size and n_tokens > prefill_chunk_size:
+                cache = prefill(
+                    model, batch, prefill_chunk_size, cache, **forward_kwargs
+                )
+        if cache is not None:
+            kwargs["past_key_values"] = cache
+        with decoder.compiled() if bucket is not None else nullcontext():
+            outputs = model.generate(
+                **batch,
+                max_new_tokens=max_new_tokens,
+                do_sample=do_sample,
+                top_p=top_p,
+                temperature=temperature,
+                # 0 is the default of `generate`, None breaks assisted generation
+                min_length=min_length or 0,
+                use_cache=use_cache,
+                top_k=top_k,
+                repetition_penalty=repetition_penalty,
+                length_penalty=length_penalty,
+                eos_token_id=terminators,
+                pad_token_id=tokenizer.eos_token_id,
+                prompt_lookup_num_tokens=prompt_lookup_num_tokens,
+                max_matching_ngram_size=max_matching_ngram_size,
+                **forward_kwargs,
+                **kwargs,
+            )
+        # Prompt lookup can accept a few tokens past `max_new_tokens`
+        outputs = outputs[:, : n_tokens + max_new_tokens]
+        output_text = tokenizer.decode(outputs[0], skip_special_tokens=False)
+        output = parse_output(output_text)
+
+    except torch.cuda.OutOfMemoryError as e:
+        log.error(f"CUDA out of memory error: {e}")
+        torch.cuda.empty_cache()
+        return n_tokens
+
+    return output
+
+
+def prefill(model, batch, chunk_size, cache=None, **kwargs):
+    """
+    Build the key/value cache of the prompt in chunks of `chunk_size` tokens.
+
+    All the tokens but the last are cached: `generate` then only runs the
+    last one, with the cache as `past_key_values`. Each forward pass only
+    holds the activations of one chunk, instead of those of the whole prompt,
+    so the peak memory is the cache plus the activations of a chunk, whatever
+    the length of the prompt. `batch` can hold left-padded rows (see
+    `left_pad`). `cache` is the (empty) cache to fill, a `DynamicCache` if
+    None. Other kwargs are passed to the model (e.g. `adapter_names`).
+    """
+    input_ids, attention_mask = batch["input_ids"], batch["attention_mask"]
+    if cache is None:
+        cache = DynamicCache()
+    # The positions of `generate`, which start after the left padding
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask == 0, 1)
+    n_cached = input_ids.shape[1] - 1
+    for start in range(0, n_cached, chunk_size):
+        end = min(start + chunk_size, n_cached)
+        model(
+            input_ids=input_ids[:, start:end],
+            attention_mask=attention_mask[:, :end],
+            position_ids=position_ids[:, start:end],
+            past_key_values=cache,
+            use_cache=True,
+            num_logits_to_keep=1,
+            **kwargs,
+        )
+    return cache
+
+
+def check_kv_cache(kv_cache, assisted=False):
+    if kv_cache not in KV_CACHES:
+        raise ValueError(f"Unknown KV cache {kv_cache}, choose from {KV_CACHES}")
+    if assisted and kv_cache in QUANTIZED_BITS:
+        # The rejected proposals are cropped from the cache
+        raise ValueError("Speculative decoding does not work with a quantized cache")
+
+
+def add_stopping_criteria(kwargs, *criteria):
+    """Append stopping criteria to the `generate` kwargs, keeping the others."""
+    stopping_criteria = StoppingCriteriaList(
+        kwargs.pop("stopping_criteria", None) or []
+    )
+    stopping_criteria.extend(criteria)
+    kwargs["stopping_criteria"] = stopping_criteria
+
+
+class TokenIterator(BaseStreamer):
+    """
+    Iterator over the token ids generated in another thread.
+
+    Passed as the `streamer` of `generate`, which pushes the prompt first (it
+    is skipped with `skip_prompt`) and then each new token. Errors of the
+    generating thread are re-raised by the iterator, and `stopped` is set
+    when the consumer closes it so that the producer can stop early.
+    """
+
+    def __init__(self, skip_prompt=True):
+        self.queue = queue.Queue()
+        self.skip_prompt = skip_prompt
+        self.stopped = threading.Event()
+
+    def put(self, value):
+        if self.skip_prompt:
+            self.skip_prompt = False
+            return
+        for token_id in value.view(-1).tolist():
+            self.push(token_id)
+
+    def push(self, token_id):
+        self.queue.put(token_id)
+
+    def end(self):
+        self.queue.put(None)
+
+    def fail(self, error):
+        self.queue.put(error)
+
+    def close(self):
+        self.stopped.set()
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+
+class StopOnEvent(StoppingCriteria):
+    """Stop `generate` once `event` is set (e.g. the stream was abandoned)."""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full(
+            (input_ids.shape[0],),
+            self.event.is_set(),
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+def decode_stream(tokenizer, token_ids, terminators=()):
+    """
+    Incrementally decode token ids into text chunks.
+
+    A chunk is yielded as soon as the decoded text grows, except while it ends
+    with an incomplete UTF-8 character. Decoding restarts after each newline,
+    so a line is never decoded more than once per token. Terminators end the
+    stream and are not decoded, and leading whitespace is dropped, as in
+    `parse_output`.
+    """
+    line_ids, n_sent, started = [], 0, False
+    for token_id in token_ids:
+        if token_id in terminators:
+            break
+        line_ids.append(token_id)
+        text = tokenizer.decode(line_ids, skip_special_tokens=False)
+        if text.endswith("\ufffd"):
+            continue
+        chunk = text[n_sent:]
+        n_sent = len(text)
+        if text.endswith("\n"):
+            line_ids, n_sent = [], 0
+        if not started:
+            chunk = chunk.lstrip()
+            started = bool(chunk)
+        if chunk:
+            yield chunk
+    if line_ids:
+        text = tokenizer.decode(line_ids, skip_special_tokens=False)
+        chunk = text[n_sent:] if started else text[n_sent:].lstrip()
+        if chunk:
+            yield chunk
+
+
+def inference_stream(
+    model,
+    tokenizer: AutoTokenizer,
+    prompt: str,
+    add_special_tokens: bool = True,
+    max_new_tokens=1024,
+    max_padding_length: int = None,
+    max_prompt_tokens: int = 35_000,
+    prefill_chunk_size: int = None,
+    kv_cache: str = "fp16",
+    adapter: str = None,
+    stats: SpeculativeStats = None,
+    throughput: ThroughputStats = None,
+    **kwargs,
+):
+    """
+    Streaming version of `inference`: yields the output text chunk by chunk.
+
+    `generate` runs in a background thread and pushes its tokens to a
+    `TokenIterator`, it is stopped if the stream is closed early. If the
+    prompt is too long or does not fit in memory, the number of prompt tokens
+    is yielded (as the last item), as `inference` returns it. Joining the
+    chunks gives the output of `inference` without the final terminator.
+    """
+    input_ids = encode_prompt(tokenizer, prompt, add_special_tokens, max_padding_length)
+    n_tokens = len(input_ids)
+    if max_prompt_tokens is not None and n_tokens > max_prompt_tokens:
+        yield n_tokens
+        return
+    batch = as_batch(input_ids, model.device)
+
+    terminators = get_terminators(tokenizer)
+    token_ids = TokenIterator()
+    add_stopping_criteria(kwargs, StopOnEvent(token_ids.stopped))
+    # As in `inference`, None breaks assisted generation
+    kwargs["min_length"] = kwargs.get("min_length") or 0
+    assisted = (
+        kwargs.get("prompt_lookup_num_tokens") is not None
+        or kwargs.get("assistant_model") is not None
+    )
+    check_kv_cache(kv_cache, assisted)
+    if kv_cache != "fp16" and kwargs.get("past_key_values") is None:
+        kwargs["past_key_values"] = make_kv_cache(kv_cache)
+    forward_kwargs = {}
+    names = adapter_names(model, [adapter])
+    if names is not None:
+        forward_kwargs["adapter_names"] = names
+    if stats is not None:
+        add_stopping_criteria(kwargs, stats.token_counter(n_tokens, assisted))
+    if throughput is not None:
+        add_stopping_criteria(kwargs, throughput.meter(n_tokens, assisted=assisted))
+
+    @torch.no_grad()
+    def generate():
+        try:
+            if prefill_chunk_size and n_tokens > prefill_chunk_size:
+                kwargs["past_key_values"] = prefill(
+                    model,
+                    batch,
+                    prefill_chunk_size,
+                    kwargs.get("past_key_values"),
+                    **forward_kwargs,
+                )
+            model.generate(
+                **batch,
+                max_new_tokens=max_new_tokens,
+                eos_token_id=terminators,
+                pad_token_id=tokenizer.eos_token_id,
+                streamer=token_ids,
+                **forward_kwargs,
+                **kwargs,
+            )
+        except Exception as e:
+            token_ids.fail(e)
+
+    thread = threading.Thread(target=generate, daemon=True)
+    thread.start()
+    try:
+        yield from decode_stream(
+            tokenizer, itertools.islice(token_ids, max_new_tokens), terminators
+        )
+    except torch.cuda.OutOfMemoryError as e:
+        log.error(f"CUDA out of memory error: {e}")
+        torch.cuda.empty_cache()
+        yield n_tokens
+    finally:
+        token_ids.close()
+        thread.join()
+
+
+def bucket_by_length(lengths, batch_size=8, max_batch_tokens=None, max_new_tokens=0):
+    """
+    Group prompts of similar length into batches.
+
+    Prompts are sorted by token length and cut into consecutive batches of at
+    most `batch_size` prompts, whose padded size `n_prompts * (longest prompt +
+    max_new_tokens)` stays under `max_batch_tokens` (a single prompt is always
+    allowed). Returns the list of batches as lists of indices into `lengths`.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches, batch = [], []
+    for idx in order:
+        n_tokens = (lengths[idx] + max_new_tokens) * (len(batch) + 1)
+        too_many = len(batch) >= batch_size
+        too_long = max_batch_tokens is not None and n_tokens > max_batch_tokens
+        if batch and (too_many or too_long):
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+@torch.no_grad()
+def inference_batch(
+    model,
+    tokenizer: AutoTokenizer,
+    prompts: list,
+    add_special_tokens: bool = True,
+    max_new_tokens=1024,
+    max_padding_length: int = None,
+    max_prompt_tokens: int = 35_000,
+    batch_size: int = 8,
+    max_batch_tokens: int = None,
+    logits_processors: list = None,
+    kv_cache: str = "fp16",
+    adapters: list = None,
+    **kwargs,
+):
+    """
+    Batched version of `inference`, returns one output per prompt (in order).
+    Prompts are text or token ids, as in `encode_prompt`.
+
+    Prompts are bucketed by length (see `bucket_by_length`) and left padded.
+    As in `inference`, the output is the number of prompt tokens instead of
+    the text if the prompt is too long or if it does not fit in memory even
+    on its own. `logits_processors` holds an optional logits processor for
+    each prompt (e.g. with its own video duration), and `adapters` its LoRA
+    adapter (see `inference`), batches can mix adapters.
+    """
+    check_kv_cache(kv_cache)
+    # Text prompts are tokenized in a single call, token ids are used as is
+    texts = [
+        format_prompt(p, add_special_tokens) for p in prompts if isinstance(p, str)
+    ]
+    encoded = iter(tokenizer(texts)["input_ids"] if texts else [])
+    input_ids = [
+        next(encoded)
+        if isinstance(prompt, str)
+        else encode_prompt(tokenizer, prompt, add_special_tokens)
+        for prompt in prompts
     ]
+    if max_padding_length:
+        input_ids = [ids[:max_padding_length] for ids in input_ids]
+    lengths = [len(ids) for ids in input_ids]
+
+    outputs = [None] * len(prompts)
+    todo = []
+    for idx, n_tokens in enumerate(lengths):
+        if max_prompt_tokens is not None and n_tokens > max_prompt_tokens:
+            outputs[idx] = n_tokens
+        else:
+            todo.append(idx)
+
+    buckets = bucket_by_length(
+        [lengths[idx] for idx in todo], batch_size, max_batch_tokens, max_new_tokens
+    )
+    for bucket in buckets:
+        indices = [todo[i] for i in bucket]
+        batch_outputs = _generate_batch(
+            model,
+            tokenizer,
+            [input_ids[idx] for idx in indices],
+            max_new_tokens=max_new_tokens,
+            logits_processors=(
+                None
+                if logits_processors is None
+                else [logits_processors[idx] for idx in indices]
+            ),
+            adapters=None if adapters is None else [adapters[idx] for idx in indices],
+            kv_cache=kv_cache,
+            **kwargs,
+        )
+        for idx, output in zip(indices, batch_outputs):
+            outputs[idx] = output
+
+    return outputs
+
 
+def left_pad(input_ids, pad_token_id):
+    """Left pad lists of token ids into `input_ids`/`attention_mask` tensors."""
+    max_len = max(len(ids) for ids in input_ids)
+    batch_ids = torch.full((len(input_ids), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids), max_len), dtype=torch.long)
+    for i, ids in enumerate(input_ids):
+        if ids:
+            batch_ids[i, -len(ids) :] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, -len(ids) :] = 1
+    return {"input_ids": batch_ids, "attention_mask": attention_mask}
+
+
+class RowLogitsProcessor(LogitsProcessor):
+    """Apply a different logits processor to each row of a batch."""
+
+    def __init__(self, processors):
+        self.processors = processors
+
+    def __call__(self, input_ids, scores):
+        return torch.cat(
+            [
+                scores[i : i + 1]
+                if processor is None
+                else processor(input_ids[i : i + 1], scores[i : i + 1])
+                for i, processor in enumerate(self.processors)
+            ]
+        )
+
+
+def _generate_batch(
+    model,
+    tokenizer,
+    input_ids,
+    logits_processors=None,
+    adapters=None,
+    kv_cache="fp16",
+    prefill_chunk_size=None,
+    throughput=None,
+    **kwargs,
+):
+    """
+    Generate for left-padded `input_ids`, halving the batch on OOM. Batches
+    longer than `prefill_chunk_size` are prefilled in chunks (see `prefill`).
+    """
+    batch = left_pad(input_ids, tokenizer.pad_token_id)
+    batch = {k: v.to(model.device) for k, v in batch.items()}
+    processors = {}
+    if logits_processors is not None and any(logits_processors):
+        processors["logits_processor"] = LogitsProcessorList(
+            [RowLogitsProcessor(logits_processors)]
+        )
+    if kv_cache != "fp16":
+        processors["past_key_values"] = make_kv_cache(kv_cache)
+    forward_kwargs = {}
+    names = adapter_names(model, adapters or [None])
+    if names is not None:
+        forward_kwargs["adapter_names"] = names
+
+    # Added to a copy, which the halves of the batch get without it
+    generate_kwargs = dict(kwargs)
+    if throughput is not None:
+        n_prompt_tokens = sum(len(ids) for ids in input_ids)
+        meter = throughput.meter(batch["input_ids"].shape[1], n_prompt_tokens)
+        add_stopping_criteria(generate_kwargs, meter)
+
+    terminators = get_terminators(tokenizer)
     try:
+        if prefill_chunk_size and batch["input_ids"].shape[1] > prefill_chunk_size:
+            processors["past_key_values"] = prefill(
+                model,
+                batch,
+                prefill_chunk_size,
+                processors.get("past_key_values"),
+                **forward_kwargs,
+            )
         outputs = model.generate(
             **batch,
-            max_new_tokens=max_new_tokens,
-            do_sample=do_sample,
-            top_p=top_p,
-            temperature=temperature,
-            min_length=min_length,
-            use_cache=use_cache,
-            top_k=top_k,
-            repetition_penalty=repetition_penalty,
-            length_penalty=length_penalty,
             eos_token_id=terminators,
             pad_token_id=tokenizer.eos_token_id,
-            **kwargs,
+            **processors,
+            **forward_kwargs,
+            **generate_kwargs,
         )
-        output_text = tokenizer.decode(outputs[0], skip_special_tokens=False)
-
-        output = output_text.split("<|start_header_id|>assistant<|end_header_id|>")[1]
-        output = output.strip()
-        output = output.removesuffix("<|eot_id|>")
-
     except torch.cuda.OutOfMemoryError as e:
-        log.error(f"CUDA out of memory error: {e}")
         torch.cuda.empty_cache()
-        return n_tokens
+        if len(input_ids) == 1:
+            log.error(f"CUDA out of memory error: {e}")
+            return [len(input_ids[0])]
+        half = len(input_ids) // 2
+        halves = [slice(None, half), slice(half, None)]
+        return [
+            output
+            for rows in halves
+            for output in _generate_batch(
+                model,
+                tokenizer,
+                input_ids[rows],
+                logits_processors=logits_processors and logits_processors[rows],
+                adapters=adapters and adapters[rows],
+                kv_cache=kv_cache,
+                prefill_chunk_size=prefill_chunk_size,
+                throughput=throughput,
+                **kwargs,
+            )
+        ]
 
-    return output
+    # Decode each row as in `inference`: without the left padding and
+    # without what was generated after its own terminator
+    prompt_len = batch["input_ids"].shape[1]
+    results = []
+    for ids, row in zip(input_ids, outputs.tolist()):
+        generated = row[prompt_len:]
+        for i, token_id in enumerate(generated):
+            if token_id in terminators:
+                generated = generated[: i + 1]
+                break
+        output_text = tokenizer.decode(ids + generated, skip_special_tokens=False)
+        results.append(parse_output(output_text))
+    return results
 
 
 class LlamaInference:
@@ -134,6 +729,27 @@ class LlamaInference:
         repetition_penalty: float = 1.0,
         length_penalty: int = 1,
         max_prompt_tokens: int = 35_000,
+        batch_size: int = 8,
+        max_batch_tokens: int = None,
+        draft_model: dict = None,
+        prompt_lookup_num_tokens: int = None,
+        max_matching_ngram_size: int = None,
+        prefill_chunk_size: int = 2048,
+        chunked_prefill: bool = False,
+        memory_headroom: float = 0.8,
+        kv_cache: str = "fp16",
+        adapters: dict = None,
+        merged_dir: str = MERGED_DIR,
+        device: str = "auto",
+        num_threads: int = None,
+        group_size: int = 128,
+        # Options of the llama.cpp engine, which shares the config
+        gguf_dir: str = None,
+        gguf_quantization: str = None,
+        fast_load: bool = False,
+        tokenizer_cache: str = TOKENIZER_CACHE,
+        compiled_decode: bool = False,
+        compile_min_bucket: int = 1024,
         **kwargs,
     ):
         # Check if LLaMA model exists
@@ -148,20 +764,90 @@ class LlamaInference:
         if peft_model:
             log.info(f"PEFT model found at {peft_model}")
 
-        model = load_model_llamarecipes(
-            model_name=ckpt_path,
-            quantization=quantization,
-            use_fast_kernels=use_fast_kernels,
-            device_map="auto",
-            **kwargs,
-        )
+        if device not in ("auto", "cpu"):
+            raise ValueError(f"Unknown device {device}, choose from auto or cpu")
+        timer = LoadTimer()
+        if fast_load and (device == "cpu" or quantization):
+            log.warning("fast_load needs device=auto without quantization, ignored")
+            fast_load = False
+        torch_dtype = kwargs.get("torch_dtype")
+        if fast_load and not fits_device(str(ckpt_path), None, torch_dtype):
+            log.warning("The model does not fit on one device, fast_load ignored")
+            fast_load = False
+
+        # The adapter merged into the base weights (tools/export/merge_lora.py),
+        # unless other adapters are loaded on top of the base model. It is only
+        # used if merged in the dtype of the model: `torch_dtype` on CPU
+        # (bfloat16 by default) and with fast_load, float32 otherwise
+        if device == "cpu":
+            dtype = kwargs.get("torch_dtype", torch.bfloat16)
+        else:
+            dtype = torch_dtype if fast_load else None
+        merged = None
+        if not adapters:
+            merged = find_merged(peft_model, merged_dir, ckpt_path, dtype)
+        if merged is not None:
+            log.info(f"Loading the merged checkpoint of {peft_model} from {merged}")
+            peft_model = None
+
+        tokenizer = None
+        if fast_load:
+            # Meta-device init, mmapped shards, cached tokenizer and adapter
+            # read in parallel (src/models/fast_load.py)
+            model, tokenizer = load_model_fast(
+                str(merged or ckpt_path),
+                tokenizer_path=ckpt_path,
+                peft_model=peft_model,
+                attn_implementation="sdpa" if use_fast_kernels else None,
+                tokenizer_cache=tokenizer_cache,
+                timer=timer,
+                **kwargs,
+            )
+            peft_model = None
+        elif device == "cpu":
+            # Weight-only int8/int4 quantization (src/models/cpu_inference.py),
+            # the LoRA is merged first unless other adapters are loaded with it
+            if quantization and adapters:
+                raise ValueError(
+                    "LoRA adapters cannot be loaded on a quantized CPU model"
+                )
+            with timer.stage("weights"):
+                model = load_cpu_model(
+                    str(merged or ckpt_path),
+                    peft_model=None if adapters else peft_model,
+                    quantization=quantization,
+                    group_size=group_size,
+                    num_threads=num_threads,
+                    **kwargs,
+                )
+            if not adapters:
+                peft_model = None
+        else:
+            with timer.stage("weights"):
+                model = load_model_llamarecipes(
+                    model_name=str(merged or ckpt_path),
+                    quantization=quantization,
+                    use_fast_kernels=use_fast_kernels,
+                    device_map="auto",
+                    **kwargs,
+                )
         if peft_model:
-            model = load_peft_model(model, peft_model)
+            with timer.stage("adapter"):
+                model = load_peft_model(model, peft_model)
+        # Other LoRAs of the same base model, selected per request by name
+        with timer.stage("adapters"):
+            for name, path in (adapters or {}).items():
+                model = load_adapter(model, name, path)
 
         model.eval()
 
-        tokenizer = AutoTokenizer.from_pretrained(ckpt_path)
-        tokenizer.pad_token = tokenizer.eos_token
+        if tokenizer is None:
+            with timer.stage("tokenizer"):
+                tokenizer = AutoTokenizer.from_pretrained(ckpt_path)
+                tokenizer.pad_token = tokenizer.eos_token
+        # Seconds spent in each stage of the load, to track the cold start
+        self.load_times = timer.stop()
+        log.info(f"Model loaded in {timer}")
 
         self.model = model
         self.tokenizer = tokenizer
@@ -177,13 +863,127 @@ class LlamaInference:
         self.repetition_penalty = repetition_penalty
         self.length_penalty = length_penalty
         self.max_prompt_tokens = max_prompt_tokens
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        # Default backend of the key/value cache, can be changed per request
+        self.kv_cache = kv_cache
+        # Tokens/s of the prefill and of the decoding, over all the requests
+        self.throughput = ThroughputStats()
+        # Prompts longer than `prefill_chunk_size` are prefilled in chunks of
+        # this size by default with `chunked_prefill`, see `prefill`
+        self.prefill_chunk_size = prefill_chunk_size if chunked_prefill else None
+        # Strategies for the prompts that are too long for a single pass
+        self.memory_policy = MemoryPolicy.from_model(
+            model,
+            prefill_chunk_size=prefill_chunk_size,
+            chunked_prefill=chunked_prefill,
+            max_prompt_tokens=max_prompt_tokens,
+            headroom=memory_headroom,
+            kv_cache=kv_cache,
+        )
+        # Static KV caches and compiled decoding steps, by buckets of prompt
+        # and output lengths (src/models/compiled_decode.py)
+        self.decoder = None
+        if compiled_decode:
+            max_tokens = max_prompt_tokens or model.config.max_position_embeddings
+            self.decoder = CompiledDecoder(
+                model, max_tokens + max_new_tokens, compile_min_bucket
+            )
+
+        # Speculative decoding with a smaller Llama (same tokenizer) as draft,
+        # or with tokens copied from the prompt (prompt lookup)
+        self.assistant_model = None
+        self.prompt_lookup_num_tokens = prompt_lookup_num_tokens
+        self.max_matching_ngram_size = max_matching_ngram_size
+        self.speculative_stats = None
+        if draft_model and draft_model.get("ckpt_path"):
+            if prompt_lookup_num_tokens is not None:
+                raise ValueError("Use either a draft model or prompt lookup, not both")
+            self.assistant_model = load_draft_model(
+                use_fast_kernels=use_fast_kernels, **draft_model
+            )
+        if self.assistant_model is not None or prompt_lookup_num_tokens is not None:
+            self.speculative_stats = SpeculativeStats()
+        check_kv_cache(kv_cache, assisted=self.speculative_stats is not None)
+
+    @property
+    def adapters(self):
+        """Names of the LoRA adapters loaded on the base model."""
+        return loaded_adapters(self.model)
+
+    def load_adapter(self, name, path):
+        """
+        Load the LoRA at `path` as `name` (next to the others), so that requests
+        can select it with `adapter=name`.
+        """
+        self.model = load_adapter(self.model, name, path)
+        log.info(f"LoRA adapter {name} loaded from {path}")
+
+    def unload_adapter(self, name):
+        unload_adapter(self.model, name)
+        log.info(f"LoRA adapter {name} unloaded")
 
-    def __call__(self, prompt: str, **kwargs):
+    def __call__(self, prompt, **kwargs):
+        """
+        Generate for a prompt, given as text or as token ids (see
+        `encode_prompt`). Returns the output text, or the number of prompt
+        tokens if the prompt is too long or does not fit in memory.
+        """
+        params = self.get_params(prompt=prompt, **kwargs)
+        if self.decoder is not None:
+            # Only single prompts are decoded with the compiled forward pass
+            params.setdefault("decoder", self.decoder)
+        return inference(**params)
+
+    def stream(self, prompt, **kwargs):
+        """
+        Yield the output text chunk by chunk while it is generated.
+
+        As with `__call__`, a single int (the number of prompt tokens) is
+        yielded instead if the prompt is too long.
+        """
+        params = self.get_params(prompt=prompt, **kwargs)
+        return inference_stream(**params)
+
+    def generate_batch(
+        self, prompts: list, batch_size=None, max_batch_tokens=None, **kwargs
+    ):
+        """
+        Generate for several prompts at once, with length-bucketed batches.
+
+        Returns a list with, for each prompt, the output text or (as in
+        `__call__`) its number of tokens if it is too long. `adapters` can
+        name the LoRA adapter of each prompt.
+        """
+        if self.speculative_stats is not None:
+            # Assisted generation only supports a batch size of 1
+            logits_processors = kwargs.pop("logits_processors", None)
+            logits_processors = logits_processors or [None] * len(prompts)
+            adapters = kwargs.pop("adapters", None) or [None] * len(prompts)
+            return [
+                self(prompt, adapter=adapter, **kwargs)
+                if processor is None
+                else self(
+                    prompt,
+                    adapter=adapter,
+                    logits_processor=LogitsProcessorList([processor]),
+                    **kwargs,
+                )
+                for prompt, processor, adapter in zip(
+                    prompts, logits_processors, adapters
+                )
+            ]
+
+        params = self.get_params(prompts=prompts, **kwargs)
+        params["batch_size"] = batch_size or self.batch_size
+        params["max_batch_tokens"] = max_batch_tokens or self.max_batch_tokens
+        return inference_batch(**params)
+
+    def get_params(self, **kwargs):
         # Create a dict of default parameters from instance attributes
         params = {
             "model": self.model,
             "tokenizer": self.tokenizer,
-            "prompt": prompt,
             "add_special_tokens": self.add_special_tokens,
             "temperature": self.temperature,
             "max_new_tokens": self.max_new_tokens,
@@ -196,9 +996,18 @@ class LlamaInference:
             "repetition_penalty": self.repetition_penalty,
             "length_penalty": self.length_penalty,
             "max_prompt_tokens": self.max_prompt_tokens,
+            "prefill_chunk_size": self.prefill_chunk_size,
+            "kv_cache": self.kv_cache,
+            "throughput": self.throughput,
         }
+        if self.assistant_model is not None:
+            params["assistant_model"] = self.assistant_model
+        if self.prompt_lookup_num_tokens is not None:
+            params["prompt_lookup_num_tokens"] = self.prompt_lookup_num_tokens
+            params["max_matching_ngram_size"] = self.max_matching_ngram_size
+        if self.speculative_stats is not None:
+            params["stats"] = self.speculative_stats
 
         # Update with any overrides passed in kwargs
         params.update(kwargs)
-
-        return inference(**params)
+        return params
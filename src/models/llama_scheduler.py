@@ -0,0 +1,512 @@
+"""
+Continuous batching of generation requests for the web backends.
+
+`LlamaScheduler` owns a background thread that runs a single decode loop over
+all the sequences in flight. Requests can be submitted from any thread
+(`submit`, or `__call__` as a drop-in for `LlamaInference`) or coroutine
+(`agenerate`). Batching happens at the iteration level: each step decodes one
+token for every active sequence, finished sequences leave the batch right
+away and waiting requests are prefilled and join it at the next step, so
+short requests are never stuck behind long ones.
+
+Sequences can use different LoRA adapters of the model (see
+`src.models.multi_lora`), which can be loaded and unloaded while serving.
+
+The batched KV cache is left padded. A joining sequence is prefilled on its
+own and its cache is padded to the batch length (or the batch to its length),
+and the columns that only hold padding are trimmed when sequences leave.
+"""
+
+import asyncio
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, Union
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+from src.models.llama_inference import (
+    TokenIterator,
+    decode_stream,
+    encode_prompt,
+    get_terminators,
+    parse_output,
+    prefill,
+)
+from src.models.multi_lora import (
+    adapter_names,
+    load_adapter,
+    loaded_adapters,
+    unload_adapter,
+)
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+
+@dataclass
+class Sequence:
+    future: Future
+    # Text or token ids, see `encode_prompt`
+    prompt: Union[str, list[int]]
+    max_new_tokens: int
+    add_special_tokens: bool = True
+    do_sample: bool = False
+    temperature: float = 1.0
+    top_p: float = 1.0
+    top_k: int = 50
+    prompt_ids: list[int] = None
+    generated: list[int] = field(default_factory=list)
+    streamer: TokenIterator = None
+    logits_processor: Callable = None
+    # LoRA adapter, the active one if None
+    adapter: str = None
+
+    def append(self, token_id):
+        self.generated.append(token_id)
+        if self.streamer is not None:
+            self.streamer.push(token_id)
+
+    def set_result(self, result):
+        self.future.set_result(result)
+        if self.streamer is not None:
+            self.streamer.end()
+
+    def set_exception(self, error):
+        if not self.future.done():
+            self.future.set_exception(error)
+        if self.streamer is not None:
+            self.streamer.fail(error)
+
+
+class LlamaScheduler:
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 8,
+        max_batch_tokens: int = None,
+        add_special_tokens: bool = True,
+        temperature: float = 1.0,
+        max_new_tokens: int = 1024,
+        top_p: float = 1.0,
+        top_k: int = 50,
+        max_padding_length: int = None,
+        do_sample: bool = False,
+        max_prompt_tokens: int = 35_000,
+        prefill_chunk_size: int = None,
+    ):
+        """
+        max_batch_size: int, maximum number of sequences decoded together.
+        max_batch_tokens: int, optional (default=None) maximum number of cached tokens (prompt + max_new_tokens of each sequence) in the batch, a single sequence is always admitted.
+        prefill_chunk_size: int, optional (default=None) Prefill the joining sequences in chunks of this many tokens (see `prefill`), in a single forward pass if None.
+        The other parameters are the defaults of each request, as in `LlamaInference`.
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.add_special_tokens = add_special_tokens
+        self.temperature = temperature
+        self.max_new_tokens = max_new_tokens
+        self.top_p = top_p
+        self.top_k = top_k
+        self.max_padding_length = max_padding_length
+        self.do_sample = do_sample
+        self.max_prompt_tokens = max_prompt_tokens
+        self.prefill_chunk_size = prefill_chunk_size
+
+        self.terminators = set(get_terminators(tokenizer))
+        self.device = model.device
+
+        self.requests = queue.Queue()
+        self.waiting = deque()
+        self.active = []
+        self.cache = None
+        self.attention_mask = None
+        # Lowered after an out of memory error, until the batch is empty again
+        self.batch_limit = max_batch_size
+        self.closed = False
+        # Held by each step of the decode loop, and to change the adapters
+        self.model_lock = threading.Lock()
+
+        self.thread = threading.Thread(
+            target=self._run, name="LlamaScheduler", daemon=True
+        )
+        self.thread.start()
+
+    @classmethod
+    def from_inference(cls, inference, **kwargs):
+        """Schedule the model of a `LlamaInference`, with the same defaults."""
+        params = {
+            "add_special_tokens": inference.add_special_tokens,
+            "temperature": inference.temperature,
+            "max_new_tokens": inference.max_new_tokens,
+            "top_p": inference.top_p,
+            "top_k": inference.top_k,
+            "max_padding_length": inference.max_padding_length,
+            "do_sample": inference.do_sample,
+            "max_prompt_tokens": inference.max_prompt_tokens,
+            "prefill_chunk_size": inference.prefill_chunk_size,
+        }
+        params.update(kwargs)
+        return cls(inference.model, inference.tokenizer, **params)
+
+    def submit(
+        self,
+        prompt: Union[str, list[int]],
+        add_special_tokens: bool = None,
+        max_new_tokens: int = None,
+        do_sample: bool = None,
+        temperature: float = None,
+        top_p: float = None,
+        top_k: int = None,
+        use_cache: bool = True,
+        streamer: TokenIterator = None,
+        logits_processor: Callable = None,
+        adapter: str = None,
+    ) -> Future:
+        """
+        Queue a prompt (text or token ids) and return a `Future` of its output.
+
+        As with `LlamaInference`, the result is the output text, or the number
+        of prompt tokens if the prompt is too long or does not fit in memory.
+        `use_cache` is only accepted for compatibility, the KV cache is always
+        used. The generated token ids are also pushed to `streamer`, if any.
+        `logits_processor(generated_ids, scores)` is applied to the logits of
+        the sequence (only the generated ids are passed, not the prompt).
+        `adapter` is the name of the LoRA adapter to use (see `load_adapter`).
+        """
+        if self.closed:
+            raise RuntimeError("LlamaScheduler is closed.")
+        # Fail now on an unknown adapter, not in the decode loop
+        adapter_names(self.model, [adapter])
+        if add_special_tokens is None:
+            add_special_tokens = self.add_special_tokens
+        future = Future()
+        self.requests.put(
+            Sequence(
+                future=future,
+                prompt=prompt,
+                add_special_tokens=add_special_tokens,
+                max_new_tokens=max_new_tokens or self.max_new_tokens,
+                do_sample=self.do_sample if do_sample is None else do_sample,
+                temperature=temperature or self.temperature,
+                top_p=top_p or self.top_p,
+                top_k=self.top_k if top_k is None else top_k,
+                streamer=streamer,
+                logits_processor=logits_processor,
+                adapter=adapter,
+            )
+        )
+        return future
+
+    @property
+    def adapters(self):
+        """Names of the LoRA adapters loaded on the model."""
+        return loaded_adapters(self.model)
+
+    def load_adapter(self, name, path):
+        """Load the LoRA at `path` as `name`, between two decoding steps."""
+        with self.model_lock:
+            self.model = load_adapter(self.model, name, path)
+        log.info(f"LoRA adapter {name} loaded from {path}")
+
+    def unload_adapter(self, name):
+        """Unload the LoRA `name`, which no admitted request can be using."""
+        with self.model_lock:
+            if any(seq.adapter == name for seq in [*self.active, *self.waiting]):
+                raise ValueError(f"Adapter {name} is used by a request")
+            unload_adapter(self.model, name)
+        log.info(f"LoRA adapter {name} unloaded")
+
+    def __call__(self, prompt, **kwargs):
+        return self.submit(prompt, **kwargs).result()
+
+    def stream(self, prompt, **kwargs):
+        """Yield the output text chunk by chunk, as `LlamaInference.stream`."""
+        token_ids = TokenIterator(skip_prompt=False)
+        future = self.submit(prompt, streamer=token_ids, **kwargs)
+        yield from decode_stream(self.tokenizer, token_ids, self.terminators)
+        output = future.result()
+        if isinstance(output, int):
+            yield output
+
+    async def agenerate(self, prompt, **kwargs):
+        return await asyncio.wrap_future(self.submit(prompt, **kwargs))
+
+    def close(self, wait=True):
+        """Stop accepting requests, the ones already submitted are completed."""
+        if not self.closed:
+            self.closed = True
+            self.requests.put(None)
+        if wait:
+            self.thread.join()
+
+    # Decode loop (scheduler thread only)
+
+    def _run(self):
+        stopping = False
+        with torch.no_grad():
+            while not (stopping and not self.active and not self.waiting):
+                try:
+                    stopping |= self._receive(block=not self.active and not stopping)
+                    with self.model_lock:
+                        self._admit()
+                        if self.active:
+                            self._step()
+                except Exception as e:
+                    log.error(f"LlamaScheduler step failed: {e}")
+                    self._fail(e)
+
+    def _receive(self, block):
+        """Move the submitted requests to `waiting`, returns True on `close`."""
+        while True:
+            try:
+                seq = self.requests.get(block=block and not self.waiting)
+            except queue.Empty:
+                return False
+            if seq is None:
+                return True
+            self.waiting.append(seq)
+            block = False
+
+    def _admit(self):
+        while self.waiting and len(self.active) < self.batch_limit:
+            seq = self.waiting.popleft()
+            try:
+                if seq.prompt_ids is None and not self._tokenize(seq):
+                    continue
+                if self.active and not self._fits(seq):
+                    self.waiting.appendleft(seq)
+                    break
+                self._prefill(seq)
+            except Exception as e:
+                log.error(f"LlamaScheduler prefill failed: {e}")
+                seq.set_exception(e)
+
+    def _tokenize(self, seq):
+        """Tokenize a new request, returns False if it is already answered."""
+        if not seq.future.set_running_or_notify_cancel():
+            return False
+        seq.prompt_ids = encode_prompt(
+            self.tokenizer,
+            seq.prompt,
+            seq.add_special_tokens,
+            max_length=self.max_padding_length,
+        )
+        n_tokens = len(seq.prompt_ids)
+        if self.max_prompt_tokens is not None and n_tokens > self.max_prompt_tokens:
+            seq.set_result(n_tokens)
+            return False
+        return True
+
+    def _fits(self, seq):
+        if self.max_batch_tokens is None:
+            return True
+        n_tokens = sum(
+            len(s.prompt_ids) + s.max_new_tokens for s in [*self.active, seq]
+        )
+        return n_tokens <= self.max_batch_tokens
+
+    def _prefill(self, seq):
+        """Run the prompt (and what was already generated) and join the batch."""
+        input_ids = torch.tensor(
+            [seq.prompt_ids + seq.generated], dtype=torch.long, device=self.device
+        )
+        adapter_kwargs = self._adapter_kwargs([seq])
+        try:
+            cache = DynamicCache()
+            chunk_size = self.prefill_chunk_size
+            if chunk_size and input_ids.shape[1] > chunk_size:
+                # All the tokens but the last, whose logits are computed below
+                batch = {
+                    "input_ids": input_ids,
+                    "attention_mask": torch.ones_like(input_ids),
+                }
+                cache = prefill(self.model, batch, chunk_size, cache, **adapter_kwargs)
+                input_ids = input_ids[:, -1:]
+            outputs = self.model(
+                input_ids=input_ids,
+                past_key_values=cache,
+                use_cache=True,
+                num_logits_to_keep=1,
+                **adapter_kwargs,
+            )
+        except torch.cuda.OutOfMemoryError as e:
+            torch.cuda.empty_cache()
+            if self.active:
+                # Retry once the batch is smaller
+                self.waiting.appendleft(seq)
+                self.batch_limit = len(self.active)
+                return
+            log.error(f"CUDA out of memory error: {e}")
+            seq.set_result(len(seq.prompt_ids))
+            return
+
+        logits = outputs.logits[0, -1]
+        if seq.logits_processor is not None:
+            logits = self._process(seq, logits)
+        self._add_token(seq, logits)
+        if self._finished(seq):
+            self._complete(seq)
+            return
+        self._join(seq, outputs.past_key_values)
+
+    def _join(self, seq, cache):
+        layers = cache.to_legacy_cache()
+        mask = torch.ones(
+            (1, layers[0][0].shape[2]), dtype=torch.long, device=self.device
+        )
+        if not self.active:
+            self.active = [seq]
+            self.cache, self.attention_mask = layers, mask
+            return
+
+        length = max(self.attention_mask.shape[1], mask.shape[1])
+        self.cache = tuple(
+            (
+                torch.cat([_left_pad(k, length), _left_pad(new_k, length)]),
+                torch.cat([_left_pad(v, length), _left_pad(new_v, length)]),
+            )
+            for (k, v), (new_k, new_v) in zip(self.cache, layers)
+        )
+        self.attention_mask = torch.cat(
+            [_left_pad(self.attention_mask, length), _left_pad(mask, length)]
+        )
+        self.active.append(seq)
+
+    def _step(self):
+        """Decode one token for every active sequence."""
+        input_ids = torch.tensor(
+            [[seq.generated[-1]] for seq in self.active], device=self.device
+        )
+        attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        # Positions count the real tokens only (not the left padding)
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True)
+        try:
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=DynamicCache.from_legacy_cache(self.cache),
+                use_cache=True,
+                **self._adapter_kwargs(self.active),
+            )
+        except torch.cuda.OutOfMemoryError as e:
+            torch.cuda.empty_cache()
+            self._preempt(e)
+            return
+
+        self.cache = outputs.past_key_values.to_legacy_cache()
+        self.attention_mask = attention_mask
+        logits = outputs.logits[:, -1]
+        for i, seq in enumerate(self.active):
+            if seq.logits_processor is not None:
+                logits[i] = self._process(seq, logits[i])
+        greedy = logits.argmax(dim=-1).tolist()
+        for i, seq in enumerate(self.active):
+            if seq.do_sample:
+                self._add_token(seq, logits[i])
+            else:
+                seq.append(greedy[i])
+
+        done = [self._finished(seq) for seq in self.active]
+        if any(done):
+            for seq, is_done in zip(self.active, done):
+                if is_done:
+                    self._complete(seq)
+            self._keep([i for i, is_done in enumerate(done) if not is_done])
+
+    def _preempt(self, error):
+        """Out of memory: send the last admitted sequence back to the queue."""
+        if len(self.active) == 1:
+            log.error(f"CUDA out of memory error: {error}")
+            seq = self.active[0]
+            self._keep([])
+            seq.set_result(len(seq.prompt_ids))
+            return
+        seq = self.active[-1]
+        self._keep(list(range(len(self.active) - 1)))
+        # Its KV cache is recomputed from the prompt and the generated tokens
+        self.waiting.appendleft(seq)
+        self.batch_limit = len(self.active)
+
+    def _keep(self, rows):
+        """Keep the `rows` of the batch and drop the padding only columns."""
+        self.active = [self.active[i] for i in rows]
+        if not self.active:
+            self.cache = self.attention_mask = None
+            self.batch_limit = self.max_batch_size
+            return
+        index = torch.tensor(rows, device=self.device)
+        mask = self.attention_mask[index]
+        start = int(mask.any(dim=0).int().argmax())
+        self.attention_mask = mask[:, start:]
+        self.cache = tuple(
+            (k[index, :, start:], v[index, :, start:]) for k, v in self.cache
+        )
+
+    def _adapter_kwargs(self, seqs):
+        names = adapter_names(self.model, [seq.adapter for seq in seqs])
+        return {} if names is None else {"adapter_names": names}
+
+    def _process(self, seq, logits):
+        generated = torch.tensor([seq.generated], dtype=torch.long, device=self.device)
+        return seq.logits_processor(generated, logits[None])[0]
+
+    def _add_token(self, seq, logits):
+        seq.append(
+            sample_token(logits, seq.do_sample, seq.temperature, seq.top_k, seq.top_p)
+        )
+
+    def _finished(self, seq):
+        return (
+            seq.generated[-1] in self.terminators
+            or len(seq.generated) >= seq.max_new_tokens
+            # The stream was closed by its consumer
+            or seq.streamer is not None
+            and seq.streamer.stopped.is_set()
+        )
+
+    def _complete(self, seq):
+        output_text = self.tokenizer.decode(
+            seq.prompt_ids + seq.generated, skip_special_tokens=False
+        )
+        seq.set_result(parse_output(output_text))
+
+    def _fail(self, error):
+        for seq in self.active:
+            seq.set_exception(error)
+        self._keep([])
+
+
+def _left_pad(tensor, length):
+    """Left pad the sequence dimension (-2 for the KV cache, -1 for the mask)."""
+    dim = -2 if tensor.dim() == 4 else -1
+    n_pad = length - tensor.shape[dim]
+    if n_pad == 0:
+        return tensor
+    pad = (0, 0, n_pad, 0) if dim == -2 else (n_pad, 0)
+    return F.pad(tensor, pad)
+
+
+def sample_token(logits, do_sample=False, temperature=1.0, top_k=50, top_p=1.0):
+    """Pick the next token from the logits of one sequence, as `generate` does."""
+    if not do_sample:
+        return int(logits.argmax())
+    logits = logits.float() / temperature
+    if top_k:
+        kth = torch.topk(logits, min(top_k, logits.shape[-1])).values[-1]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+    if top_p < 1.0:
+        sorted_logits, sorted_idx = torch.sort(logits, descending=True)
+        probs = sorted_logits.softmax(dim=-1)
+        # Keep the smallest set of tokens whose probabilities add up to top_p
+        remove = probs.cumsum(dim=-1) - probs > top_p
+        logits[sorted_idx[remove]] = float("-inf")
+    return int(torch.multinomial(logits.softmax(dim=-1), 1))
@@ -0,0 +1,279 @@
+"""
+Memory-aware choice of how to run a long prompt.
+
+Instead of giving up on a video when its prompt is too long or does not fit
+in memory, `MemoryPolicy` estimates the memory of the generation from the
+prompt length and the model config (`estimate_memory`), and plans the
+strategies to try in order:
+
+- "single": the prompt is prefilled in a single forward pass,
+- "chunked": the prompt is prefilled in chunks of `prefill_chunk_size`
+  tokens, so the activations no longer grow with the prompt,
+- "window": the transcript is cut into windows that fit in memory and the
+  chapters of all the windows are merged (`src.test.vidchapters_window`).
+
+Strategies that are known not to fit are skipped, and the next one is tried
+when one fails anyway (out of memory). The windows always fit: their size is
+derived from the available memory and halved again on failure.
+"""
+
+from typing import NamedTuple, Optional
+
+import torch
+
+from src.models.kv_cache import kv_cache_scale
+
+# Smallest transcript window worth generating chapters for
+MIN_WINDOW_TOKENS = 1_000
+
+
+class MemoryEstimate(NamedTuple):
+    kv_cache: int
+    activations: int
+
+    @property
+    def total(self):
+        return self.kv_cache + self.activations
+
+
+class Strategy(NamedTuple):
+    name: str
+    # Prefill chunk size ("chunked") or transcript tokens per window ("window")
+    size: Optional[int] = None
+
+
+def kv_bytes_per_token(config, dtype_bytes=2):
+    """Bytes of the key/value cache of one token, over all the layers."""
+    head_dim = getattr(config, "head_dim", None)
+    head_dim = head_dim or config.hidden_size // config.num_attention_heads
+    n_kv_heads = getattr(config, "num_key_value_heads", None)
+    n_kv_heads = n_kv_heads or config.num_attention_heads
+    return 2 * config.num_hidden_layers * n_kv_heads * head_dim * dtype_bytes
+
+
+def estimate_memory(
+    config,
+    n_tokens,
+    max_new_tokens=0,
+    chunk_size=None,
+    dtype_bytes=2,
+    eager=False,
+    kv_cache="fp16",
+):
+    """
+    Estimate the memory needed to generate after a prompt of `n_tokens`.
+
+    The key/value cache holds every token of the prompt and of the output,
+    in less memory if it is quantized or offloaded (`kv_cache`).
+    The activations are those of one layer during the prefill of `chunk_size`
+    tokens at a time (the whole prompt if None): hidden states, the MLP and,
+    with `eager` attention, the attention scores of the chunk against the
+    whole prompt. Only the logits of the last token are computed.
+    """
+    kv_bytes = kv_bytes_per_token(config, dtype_bytes) * (n_tokens + max_new_tokens)
+    kv_bytes = int(kv_bytes * kv_cache_scale(kv_cache, config, dtype_bytes))
+    n_active = min(n_tokens, chunk_size) if chunk_size else n_tokens
+    per_token = 3 * config.intermediate_size + 4 * config.hidden_size
+    activations = n_active * per_token * dtype_bytes
+    if eager:
+        activations += config.num_attention_heads * n_active * n_tokens * dtype_bytes
+    activations += config.vocab_size * 4
+    return MemoryEstimate(kv_bytes, activations)
+
+
+def available_memory(device):
+    """Free memory of a CUDA device (None if unknown, e.g. on CPU)."""
+    device = torch.device(device)
+    if device.type != "cuda" or not torch.cuda.is_available():
+        return None
+    free, _ = torch.cuda.mem_get_info(device)
+    # Memory cached by PyTorch but unused can be reused as well
+    return (
+        free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    )
+
+
+class MemoryPolicy:
+    """
+    Plan the strategies to generate for a prompt, given the free memory.
+
+    `headroom` is the fraction of the free memory that the estimates can
+    use, to account for fragmentation and what they do not model. `kv_cache`
+    is the backend of the key/value cache (see `src.models.kv_cache`). With
+    `chunked_prefill`, the prompts longer than `prefill_chunk_size` are always
+    prefilled in chunks, so they are not tried in a single pass.
+    """
+
+    def __init__(
+        self,
+        config,
+        device,
+        dtype=torch.bfloat16,
+        prefill_chunk_size: int = 2048,
+        chunked_prefill: bool = False,
+        max_prompt_tokens: int = 35_000,
+        headroom: float = 0.8,
+        kv_cache: str = "fp16",
+    ):
+        self.config = config
+        self.device = device
+        self.dtype_bytes = torch.empty((), dtype=dtype).element_size()
+        self.prefill_chunk_size = prefill_chunk_size
+        self.chunked_prefill = chunked_prefill
+        self.max_prompt_tokens = max_prompt_tokens
+        self.headroom = headroom
+        self.kv_cache = kv_cache
+        self.eager = getattr(config, "_attn_implementation", None) == "eager"
+
+    @classmethod
+    def from_model(cls, model, **kwargs):
+        return cls(model.config, model.device, dtype=model.dtype, **kwargs)
+
+    def estimate(self, n_tokens, max_new_tokens=0, chunk_size=None):
+        return estimate_memory(
+            self.config,
+            n_tokens,
+            max_new_tokens,
+            chunk_size=chunk_size,
+            dtype_bytes=self.dtype_bytes,
+            eager=self.eager,
+            kv_cache=self.kv_cache,
+        )
+
+    def budget(self):
+        free = available_memory(self.device)
+        return None if free is None else int(free * self.headroom)
+
+    def max_tokens(self, max_new_tokens=0, budget=None):
+        """
+        Longest prompt that fits in `budget` bytes with chunked prefill, and
+        is not longer than `max_prompt_tokens` (None if there is no limit).
+        """
+        if budget is None:
+            return self.max_prompt_tokens
+        fixed = self.estimate(self.prefill_chunk_size).activations
+        per_token = kv_bytes_per_token(self.config, self.dtype_bytes)
+        per_token *= kv_cache_scale(self.kv_cache, self.config, self.dtype_bytes)
+        n_tokens = int((budget - fixed) // per_token) - max_new_tokens
+        if self.max_prompt_tokens is not None:
+            n_tokens = min(n_tokens, self.max_prompt_tokens)
+        return max(0, n_tokens)
+
+    def plan(self, n_tokens, max_new_tokens=0, n_prompt_tokens=0):
+        """
+        Strategies to try, in order, for a prompt of `n_tokens` tokens whose
+        instructions (without the transcript) take `n_prompt_tokens`.
+        """
+        budget = self.budget()
+        strategies = []
+        if self.max_prompt_tokens is None or n_tokens <= self.max_prompt_tokens:
+            long_prompt = n_tokens > self.prefill_chunk_size
+            single = self.estimate(n_tokens, max_new_tokens)
+            if not (self.chunked_prefill and long_prompt) and (
+                budget is None or single.total <= budget
+            ):
+                strategies.append(Strategy("single"))
+            chunked = self.estimate(n_tokens, max_new_tokens, self.prefill_chunk_size)
+            if long_prompt and (budget is None or chunked.total <= budget):
+                strategies.append(Strategy("chunked", self.prefill_chunk_size))
+
+        # Windows of the transcript, smaller than the whole one if it was
+        # already tried at once
+        n_transcript = n_tokens - n_prompt_tokens
+        max_tokens = self.max_tokens(max_new_tokens, budget)
+        window = n_transcript if max_tokens is None else max_tokens - n_prompt_tokens
+        window = min(window, n_transcript // 2 if strategies else n_transcript)
+        while window >= MIN_WINDOW_TOKENS:
+            strategies.append(Strategy("window", window))
+            window //= 2
+        if not strategies:
+            strategies.append(Strategy("window", MIN_WINDOW_TOKENS))
+        return strategies
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from src.models.llama_inference import LlamaInference, encode_prompt
+    from src.test.utils_chapters import extract_chapters
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Peak GPU memory of the single-pass and of the chunked prefill against "
+            "the prompt length, and whether their chapters match."
+        )
+    )
+    parser.add_argument("--ckpt_path", default="meta-llama/Meta-Llama-3.1-8B-Instruct")
+    parser.add_argument("--peft_model", default=None)
+    parser.add_argument("--subset", default=None, help="ASR prompts of a subset")
+    parser.add_argument("--n_videos", type=int, default=5)
+    parser.add_argument(
+        "--lengths",
+        type=int,
+        nargs="+",
+        default=[4096, 8192, 16384, 32768],
+        help="Tokens of the synthetic transcripts, without --subset",
+    )
+    parser.add_argument("--prefill_chunk_size", type=int, default=2048)
+    parser.add_argument("--max_new_tokens", type=int, default=256)
+    args = parser.parse_args()
+
+    inference = LlamaInference(
+        args.ckpt_path,
+        peft_model=args.peft_model,
+        use_fast_kernels=True,
+        max_new_tokens=args.max_new_tokens,
+        max_prompt_tokens=None,
+        prefill_chunk_size=args.prefill_chunk_size,
+    )
+    tokenizer = inference.tokenizer
+    if args.subset:
+        from src.data.utils_asr import ChaptersASR, PromptASR
+
+        chapters = ChaptersASR(subset=args.subset)
+        prompter = PromptASR(chapters=chapters)
+        vid_ids = [vid_id for vid_id in chapters if vid_id in prompter]
+        prompts = [prompter.get_prompt_test(vid_id) for vid_id in vid_ids]
+        prompts = prompts[: args.n_videos]
+    else:
+        line = "00:00:00: and then we add the next ingredient to the pan\n"
+        line_tokens = len(tokenizer(line, add_special_tokens=False)["input_ids"])
+        prompts = [
+            "Generate chapters for this transcript:\n" + line * (n // line_tokens)
+            for n in args.lengths
+        ]
+
+    def gib(n_bytes):
+        return "-" if n_bytes is None else f"{n_bytes / 2**30:.2f} GiB"
+
+    def run(prompt, chunk_size):
+        """Output and peak memory (above the weights) of a generation."""
+        cuda = inference.model.device.type == "cuda"
+        if cuda:
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+            start = torch.cuda.memory_allocated()
+        output = inference(prompt, prefill_chunk_size=chunk_size)
+        peak = torch.cuda.max_memory_allocated() - start if cuda else None
+        return output, peak
+
+    policy = inference.memory_policy
+    modes = {"single": None, "chunked": args.prefill_chunk_size}
+    n_same = 0
+    for prompt in sorted(prompts, key=len):
+        n_tokens = len(encode_prompt(tokenizer, prompt))
+        results = {}
+        for name, chunk_size in modes.items():
+            output, peak = run(prompt, chunk_size)
+            estimate = policy.estimate(n_tokens, args.max_new_tokens, chunk_size)
+            results[name] = output
+            status = "out of memory" if isinstance(output, int) else gib(peak)
+            print(
+                f"{n_tokens} tokens, {name}: {status} (estimate {gib(estimate.total)})"
+            )
+        single, chunked = results["single"], results["chunked"]
+        same = not isinstance(single, int) and not isinstance(chunked, int)
+        same = same and extract_chapters(single) == extract_chapters(chunked)
+        n_same += same
+        print(f"  chapters {'identical' if same else 'different'}")
+    print(f"Chapters: {n_same}/{len(prompts)} identical")
@@ -0,0 +1,157 @@
+"""
+LoRA adapters merged into the base weights, exported once and cached.
+
+In production a single adapter is used: merging it into the base weights
+removes the LoRA matmuls of every layer at each decoding step, and loading the
+merged model is faster than loading the base model and wrapping it with PEFT.
+`merge_lora` (`python -m tools.export.merge_lora`) saves the merged model as
+sharded safetensors in `merged_dir/<key>`, where the key hashes the content of
+the adapter files, so a retrained adapter is never served from a stale export.
+`find_merged` is how `LlamaInference` detects the export and loads it instead
+of the base model and the adapter, if it was merged into the same base model
+and in the dtype the model is loaded in (both recorded in `merge_info.json`).
+
+The export also records the SHA-256 of every shard (`merge_info.json`,
+written last, so an interrupted export is never found), which
+`verify_merged` checks.
+"""
+
+import hashlib
+import json
+import shutil
+from pathlib import Path
+
+import torch
+
+from src.models.fast_load import resolve_dtype
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+MERGED_DIR = Path("checkpoints/merged")
+INFO_FILE = "merge_info.json"
+ADAPTER_FILES = (
+    "adapter_config.json",
+    "adapter_model.safetensors",
+    "adapter_model.bin",
+)
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def adapter_sha256(peft_model):
+    """Hash of the files of an adapter (its config and weights)."""
+    sha = hashlib.sha256()
+    for name in ADAPTER_FILES:
+        path = Path(peft_model) / name
+        if path.exists():
+            sha.update(f"{name}:{file_sha256(path)}".encode())
+    return sha.hexdigest()
+
+
+def merged_path(peft_model, merged_dir=MERGED_DIR):
+    return Path(merged_dir) / adapter_sha256(peft_model)[:16]
+
+
+def dtype_name(dtype=None):
+    return str(resolve_dtype(dtype)).removeprefix("torch.")
+
+
+def find_merged(peft_model, merged_dir=MERGED_DIR, base_model=None, dtype=None):
+    """
+    Directory of the merged export of `peft_model`, None if not exported, or
+    if it was merged into another `base_model` or in another `dtype` (the
+    default dtype if None) than the ones given.
+    """
+    if not peft_model or not (Path(peft_model) / ADAPTER_FILES[0]).exists():
+        return None
+    path = merged_path(peft_model, merged_dir)
+    if not (path / INFO_FILE).exists():
+        return None
+    with open(path / INFO_FILE) as f:
+        info = json.load(f)
+    if base_model is not None and info["base_model"] != str(base_model):
+        log.info(f"{path} is merged into {info['base_model']}, not {base_model}")
+        return None
+    if info.get("dtype") != dtype_name(dtype):
+        log.info(
+            f"{path} is merged in {info.get('dtype')}, not {dtype_name(dtype)}: "
+            f"export it again with --dtype to use it"
+        )
+        return None
+    return path
+
+
+def shard_hashes(path):
+    return {
+        shard.name: file_sha256(shard) for shard in sorted(path.glob("*.safetensors"))
+    }
+
+
+def merge_lora(
+    ckpt_path,
+    peft_model,
+    merged_dir=MERGED_DIR,
+    max_shard_size="5GB",
+    dtype=torch.bfloat16,
+    overwrite=False,
+):
+    """
+    Merge the adapter `peft_model` into the base model `ckpt_path` and save
+    it (with the tokenizer) as sharded safetensors. Returns the directory of
+    the export, which is reused if it already exists for the same base model
+    and dtype (unless `overwrite`), and replaced otherwise.
+    """
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    output_dir = merged_path(peft_model, merged_dir)
+    found = find_merged(peft_model, merged_dir, base_model=ckpt_path, dtype=dtype)
+    if found is not None and not overwrite:
+        log.info(f"{peft_model} is already merged in {output_dir}")
+        return output_dir
+
+    model = AutoModelForCausalLM.from_pretrained(
+        ckpt_path, torch_dtype=dtype, low_cpu_mem_usage=True
+    )
+    model = PeftModel.from_pretrained(model, peft_model).merge_and_unload()
+
+    # Written next to the final directory, which only appears once complete
+    tmp_dir = output_dir.with_name(f"{output_dir.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    model.save_pretrained(
+        tmp_dir, safe_serialization=True, max_shard_size=max_shard_size
+    )
+    AutoTokenizer.from_pretrained(ckpt_path).save_pretrained(tmp_dir)
+
+    shards = shard_hashes(tmp_dir)
+    weights_sha256 = hashlib.sha256("".join(shards.values()).encode()).hexdigest()
+    info = {
+        "base_model": str(ckpt_path),
+        "peft_model": str(peft_model),
+        "dtype": dtype_name(dtype),
+        "adapter_sha256": adapter_sha256(peft_model),
+        "weights_sha256": weights_sha256,
+        "shards": shards,
+    }
+    with open(tmp_dir / INFO_FILE, "w") as f:
+        json.dump(info, f, indent=2)
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    tmp_dir.rename(output_dir)
+    log.info(f"{peft_model} merged into {ckpt_path} saved to {output_dir}")
+    return output_dir
+
+
+def verify_merged(path):
+    """Whether the shards of a merged export match the hashes of its info."""
+    path = Path(path)
+    with open(path / INFO_FILE) as f:
+        info = json.load(f)
+    return shard_hashes(path) == info["shards"]
@@ -0,0 +1,55 @@
+"""
+Several LoRA adapters served by one base model.
+
+The chapter models (asr-1k, asr-10k, captions_asr-1k and captions_asr-10k in
+`tools.download.models.MODEL_PATHS`) are LoRAs of the same Llama. Instead of
+a base model per adapter, they are all loaded in a single `PeftModel`, while
+serving (`load_adapter`, `unload_adapter`), and every request names its
+adapter. PEFT runs the rows of a batch with different adapters
+(`adapter_names`), so requests for different models are still batched
+together. `BASE_MODEL` selects the base model without any LoRA.
+"""
+
+from peft import PeftModel
+
+# Name of the base model (no adapter) for PEFT
+BASE_MODEL = "__base__"
+
+
+def load_adapter(model, name, path):
+    """Add the LoRA at `path` to `model` as `name`, returns the `PeftModel`."""
+    if isinstance(model, PeftModel):
+        model.load_adapter(path, adapter_name=name)
+    else:
+        model = PeftModel.from_pretrained(model, path, adapter_name=name)
+    model.eval()
+    return model
+
+
+def unload_adapter(model, name):
+    """Remove the LoRA `name` from `model` and free its weights."""
+    if name not in loaded_adapters(model):
+        raise ValueError(f"Adapter {name} is not loaded")
+    model.delete_adapter(name)
+
+
+def loaded_adapters(model):
+    return list(model.peft_config) if isinstance(model, PeftModel) else []
+
+
+def adapter_names(model, adapters):
+    """
+    `adapter_names` of a batch (for `generate` or the forward pass of a
+    `PeftModel`), from the adapter of each row: a name, `BASE_MODEL` or None
+    for the active adapter. Returns None when all the rows use the active
+    adapter, as without `adapter_names`.
+    """
+    if all(adapter is None for adapter in adapters):
+        return None
+    loaded = loaded_adapters(model)
+    unknown = {adapter for adapter in adapters if adapter is not None}
+    unknown -= {*loaded, BASE_MODEL}
+    if unknown:
+        raise ValueError(f"Unknown adapters {sorted(unknown)}, loaded: {loaded}")
+    active = model.active_adapter if loaded else BASE_MODEL
+    return [active if adapter is None else adapter for adapter in adapters]
@@ -0,0 +1,202 @@
+"""
+Speculative decoding: cheap proposals verified by the target model.
+
+The tokens are proposed either by a smaller draft model (e.g. Llama-3.2-1B
+for the 8B model, same tokenizer) or by prompt lookup: the last n-gram of the
+sequence is searched for in the prompt and the tokens that follow it there
+are proposed, since chapter timestamps and titles are often copied from the
+transcript. The target model verifies all the proposals in a single forward
+pass (`generate(assistant_model=...)` or `generate(prompt_lookup_num_tokens=
+...)`), so with greedy decoding the output is the one of the target model
+alone, only faster when most proposals are accepted.
+
+`SpeculativeStats` counts the new tokens, the verification steps (forward
+passes of the target model) and the proposed tokens, to report the
+acceptance rate.
+"""
+
+from pathlib import Path
+
+import torch
+from llama_cookbook.inference.model_utils import load_model as load_model_llamarecipes
+from llama_cookbook.inference.model_utils import load_peft_model
+from transformers import StoppingCriteria
+
+from src.utils import RankedLogger
+
+log = RankedLogger(__name__, rank_zero_only=True)
+
+
+def load_draft_model(
+    ckpt_path,
+    peft_model=None,
+    quantization=None,
+    use_fast_kernels=False,
+    num_assistant_tokens: int = 8,
+    num_assistant_tokens_schedule: str = "heuristic",
+    assistant_confidence_threshold: float = 0.4,
+):
+    """
+    Load the draft model of speculative decoding, with its optional LoRA.
+
+    `num_assistant_tokens` is the number of tokens proposed at each step, and
+    with the "heuristic" schedule it grows by 2 when all the proposals are
+    accepted and shrinks by 1 otherwise. The draft model also stops
+    proposing once its probability for the next token is below
+    `assistant_confidence_threshold`.
+    """
+    if peft_model and not Path(peft_model).exists():
+        log.warning(f"Draft PEFT model does not exist at {peft_model}")
+        peft_model = None
+
+    model = load_model_llamarecipes(
+        model_name=ckpt_path,
+        quantization=quantization,
+        use_fast_kernels=use_fast_kernels,
+        device_map="auto",
+    )
+    if peft_model:
+        model = load_peft_model(model, peft_model)
+    model.eval()
+
+    generation_config = model.generation_config
+    generation_config.num_assistant_tokens = num_assistant_tokens
+    generation_config.num_assistant_tokens_schedule = num_assistant_tokens_schedule
+    generation_config.assistant_confidence_threshold = assistant_confidence_threshold
+    log.info(f"Draft model {ckpt_path} loaded (LoRA: {peft_model or 'none'})")
+    return model
+
+
+class SpeculativeStats:
+    """Acceptance statistics of speculative decoding, over all generations."""
+
+    def __init__(self):
+        self.n_generations = 0
+        self.n_tokens = 0
+        self.n_steps = 0
+        self.n_proposed = 0
+
+    def token_counter(self, prompt_len, assisted=True):
+        """Stopping criterion counting the tokens and steps of a generation."""
+        self.n_generations += 1
+        return TokenCounter(self, prompt_len, assisted)
+
+    @property
+    def n_accepted(self):
+        # Each verification step adds the accepted tokens plus one of the target
+        return self.n_tokens - self.n_steps
+
+    @property
+    def acceptance_rate(self):
+        return self.n_accepted / self.n_proposed if self.n_proposed else 0.0
+
+    @property
+    def tokens_per_step(self):
+        return self.n_tokens / self.n_steps if self.n_steps else 0.0
+
+    def as_dict(self):
+        return {
+            "generations": self.n_generations,
+            "tokens": self.n_tokens,
+            "target_steps": self.n_steps,
+            "proposed": self.n_proposed,
+            "accepted": self.n_accepted,
+            "acceptance_rate": self.acceptance_rate,
+            "tokens_per_step": self.tokens_per_step,
+        }
+
+    def __str__(self):
+        return (
+            f"{self.n_tokens} tokens in {self.n_steps} target steps "
+            f"({self.tokens_per_step:.2f} tokens/step), "
+            f"{self.n_accepted}/{self.n_proposed} proposed tokens accepted "
+            f"({self.acceptance_rate:.1%}) over {self.n_generations} generations"
+        )
+
+
+class TokenCounter(StoppingCriteria):
+    """
+    Count the steps of `generate` and the tokens they add, never stops.
+
+    Stopping criteria are called once per step with the accepted tokens, and
+    with `assisted` generation, also once before on the proposed tokens.
+    """
+
+    def __init__(self, stats: SpeculativeStats, prompt_len: int, assisted=True):
+        self.stats = stats
+        self.length = prompt_len
+        self.assisted = assisted
+        self.proposal = assisted
+
+    def __call__(self, input_ids, scores, **kwargs):
+        length = input_ids.shape[1]
+        if self.proposal:
+            self.stats.n_proposed += length - self.length
+        else:
+            self.stats.n_steps += 1
+            self.stats.n_tokens += length - self.length
+            self.length = length
+        if self.assisted:
+            self.proposal = not self.proposal
+        return torch.zeros(
+            input_ids.shape[0], dtype=torch.bool, device=input_ids.device
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from src.data.utils_asr import ChaptersASR, PromptASR
+    from src.models.llama_inference import LlamaInference
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmark prompt lookup and draft-model decoding against plain greedy "
+            "decoding on ASR prompts."
+        )
+    )
+    parser.add_argument("--ckpt_path", default="meta-llama/Meta-Llama-3.1-8B-Instruct")
+    parser.add_argument("--peft_model", default=None)
+    parser.add_argument("--subset", default="sml300_val")
+    parser.add_argument("--n_videos", type=int, default=20)
+    parser.add_argument("--max_new_tokens", type=int, default=1024)
+    parser.add_argument("--prompt_lookup_num_tokens", type=int, default=10)
+    parser.add_argument("--max_matching_ngram_size", type=int, default=2)
+    parser.add_argument("--draft_ckpt_path", default=None)
+    parser.add_argument("--draft_peft_model", default=None)
+    args = parser.parse_args()
+
+    chapters = ChaptersASR(subset=args.subset)
+    prompter = PromptASR(chapters=chapters)
+    vid_ids = [vid_id for vid_id in chapters if vid_id in prompter]
+    prompts = [prompter.get_prompt_test(vid_id) for vid_id in vid_ids[: args.n_videos]]
+
+    inference = LlamaInference(
+        args.ckpt_path, peft_model=args.peft_model, max_new_tokens=args.max_new_tokens
+    )
+    modes = {
+        "greedy": {},
+        "prompt lookup": {
+            "prompt_lookup_num_tokens": args.prompt_lookup_num_tokens,
+            "max_matching_ngram_size": args.max_matching_ngram_size,
+        },
+    }
+    if args.draft_ckpt_path:
+        draft = load_draft_model(args.draft_ckpt_path, peft_model=args.draft_peft_model)
+        modes["draft model"] = {"assistant_model": draft}
+
+    # Warm up the kernels before timing
+    inference(prompts[0], max_new_tokens=8)
+
+    outputs = {}
+    for name, kwargs in modes.items():
+        stats = SpeculativeStats()
+        start = time.perf_counter()
+        outputs[name] = [inference(prompt, stats=stats, **kwargs) for prompt in prompts]
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed:.1f}s, {stats.n_tokens / elapsed:.1f} tokens/s")
+        print(f"  {stats}")
+        if name != "greedy":
+            same = sum(a == b for a, b in zip(outputs["greedy"], outputs[name]))
+            print(f"  {same}/{len(prompts)} outputs identical to greedy decoding")
@@ -0,0 +1,122 @@
+"""
+Prompt and generation throughput (tokens/s) of `LlamaInference`.
+
+`ThroughputStats` times the generations it is given (`stats.meter(...)` is a
+stopping criterion of `generate`, see `inference`): the prefill is the time
+until the first new token, the decoding the time of the following steps.
+The prompt tokens/s of the prefill and the generated tokens/s of the
+decoding are what size the workers, e.g. on CPU nodes
+(`src.models.cpu_inference`).
+"""
+
+import time
+
+import torch
+from transformers import StoppingCriteria
+
+
+class ThroughputStats:
+    """Tokens and time of the prefill and of the decoding, over all generations."""
+
+    def __init__(self):
+        self.n_generations = 0
+        self.n_prompt_tokens = 0
+        self.n_tokens = 0
+        self.n_decoded = 0
+        self.prefill_time = 0.0
+        self.decode_time = 0.0
+
+    def meter(self, prompt_len, n_prompt_tokens=None, assisted=False):
+        """
+        Stopping criterion timing a generation, started now, for `input_ids`
+        of length `prompt_len` with `n_prompt_tokens` tokens (without the
+        padding of a batch, `prompt_len` if None).
+        """
+        self.n_generations += 1
+        if n_prompt_tokens is None:
+            n_prompt_tokens = prompt_len
+        return ThroughputMeter(self, prompt_len, n_prompt_tokens, assisted)
+
+    @property
+    def prefill_tokens_per_s(self):
+        return self.n_prompt_tokens / self.prefill_time if self.prefill_time else 0.0
+
+    @property
+    def decode_tokens_per_s(self):
+        return self.n_decoded / self.decode_time if self.decode_time else 0.0
+
+    @property
+    def tokens_per_s(self):
+        elapsed = self.prefill_time + self.decode_time
+        return self.n_tokens / elapsed if elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            "generations": self.n_generations,
+            "prompt_tokens": self.n_prompt_tokens,
+            "tokens": self.n_tokens,
+            "prefill_time": self.prefill_time,
+            "decode_time": self.decode_time,
+            "prefill_tokens_per_s": self.prefill_tokens_per_s,
+            "decode_tokens_per_s": self.decode_tokens_per_s,
+            "tokens_per_s": self.tokens_per_s,
+        }
+
+    def __str__(self):
+        return (
+            f"{self.n_prompt_tokens} prompt tokens in {self.prefill_time:.1f}s "
+            f"({self.prefill_tokens_per_s:.1f} tokens/s), "
+            f"{self.n_tokens} generated tokens in "
+            f"{self.prefill_time + self.decode_time:.1f}s "
+            f"({self.tokens_per_s:.1f} tokens/s, "
+            f"{self.decode_tokens_per_s:.1f} tokens/s after the first) "
+            f"over {self.n_generations} generations"
+        )
+
+
+class ThroughputMeter(StoppingCriteria):
+    """
+    Time the steps of `generate` and count the tokens they add, never stops.
+
+    The first step ends the prefill. With `assisted` generation, the stopping
+    criteria are also called on the proposed tokens, these calls are skipped
+    (as in `src.models.speculative.TokenCounter`). Rows of a batch that have
+    already finished are still counted.
+    """
+
+    def __init__(
+        self,
+        stats: ThroughputStats,
+        prompt_len: int,
+        n_prompt_tokens: int,
+        assisted=False,
+    ):
+        self.stats = stats
+        self.length = prompt_len
+        self.n_prompt_tokens = n_prompt_tokens
+        self.assisted = assisted
+        self.proposal = assisted
+        self.prefilled = False
+        self.last = time.perf_counter()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.proposal:
+            self.proposal = False
+        else:
+            now = time.perf_counter()
+            n_rows, length = input_ids.shape
+            n_new = (length - self.length) * n_rows
+            self.stats.n_tokens += n_new
+            if self.prefilled:
+                self.stats.n_decoded += n_new
+                self.stats.decode_time += now - self.last
+            else:
+                self.stats.n_prompt_tokens += self.n_prompt_tokens
+                self.stats.prefill_time += now - self.last
+                self.prefilled = True
+            self.length = length
+            self.last = now
+            self.proposal = self.assisted
+        return torch.zeros(
+            input_ids.shape[0], dtype=torch.bool, device=input_ids.device
+        )
@@ -1,5 +1,8 @@
 import re
 
+# Only capture the first timestamp (hh:mm:ss) and ignore the second.
+CHAPTER_PATTERN = re.compile(r"(\d{2}:[0-5]\d:[0-5]\d)\b")
+
 
 def extract_chapters(output: str | list[str]):
     """
@@ -13,30 +16,37 @@ def extract_chapters(output: str | list[str]):
         dict: A dictionary of extracted chapters with timestamps as keys and titles as values.
     """
 
-    # Only capture the first timestamp (hh:mm:ss) and ignore the second.
-    pattern = r"(\d{2}:[0-5]\d:[0-5]\d)\b"
     chapters = {}
 
     if isinstance(output, str):
         output = output.split("\n")
 
     for line in output:
-        if len(line) == 0:
-            continue
-
-        match = re.search(pattern, line)
-        if match:
-            time = match.group(1)
-            # Strip any additional timestamp or text following it
-            title = re.sub(pattern, "", line).strip()
-            title = title.lstrip(" -:")  # Remove leading dash, colon, or space
-            title = title.strip()
-            if len(title) > 0:
-                chapters[time] = title
+        chapter = parse_chapter_line(line)
+        if chapter is not None:
+            time, title = chapter
+            chapters[time] = title
 
     return chapters
 
 
+def parse_chapter_line(line: str):
+    """Parse one "hh:mm:ss - Title" line, returns `(time, title)` or None."""
+    if len(line) == 0:
+        return None
+
+    match = re.search(CHAPTER_PATTERN, line)
+    if match:
+        time = match.group(1)
+        # Strip any additional timestamp or text following it
+        title = re.sub(CHAPTER_PATTERN, "", line).strip()
+        title = title.lstrip(" -:")  # Remove leading dash, colon, or space
+        title = title.strip()
+        if len(title) > 0:
+            return time, title
+    return None
+
+
 def filter_chapters(chapters: dict, vid_duration: str | None = None):
     if vid_duration:
         filter_chapters = {}
@@ -62,6 +72,70 @@ def filter_chapters(chapters: dict, vid_duration: str | None = None):
     return chapters
 
 
+class ChapterStream:
+    """
+    Incremental `extract_chapters` + `filter_chapters` over streamed text.
+
+    `feed` takes the text as it is generated and returns the chapters whose
+    line has been completed (by a newline), `close` parses the last line.
+    The returned chapters are a preview: they are within the video duration
+    and after the previous returned chapter, and a first chapter at 00:00:00
+    is held back until a second one arrives. Later lines can still change
+    the result (e.g. an out of order chapter, or a repeated timestamp whose
+    last title is kept), so only `chapters`, which is
+    `filter_chapters(extract_chapters(text), vid_duration)`, is final.
+    """
+
+    def __init__(self, vid_duration: str | None = None):
+        self.vid_duration = vid_duration
+        self.lines = []
+        self.buffer = ""
+        self.last_time = None
+        self.held = None
+        self.closed = False
+
+    def feed(self, text: str):
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        return self._parse(lines)
+
+    def close(self):
+        lines, self.buffer = [self.buffer], ""
+        self.closed = True
+        return self._parse(lines)
+
+    @property
+    def text(self):
+        return "\n".join(self.lines if self.closed else [*self.lines, self.buffer])
+
+    @property
+    def chapters(self):
+        return filter_chapters(extract_chapters(self.lines), self.vid_duration)
+
+    def _parse(self, lines):
+        new_chapters = []
+        for line in lines:
+            self.lines.append(line)
+            chapter = parse_chapter_line(line)
+            if chapter is None:
+                continue
+            time, title = chapter
+            if self.vid_duration and time > self.vid_duration:
+                continue
+            if self.last_time is None and time == "00:00:00":
+                # A single chapter at 00:00:00 is not kept by `filter_chapters`
+                self.held = chapter
+                continue
+            if self.last_time is not None and time <= self.last_time:
+                continue
+            if self.held is not None:
+                new_chapters.append(self.held)
+                self.held = None
+            new_chapters.append(chapter)
+            self.last_time = time
+        return new_chapters
+
+
 if __name__ == "__main__":
     # Example usage
     text = """
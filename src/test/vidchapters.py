@@ -2,13 +2,30 @@ from pathlib import Path
 
 from lutils import writef
 from tqdm import tqdm
+from transformers import LogitsProcessorList
 
-from src.test.utils_chapters import extract_chapters, filter_chapters
+from src.models.chapter_grammar import chapter_processor
+from src.models.llama_inference import encode_prompt
+from src.test.utils_chapters import ChapterStream, extract_chapters, filter_chapters
 from src.utils import RankedLogger
 
 log = RankedLogger(__name__, rank_zero_only=True)
 
 
+def constraint_kwargs(
+    inference, prompt, vid_duration, constrained, transcript_timestamps=False
+):
+    """Generation kwargs of the constrained decoding of the chapters (if enabled)."""
+    if not constrained:
+        return {}
+    if transcript_timestamps and not isinstance(prompt, str):
+        prompt = inference.tokenizer.decode(prompt)
+    processor = chapter_processor(
+        inference.tokenizer, prompt, vid_duration, transcript_timestamps
+    )
+    return {"logits_processor": LogitsProcessorList([processor])}
+
+
 def get_chapters(
     inference,
     prompt,
@@ -17,13 +34,31 @@ def get_chapters(
     vid_duration=None,
     use_cache=True,
     vid_id="",
+    constrained=False,
+    transcript_timestamps=False,
+    **kwargs,
 ):
+    """
+    Generate and parse the chapters of a prompt (text, or token ids for
+    `LlamaInference`), returns `(output_text, chapters)`.
+
+    If no chapters are found with greedy decoding, the generation is done
+    again with sampling. With `constrained`, the output format is enforced
+    during decoding (see `src.models.chapter_grammar`), so it always parses
+    and there is no retry. `transcript_timestamps` also restricts the
+    chapters to the timestamps of the transcript. Other kwargs are passed to
+    `inference` (e.g. `prefill_chunk_size`).
+    """
     output_text = inference(
         prompt=prompt,
         max_new_tokens=max_new_tokens,
         add_special_tokens=True,
         do_sample=do_sample,
         use_cache=use_cache,
+        **constraint_kwargs(
+            inference, prompt, vid_duration, constrained, transcript_timestamps
+        ),
+        **kwargs,
     )
 
     if isinstance(output_text, int):
@@ -33,7 +68,7 @@ def get_chapters(
     chapters = extract_chapters(output_text)
     chapters = filter_chapters(chapters, vid_duration=vid_duration)
 
-    if not chapters and not do_sample:
+    if not chapters and not do_sample and not constrained:
         log.info(f"No chapters found for {vid_id}, trying again with sampling")
         return get_chapters(
             inference,
@@ -41,16 +76,251 @@ def get_chapters(
             max_new_tokens,
             do_sample=True,
             vid_duration=vid_duration,
+            **kwargs,
         )
 
     return output_text, chapters
 
 
+def get_chapters_adaptive(
+    inference,
+    prompt,
+    transcript,
+    max_new_tokens,
+    do_sample=False,
+    vid_duration=None,
+    vid_id="",
+    constrained=False,
+    transcript_timestamps=False,
+    skip=(),
+):
+    """
+    `get_chapters` that does not give up on a video because of its length.
+
+    The strategies planned by the `memory_policy` of `inference` (see
+    `src.models.memory_policy`) are tried in order until one does not run
+    out of memory (for the windows, on any of them): a single pass, chunked
+    prefill, then windows of the transcript of decreasing size (as in
+    `src.test.vidchapters_window`).
+    Strategies named in `skip` are not tried (e.g. "single" if it already
+    failed). Without a memory policy, this is `get_chapters` on the whole
+    prompt. Otherwise, the transcript is tokenized once (`WindowIndex`) and
+    all the strategies get token ids.
+    """
+    # vidchapters_window builds on this module
+    from src.test.vidchapters_window import WindowIndex
+    from src.test.vidchapters_window import get_chapters as get_window_chapters
+
+    chapters_kwargs = {
+        "do_sample": do_sample,
+        "vid_duration": vid_duration,
+        "constrained": constrained,
+        "transcript_timestamps": transcript_timestamps,
+    }
+    policy = getattr(inference, "memory_policy", None)
+    if policy is None:
+        return get_chapters(
+            inference,
+            prompt + transcript,
+            max_new_tokens,
+            vid_id=vid_id,
+            **chapters_kwargs,
+        )
+
+    tokenizer = inference.tokenizer
+    index = WindowIndex(transcript, tokenizer)
+    transcript_ids = index.transcript_ids()
+    input_ids = tokenizer(prompt, add_special_tokens=False)["input_ids"]
+    input_ids += transcript_ids
+    n_tokens = len(encode_prompt(tokenizer, input_ids))
+    n_prompt_tokens = n_tokens - len(transcript_ids)
+    strategies = policy.plan(n_tokens, max_new_tokens, n_prompt_tokens)
+    for strategy in strategies:
+        if strategy.name in skip:
+            continue
+        if strategy.name == "window":
+            output_texts, chapters = get_window_chapters(
+                inference,
+                prompt,
+                transcript,
+                max_new_tokens,
+                window_token_size=strategy.size,
+                index=index,
+                require_end=True,
+                **chapters_kwargs,
+            )
+            # Only the windows that went through the whole transcript
+            if chapters:
+                output_text = (
+                    output_texts[0] if len(output_texts) == 1 else output_texts
+                )
+                return output_text, chapters
+        else:
+            output_text, chapters = get_chapters(
+                inference,
+                input_ids,
+                max_new_tokens,
+                vid_id=vid_id,
+                prefill_chunk_size=strategy.size,
+                **chapters_kwargs,
+            )
+            if not isinstance(output_text, int):
+                return output_text, chapters
+        log.info(f"{vid_id} ({n_tokens} tokens) failed with {strategy}")
+
+    # As `get_chapters` for a prompt that is too long
+    return n_tokens, None
+
+
+def stream_chapters(
+    inference,
+    prompt,
+    max_new_tokens,
+    do_sample=False,
+    vid_duration=None,
+    use_cache=True,
+    vid_id="",
+    constrained=False,
+    transcript_timestamps=False,
+    **kwargs,
+):
+    """
+    Streaming `get_chapters`: yields each `(timestamp, title)` as soon as its
+    line is generated, and returns `(output_text, chapters)` as `get_chapters`
+    does (use `yield from` to get it).
+
+    `inference` needs a `stream` method (`LlamaInference`, `LlamaScheduler`).
+    The yielded chapters are a preview (see `ChapterStream`), only the
+    returned ones are final. If no chapters are kept, the generation is done
+    again with sampling as in `get_chapters`: `None` is yielded first, and
+    the chapters yielded before it are to be discarded. Other kwargs are
+    passed to `inference.stream` (e.g. `adapter`).
+    """
+    parser = ChapterStream(vid_duration=vid_duration)
+    for chunk in inference.stream(
+        prompt=prompt,
+        max_new_tokens=max_new_tokens,
+        add_special_tokens=True,
+        do_sample=do_sample,
+        use_cache=use_cache,
+        **constraint_kwargs(
+            inference, prompt, vid_duration, constrained, transcript_timestamps
+        ),
+        **kwargs,
+    ):
+        if isinstance(chunk, int):
+            # the input is too long, return the length of the input
+            return chunk, None
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+    chapters = parser.chapters
+    if not chapters and not do_sample and not constrained:
+        log.info(f"No chapters found for {vid_id}, trying again with sampling")
+        # The chapters yielded so far are not part of the result
+        yield None
+        return (
+            yield from stream_chapters(
+                inference,
+                prompt,
+                max_new_tokens,
+                do_sample=True,
+                vid_duration=vid_duration,
+                use_cache=use_cache,
+                vid_id=vid_id,
+                constrained=constrained,
+                transcript_timestamps=transcript_timestamps,
+                **kwargs,
+            )
+        )
+
+    return parser.text.strip(), chapters
+
+
+def get_chapters_batch(
+    inference,
+    prompts,
+    max_new_tokens,
+    do_sample=False,
+    vid_durations=None,
+    vid_ids=None,
+    batch_size=8,
+    max_batch_tokens=None,
+    constrained=False,
+    transcript_timestamps=False,
+):
+    """Batched `get_chapters`: one `(output_text, chapters)` pair per prompt."""
+    vid_durations = vid_durations or [None] * len(prompts)
+    vid_ids = vid_ids or [""] * len(prompts)
+    logits_processors = None
+    if constrained:
+        logits_processors = [
+            chapter_processor(
+                inference.tokenizer, prompt, vid_duration, transcript_timestamps
+            )
+            for prompt, vid_duration in zip(prompts, vid_durations)
+        ]
+    output_texts = inference.generate_batch(
+        prompts,
+        batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+        max_new_tokens=max_new_tokens,
+        add_special_tokens=True,
+        do_sample=do_sample,
+        use_cache=True,
+        logits_processors=logits_processors,
+    )
+
+    results = []
+    for prompt, output_text, vid_duration, vid_id in zip(
+        prompts, output_texts, vid_durations, vid_ids
+    ):
+        if isinstance(output_text, int):
+            # the input is too long, return the length of the input
+            results.append((output_text, None))
+            continue
+
+        chapters = extract_chapters(output_text)
+        chapters = filter_chapters(chapters, vid_duration=vid_duration)
+        if not chapters and not do_sample and not constrained:
+            log.info(f"No chapters found for {vid_id}, trying again with sampling")
+            results.append(
+                get_chapters(
+                    inference,
+                    prompt,
+                    max_new_tokens,
+                    do_sample=True,
+                    vid_duration=vid_duration,
+                )
+            )
+            continue
+        results.append((output_text, chapters))
+    return results
+
+
 class VidChaptersTester:
-    def __init__(self, save_dir: str, do_sample=False, **kwargs):
+    # Number of batches worth of videos gathered before bucketing them by length
+    POOL_BATCHES = 4
+
+    def __init__(
+        self,
+        save_dir: str,
+        do_sample=False,
+        batch_size: int = 1,
+        max_batch_tokens: int = None,
+        constrained: bool = False,
+        transcript_timestamps: bool = False,
+        adaptive: bool = True,
+        **kwargs,
+    ):
         self.save_dir = Path(save_dir)
         self.save_dir.mkdir(exist_ok=True)
         self.do_sample = do_sample
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.constrained = constrained
+        self.transcript_timestamps = transcript_timestamps
+        self.adaptive = adaptive
 
     def __call__(
         self,
@@ -63,12 +333,12 @@ class VidChaptersTester:
             desc="Evaluating chapters",
         )
 
+        pending = []
         for batch in test_dataloader:
             vid_id = batch["vid_id"][0]
             prompt = batch["prompt"][0]
             transcript = batch["transcript"][0]
             vid_duration = batch["vid_duration"][0]
-            prompt += transcript
 
             chapters_pth = self.save_dir / f"{vid_id[:2]}" / f"{vid_id}.json"
             chapters_pth.parent.mkdir(exist_ok=True)
@@ -77,31 +347,88 @@ class VidChaptersTester:
                 pbar.update(1)
                 continue
 
-            pbar.set_description(f"vid_id: {vid_id}")
-
-            output_text, chapters = get_chapters(
-                inference,
-                prompt,
-                max_new_tokens,
-                do_sample=self.do_sample,
-                vid_duration=vid_duration,
-                vid_id=vid_id,
-            )
-
-            if chapters is None:
-                log.info(f"Input too long for {vid_id}, {output_text} tokens")
-                error_pth = chapters_pth.with_suffix(".txt")
-                writef(error_pth, [output_text])
-                pbar.update(1)
+            if self.batch_size > 1:
+                pending.append((vid_id, prompt, transcript, vid_duration, chapters_pth))
+                if len(pending) >= self.batch_size * self.POOL_BATCHES:
+                    self.run_batch(inference, pending, max_new_tokens, pbar)
+                    pending = []
                 continue
 
-            if chapters:
-                vid_data = {
-                    "chapters": chapters,
-                    "output": output_text,
-                }
-                writef(chapters_pth, vid_data)
+            pbar.set_description(f"vid_id: {vid_id}")
 
+            if self.adaptive:
+                output_text, chapters = get_chapters_adaptive(
+                    inference,
+                    prompt,
+                    transcript,
+                    max_new_tokens,
+                    do_sample=self.do_sample,
+                    vid_duration=vid_duration,
+                    vid_id=vid_id,
+                    constrained=self.constrained,
+                    transcript_timestamps=self.transcript_timestamps,
+                )
+            else:
+                output_text, chapters = get_chapters(
+                    inference,
+                    prompt + transcript,
+                    max_new_tokens,
+                    do_sample=self.do_sample,
+                    vid_duration=vid_duration,
+                    vid_id=vid_id,
+                    constrained=self.constrained,
+                    transcript_timestamps=self.transcript_timestamps,
+                )
+            self.save_chapters(vid_id, chapters_pth, output_text, chapters)
             pbar.update(1)
 
+        if pending:
+            self.run_batch(inference, pending, max_new_tokens, pbar)
         pbar.close()
+
+    def run_batch(self, inference, pending, max_new_tokens, pbar):
+        vid_ids, prompts, transcripts, vid_durations, chapters_pths = zip(*pending)
+        pbar.set_description(f"batch of {len(vid_ids)} videos")
+        results = get_chapters_batch(
+            inference,
+            [prompt + transcript for prompt, transcript in zip(prompts, transcripts)],
+            max_new_tokens,
+            do_sample=self.do_sample,
+            vid_durations=list(vid_durations),
+            vid_ids=list(vid_ids),
+            batch_size=self.batch_size,
+            max_batch_tokens=self.max_batch_tokens,
+            constrained=self.constrained,
+            transcript_timestamps=self.transcript_timestamps,
+        )
+        for i, (output_text, chapters) in enumerate(results):
+            if chapters is None and self.adaptive:
+                # Too long or out of memory on its own: a single pass failed
+                output_text, chapters = get_chapters_adaptive(
+                    inference,
+                    prompts[i],
+                    transcripts[i],
+                    max_new_tokens,
+                    do_sample=self.do_sample,
+                    vid_duration=vid_durations[i],
+                    vid_id=vid_ids[i],
+                    constrained=self.constrained,
+                    transcript_timestamps=self.transcript_timestamps,
+                    skip=("single",),
+                )
+            self.save_chapters(vid_ids[i], chapters_pths[i], output_text, chapters)
+            pbar.update(1)
+
+    def save_chapters(self, vid_id, chapters_pth, output_text, chapters):
+        if chapters is None:
+            log.info(f"Input too long for {vid_id}, {output_text} tokens")
+            error_pth = chapters_pth.with_suffix(".txt")
+            writef(error_pth, [output_text])
+            return
+
+        if chapters:
+            vid_data = {
+                "chapters": chapters,
+                "output": output_text,
+            }
+            writef(chapters_pth, vid_data)
@@ -2,22 +2,206 @@ import re
 import shutil
 from pathlib import Path
 
+import numpy as np
 from lutils import writef
 from tqdm import tqdm
 
-from src.data.chapters import hms_to_sec, sec_to_hms
+from src.data.timestamps import hms_to_sec, sec_to_hms
 from src.test.vidchapters import get_chapters as get_window_chapters
 from src.utils import RankedLogger
 
 log = RankedLogger(__name__, rank_zero_only=True)
 
 
+TIMESTAMP_PATTERN = re.compile(r"(\d{2}:[0-5]\d:[0-5]\d)\b")
+
+
+class WindowIndex:
+    """
+    Token index of a transcript, to cut windows without re-tokenizing it.
+
+    All the lines are tokenized once (in a single batch), in parts around
+    their timestamps. The token ids of a window are then concatenated from
+    those of its lines, with the (cached) ids of the shifted timestamps, and
+    those of the whole transcript from all the lines. This is the
+    tokenization of the text as long as tokens do not span a timestamp or a
+    newline, as with the Llama 3 tokenizer, which splits digits from the
+    rest. Per-line token counts and timestamps are kept as numpy arrays with
+    a prefix sum of the token counts, so finding the window that starts at
+    `t` with a budget of `B` tokens is a binary search.
+    """
+
+    def __init__(self, transcript: str, tokenizer):
+        self.transcript = transcript
+        self.tokenizer = tokenizer
+
+        self.lines = [line.strip() for line in transcript.split("\n") if line.strip()]
+        # Lines split around their timestamps, to shift them when rendering
+        self.parts = [TIMESTAMP_PATTERN.split(line) for line in self.lines]
+        timestamps = [
+            hms_to_sec(parts[1]) if len(parts) > 1 else -1 for parts in self.parts
+        ]
+        self.timestamps = np.array(timestamps, dtype=np.int64)
+        self.has_timestamp = self.timestamps >= 0
+
+        # Every part of every line, the last one with the newline ending the line
+        texts = [
+            text for parts in self.parts for text in parts[:-1] + [parts[-1] + "\n"]
+        ]
+        encoded = iter(
+            tokenizer(texts, add_special_tokens=False)["input_ids"] if texts else []
+        )
+        self.part_ids = [[next(encoded) for _ in parts] for parts in self.parts]
+        self.newline_ids = tokenizer("\n", add_special_tokens=False)["input_ids"]
+        self._timestamp_ids = {
+            timestamp: ids
+            for parts, part_ids in zip(self.parts, self.part_ids)
+            for timestamp, ids in zip(parts[1::2], part_ids[1::2])
+        }
+        self._transcript_ids = None
+
+        # Tokens of each line tokenized on its own, with the special tokens
+        n_special = len(tokenizer("")["input_ids"])
+        line_tokens = np.zeros(len(self.lines), dtype=np.int64)
+        for i in range(len(self.lines)):
+            ids = self.line_ids(i)
+            if self.ends_with_newline(ids):
+                ids = ids[: -len(self.newline_ids)]
+            line_tokens[i] = n_special + len(ids)
+        # Lines without a timestamp are skipped, so they do not count
+        line_tokens[~self.has_timestamp] = 0
+        self.token_prefix = np.zeros(len(self.lines) + 1, dtype=np.int64)
+        np.cumsum(line_tokens, out=self.token_prefix[1:])
+
+        self.timed_lines = np.flatnonzero(self.has_timestamp)
+        self.sorted_timestamps = self.timestamps[self.timed_lines]
+        ts = self.sorted_timestamps
+        self.is_sorted = bool(np.all(ts[1:] >= ts[:-1]))
+
+        self.n_tokens = n_special + len(self.transcript_ids())
+
+    def ends_with_newline(self, input_ids):
+        return input_ids[-len(self.newline_ids) :] == self.newline_ids
+
+    def timestamp_ids(self, timestamp: str):
+        if timestamp not in self._timestamp_ids:
+            self._timestamp_ids[timestamp] = self.tokenizer(
+                timestamp, add_special_tokens=False
+            )["input_ids"]
+        return self._timestamp_ids[timestamp]
+
+    def line_text(self, i, timestamp=None):
+        """Line `i`, with its timestamps replaced by `timestamp` (if any)."""
+        if timestamp is None:
+            return self.lines[i]
+        return timestamp.join(self.parts[i][::2])
+
+    def line_ids(self, i, timestamp=None):
+        """Token ids of `line_text(i, timestamp)` followed by a newline."""
+        part_ids = self.part_ids[i]
+        if timestamp is None:
+            return [token_id for ids in part_ids for token_id in ids]
+        timestamp_ids = self.timestamp_ids(timestamp)
+        input_ids = list(part_ids[0])
+        for ids in part_ids[2::2]:
+            input_ids += timestamp_ids + ids
+        return input_ids
+
+    def join_ids(self, lines, timestamps, trailing_newline=False):
+        """Token ids of the `lines` (with their `timestamps`) joined by newlines."""
+        input_ids = []
+        for i, timestamp in zip(lines, timestamps):
+            input_ids += self.line_ids(i, timestamp)
+        if not lines or trailing_newline:
+            return input_ids
+        if self.ends_with_newline(input_ids):
+            return input_ids[: -len(self.newline_ids)]
+        # The newline is merged with the end of the last line
+        del input_ids[-len(self.line_ids(lines[-1], timestamps[-1])) :]
+        text = self.line_text(lines[-1], timestamps[-1])
+        return input_ids + self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def transcript_ids(self):
+        """Token ids of the whole transcript, without special tokens."""
+        if self._transcript_ids is None:
+            lines = list(range(len(self.lines)))
+            text = "\n".join(self.lines)
+            if self.transcript in (text, text + "\n"):
+                self._transcript_ids = self.join_ids(
+                    lines,
+                    [None] * len(lines),
+                    trailing_newline=self.transcript.endswith("\n"),
+                )
+            else:
+                # Not made of its stripped lines (e.g. blank lines)
+                self._transcript_ids = self.tokenizer(
+                    self.transcript, add_special_tokens=False
+                )["input_ids"]
+        return self._transcript_ids
+
+    def select(self, start_time, window_token_size):
+        """Lines of the window starting at `start_time` (s), and `reached_end`."""
+        n_lines = len(self.lines)
+        if self.is_sorted:
+            # Lines with timestamps are ordered: the window is a contiguous range
+            k = int(np.searchsorted(self.sorted_timestamps, start_time))
+            first = self.timed_lines[k] if k < len(self.timed_lines) else n_lines
+            budget = self.token_prefix[first] + window_token_size
+            stop = int(np.searchsorted(self.token_prefix[1:], budget, side="right"))
+            in_window = np.zeros(n_lines, dtype=bool)
+            in_window[first:stop] = True
+            in_window &= self.has_timestamp
+        else:
+            eligible = self.has_timestamp & (self.timestamps >= start_time)
+            tokens = np.cumsum(np.diff(self.token_prefix) * eligible)
+            stop = int(np.searchsorted(tokens, window_token_size, side="right"))
+            in_window = eligible.copy()
+            in_window[stop:] = False
+        # The last line is reached either by going through it or breaking on it
+        reached_end = n_lines > 0 and stop >= n_lines - 1
+        return np.flatnonzero(in_window).tolist(), reached_end
+
+    def get_window(self, prompt: str, start_time=0, window_token_size=35_000):
+        """Same as `get_window`, for the indexed transcript."""
+        return self._get_window(prompt, start_time, window_token_size, ids=False)
+
+    def get_window_ids(self, prompt: str, start_time=0, window_token_size=35_000):
+        """`get_window` with the token ids of the window instead of its text."""
+        return self._get_window(prompt, start_time, window_token_size, ids=True)
+
+    def _get_window(self, prompt, start_time, window_token_size, ids):
+        # check transcript size, if it fits, return the whole transcript
+        if self.n_tokens <= window_token_size:
+            return prompt, self.transcript_ids() if ids else self.transcript, True
+
+        start_time = hms_to_sec(start_time)
+        window, reached_end = self.select(start_time, window_token_size)
+        if not window:
+            return None, None, reached_end
+
+        timestamps = [sec_to_hms(int(self.timestamps[i]) - start_time) for i in window]
+        if ids:
+            windowed_transcript = self.join_ids(window, timestamps)
+        else:
+            windowed_transcript = "\n".join(
+                self.line_text(i, timestamp) for i, timestamp in zip(window, timestamps)
+            )
+
+        last_timestamp = int(self.timestamps[window[-1]])
+        duration = sec_to_hms(last_timestamp - start_time)
+        # Change the duration of the video in the prompt
+        prompt = TIMESTAMP_PATTERN.sub(duration, prompt)
+
+        return prompt, windowed_transcript, reached_end
+
+
 def get_window(
     prompt: str,
     transcript: str,
     tokenizer,
     start_time: float = 0,
     window_token_size: int = 35_000,
+    index: WindowIndex = None,
 ):
     """
     Get a window of the transcript starting from start_time.
@@ -25,60 +209,17 @@ def get_window(
     Args:
         transcript: The full transcript text
         start_time: Start time in seconds to begin the window
+        index: Pre-built `WindowIndex` of the transcript (built if None)
 
     Returns:
         Tuple of (windowed_transcript, duration_str, reached_end)
         Returns (None, None, False) if no valid window can be created
     """
-    pattern = r"(\d{2}:[0-5]\d:[0-5]\d)\b"
-
-    # check transcript size, if it fits, return the whole transcript
-    if len(tokenizer.encode(transcript)) <= window_token_size:
-        return prompt, transcript, True
-
-    window_lines = []
-    n_tokens = 0
-    last_timestamp = None
-    reached_end = False
-    start_time = hms_to_sec(start_time)
-
-    lines = [line.strip() for line in transcript.split("\n") if line.strip()]
-    for i, line in enumerate(lines):
-        # Check if we've reached the last line
-        if i == len(lines) - 1:
-            reached_end = True
-
-        match = re.search(pattern, line)
-        if not match:
-            # Skip lines that don't have a timestamp
-            continue
-
-        line_timestamp = hms_to_sec(match.group(1))
-
-        # Skip lines before start_time
-        if line_timestamp < start_time:
-            continue
-
-        # Count tokens in this line
-        n_tokens += len(tokenizer.encode(line))
-        if n_tokens > window_token_size:
-            break
-
-        shifted_timestamp = sec_to_hms(line_timestamp - start_time)
-        line = re.sub(pattern, shifted_timestamp, line)
-        window_lines.append(line)
-        last_timestamp = line_timestamp
-
-    # If we couldn't create a valid window
-    if not window_lines or last_timestamp is None:
-        return None, None, reached_end
-
-    windowed_transcript = "\n".join(window_lines)
-    duration = sec_to_hms(last_timestamp - start_time)
-    # Change the duration of the video in the prompt
-    prompt = re.sub(pattern, duration, prompt)
-
-    return prompt, windowed_transcript, reached_end
+    if index is None:
+        index = WindowIndex(transcript, tokenizer)
+    return index.get_window(
+        prompt, start_time=start_time, window_token_size=window_token_size
+    )
 
 
 def get_chapters(
@@ -90,32 +231,56 @@ def get_chapters(
     vid_duration=None,
     window_token_size=35_000,
     first_window_only=False,
+    constrained=False,
+    transcript_timestamps=False,
+    index: WindowIndex = None,
+    require_end=False,
 ):
+    """
+    Generate the chapters of a transcript window by window, returns
+    `(output_texts, chapters)` with the chapters of all the windows merged.
+
+    The windows are given to `inference` as token ids, cut from `index` (the
+    `WindowIndex` of the transcript, built if None): the transcript is only
+    tokenized once.
+
+    By default, the chapters of the windows before a failure (a window that
+    is too long) are returned. With `require_end`, the result is
+    `(n_tokens, None)` if a window is too long, as for `get_chapters`, and
+    `(output_texts, None)` if the windows did not reach the end.
+    """
     all_chapters = {}
     all_output_texts = []
     start_time = 0
+    reached_end = False
     n_allowed_tries = 1 if first_window_only else 1_000_000 // window_token_size
+    # Tokenize the transcript once for all the windows
+    if index is None:
+        index = WindowIndex(transcript, inference.tokenizer)
 
     for _ in range(n_allowed_tries):
         # Get transcript window starting from start_time
-        w_prompt, w_transcript, reached_end = get_window(
-            prompt=prompt,
-            transcript=transcript,
-            tokenizer=inference.tokenizer,
-            start_time=start_time,
-            window_token_size=window_token_size,
+        w_prompt, w_ids, reached_end = index.get_window_ids(
+            prompt, start_time=start_time, window_token_size=window_token_size
         )
 
-        if not w_transcript:
+        if not w_ids:
             break
+        prompt_ids = inference.tokenizer(w_prompt, add_special_tokens=False)
+        prompt_ids = prompt_ids["input_ids"] + w_ids
 
-        # Get chapters for this window
+        # Get chapters for this window, whose times start at `start_time`
+        w_duration = vid_duration
+        if vid_duration and start_time:
+            w_duration = sec_to_hms(max(hms_to_sec(vid_duration) - start_time, 0))
         output_text, chapters = get_window_chapters(
             inference=inference,
-            prompt=w_prompt + w_transcript,
+            prompt=prompt_ids,
             max_new_tokens=max_new_tokens,
             do_sample=do_sample,
-            vid_duration=vid_duration,
+            vid_duration=w_duration,
+            constrained=constrained,
+            transcript_timestamps=transcript_timestamps,
         )
         if chapters and start_time:
             chapters = {
@@ -124,6 +289,8 @@ def get_chapters(
 
         # If we got back a number instead of text, the input was too long
         if isinstance(output_text, int):
+            if require_end:
+                return output_text, None
             break
 
         if chapters:
@@ -141,12 +308,20 @@ def get_chapters(
         timestamps = [hms_to_sec(k) for k in chapters]
         start_time = max(timestamps) if timestamps else 0
 
+    if require_end and not reached_end:
+        return all_output_texts, None
     return all_output_texts, all_chapters if all_chapters else None
 
 
 class VidChaptersTesterWindow:
     def __init__(
-        self, save_dir: str, window_token_size=35_000, first_window_only=False, **kwargs
+        self,
+        save_dir: str,
+        window_token_size=35_000,
+        first_window_only=False,
+        constrained=False,
+        transcript_timestamps=False,
+        **kwargs,
     ):
         if "window" not in save_dir:
             save_dir = f"{save_dir}_window{window_token_size}"
@@ -156,6 +331,8 @@ class VidChaptersTesterWindow:
         self.save_dir.mkdir(exist_ok=True)
         self.window_token_size = window_token_size
         self.first_window_only = first_window_only
+        self.constrained = constrained
+        self.transcript_timestamps = transcript_timestamps
 
     def __call__(
         self,
@@ -190,6 +367,8 @@ class VidChaptersTesterWindow:
                 vid_duration=vid_duration,
                 window_token_size=self.window_token_size,
                 first_window_only=self.first_window_only,
+                constrained=self.constrained,
+                transcript_timestamps=self.transcript_timestamps,
             )
 
             if chapters:
@@ -27,7 +27,12 @@ def test(cfg: DictConfig):
     if cfg.get("seed"):
         seed_everything(cfg.seed, workers=True)
 
-    fabric = Fabric(accelerator="gpu", strategy="ddp", devices="auto", num_nodes=1)
+    # CPU nodes with model.config_inference.device=cpu (src/models/cpu_inference.py)
+    on_cpu = cfg.model.config_inference.get("device") == "cpu"
+    accelerator = "cpu" if on_cpu else "gpu"
+    fabric = Fabric(
+        accelerator=accelerator, strategy="ddp", devices="auto", num_nodes=1
+    )
     fabric.launch()
 
     # Most likely src.models.llama_inference.LlamaInference
@@ -60,6 +65,13 @@ def test(cfg: DictConfig):
         # Wait for all GPUs to finish
         fabric.barrier()
 
+        speculative_stats = getattr(inference, "speculative_stats", None)
+        if speculative_stats is not None:
+            log.info(f"Speculative decoding: {speculative_stats}")
+        throughput = getattr(inference, "throughput", None)
+        if throughput is not None:
+            log.info(f"Throughput: {throughput}")
+
     log.info("Done testing!")
 
 
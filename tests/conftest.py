@@ -0,0 +1,51 @@
+"""This file prepares the fixtures of the tests (tiny random checkpoints)."""
+
+import pytest
+import torch
+from lightning_utilities.core.rank_zero import rank_zero_only
+from peft import LoraConfig, get_peft_model
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from tests.helpers.tiny_llama import make_tokenizer
+
+# `RankedLogger` needs the rank, set by Lightning in the training scripts
+rank_zero_only.rank = 0
+
+
+@pytest.fixture(scope="session")
+def tiny_llama(tmp_path_factory):
+    """Directory of a tiny random Llama (float32) and its tokenizer."""
+    path = tmp_path_factory.mktemp("tiny_llama")
+    tokenizer = make_tokenizer()
+    tokenizer.save_pretrained(path)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        tie_word_embeddings=False,
+    )
+    torch.manual_seed(0)
+    LlamaForCausalLM(config).save_pretrained(path)
+    return path
+
+
+@pytest.fixture(scope="session")
+def tiny_lora(tiny_llama, tmp_path_factory):
+    """Directory of a random (non-zero) LoRA of `tiny_llama`."""
+    path = tmp_path_factory.mktemp("tiny_lora")
+    torch.manual_seed(1)
+    model = LlamaForCausalLM.from_pretrained(tiny_llama)
+    config = LoraConfig(
+        r=4,
+        lora_alpha=64,
+        target_modules=["q_proj", "v_proj"],
+        init_lora_weights=False,
+    )
+    get_peft_model(model, config).save_pretrained(path)
+    return path
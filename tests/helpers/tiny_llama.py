@@ -0,0 +1,96 @@
+"""Tiny random Llama checkpoints, to run the inference code on CPU."""
+
+import json
+import random
+
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from tokenizers.processors import TemplateProcessing
+from transformers import PreTrainedTokenizerFast
+
+SPECIAL_TOKENS = [
+    "<|begin_of_text|>",
+    "<|end_of_text|>",
+    "<|start_header_id|>",
+    "<|end_header_id|>",
+    "<|eot_id|>",
+    "<|reserved_special_token_0|>",
+]
+WORDS = [
+    "introduction",
+    "chapter",
+    "video",
+    "cooking",
+    "recipe",
+    "review",
+    "final",
+    "thoughts",
+    "setup",
+    "build",
+    "test",
+    "part",
+    "conclusion",
+    "summary",
+    "hello",
+    "welcome",
+    "step",
+    "the",
+    "and",
+    "to",
+]
+
+
+def random_transcript(n_lines, seed=0):
+    """ASR-like "hh:mm:ss: text" lines."""
+    rng = random.Random(seed)
+    seconds = sorted(rng.sample(range(3600), n_lines))
+    return "".join(
+        f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}: "
+        + " ".join(rng.choices(WORDS, k=6))
+        + "\n"
+        for s in seconds
+    )
+
+
+def make_tokenizer():
+    """
+    BPE with the special tokens of the Llama 3 chat template, in the format of
+    the Llama 2 tokenizer (byte fallback), which llama.cpp can convert.
+    """
+    tokenizer = Tokenizer(models.BPE(byte_fallback=True, fuse_unk=True))
+    tokenizer.pre_tokenizer = pre_tokenizers.Metaspace(
+        replacement="\u2581", prepend_scheme="first", split=False
+    )
+    tokenizer.decoder = decoders.Sequence(
+        [
+            decoders.Replace("\u2581", " "),
+            decoders.ByteFallback(),
+            decoders.Fuse(),
+            decoders.Strip(" ", 1, 0),
+        ]
+    )
+    corpus = [random_transcript(50, seed) for seed in range(40)]
+    corpus += [
+        f"{i:02d}:{i:02d}:{i:02d} - {word.title()}" for i, word in enumerate(WORDS)
+    ]
+    trainer = trainers.BpeTrainer(vocab_size=500, special_tokens=SPECIAL_TOKENS)
+    tokenizer.train_from_iterator(corpus, trainer)
+
+    # The <0xXX> tokens of the characters that are not in the vocabulary
+    data = json.loads(tokenizer.to_str())
+    vocab = data["model"]["vocab"]
+    for byte in range(256):
+        vocab.setdefault(f"<0x{byte:02X}>", len(vocab))
+    tokenizer = Tokenizer.from_str(json.dumps(data))
+
+    bos = SPECIAL_TOKENS[0]
+    tokenizer.post_processor = TemplateProcessing(
+        single=f"{bos} $A",
+        pair=f"{bos} $A $B",
+        special_tokens=[(bos, tokenizer.token_to_id(bos))],
+    )
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token=SPECIAL_TOKENS[0],
+        eos_token=SPECIAL_TOKENS[1],
+        additional_special_tokens=SPECIAL_TOKENS[2:],
+    )
@@ -0,0 +1,68 @@
+import pytest
+import torch
+
+from src.models.kv_cache import QUANTIZED_BITS, make_kv_cache
+from src.models.llama_inference import LlamaInference, encode_prompt
+from tests.helpers.tiny_llama import random_transcript
+
+
+@pytest.fixture(scope="module")
+def inference(tiny_llama):
+    return LlamaInference(
+        str(tiny_llama), device="cpu", torch_dtype=torch.float32, max_new_tokens=32
+    )
+
+
+@pytest.mark.parametrize("kv_cache", ["int8", "int4"])
+def test_quantize_round_trip(kv_cache):
+    """The dequantized keys/values are within half a quantization step of
+    their group (up to the float16 scales), about 1e-2 for int8 and 0.24 for
+    int4 on N(0, 1) values."""
+    cache = make_kv_cache(kv_cache, q_group_size=64)
+    torch.manual_seed(0)
+    tensor = torch.randn(2, 4, 100, 128)
+    restored = cache._dequantize(cache._quantize(tensor, axis=0)).float()
+    assert restored.shape == tensor.shape
+
+    groups = tensor.reshape(2, 4, 100, 2, 64)
+    step = (groups.amax(-1) - groups.amin(-1)) / (2 ** QUANTIZED_BITS[kv_cache] - 1)
+    error = (restored - tensor).abs().reshape(2, 4, 100, 2, 64).amax(-1)
+    assert torch.all(error <= step / 2 + 5e-3)
+    assert error.max() < {"int8": 2e-2, "int4": 0.26}[kv_cache]
+
+
+@pytest.mark.parametrize("kv_cache", ["int8", "int4"])
+def test_quantized_cache_logits(inference, kv_cache):
+    """The logits of decoding steps with a quantized cache are close to those
+    with the fp16 one, once the prompt is quantized."""
+    prompt = random_transcript(40, seed=40)
+    input_ids = torch.tensor([encode_prompt(inference.tokenizer, prompt)])
+    next_ids = torch.tensor([[5], [6], [7]])
+    logits = {}
+    for name in ["fp16", kv_cache]:
+        cache = make_kv_cache(name)
+        with torch.no_grad():
+            steps = [inference.model(input_ids, past_key_values=cache).logits[0, -1]]
+            for token_id in next_ids:
+                outputs = inference.model(token_id[None], past_key_values=cache)
+                steps.append(outputs.logits[0, -1])
+        logits[name] = torch.stack(steps)
+    # The prompt went through the quantized part of the cache
+    assert cache._quantized_key_cache[0] is not None
+
+    error = (logits[kv_cache] - logits["fp16"]).abs().max()
+    assert error < {"int8": 5e-3, "int4": 5e-2}[kv_cache]
+
+
+def test_int8_cache_generation(inference):
+    """Greedy decoding with the int8 cache gives the outputs of the fp16 one,
+    with prompts longer than the tokens kept in full precision."""
+    for n_lines in [20, 40]:
+        prompt = random_transcript(n_lines, seed=n_lines)
+        assert len(inference.tokenizer(prompt)["input_ids"]) > 128
+        reference = inference(prompt, kv_cache="fp16")
+
+        cache = make_kv_cache("int8")
+        output = inference(prompt, kv_cache="int8", past_key_values=cache)
+        assert cache._quantized_key_cache[0] is not None
+        assert output == reference
@@ -0,0 +1,53 @@
+import pytest
+import torch
+
+from src.models.gguf_export import export_base, export_lora, find_llama_cpp
+from src.models.llama_cpp_inference import LlamaCppInference
+from src.models.llama_inference import LlamaInference
+from src.test.utils_chapters import extract_chapters
+from tests.helpers.tiny_llama import random_transcript
+
+pytest.importorskip("llama_cpp")
+
+MAX_NEW_TOKENS = 32
+
+
+@pytest.fixture(scope="module")
+def gguf_dir(tiny_llama, tiny_lora, tmp_path_factory):
+    """F16 GGUF exports of the tiny Llama and of its LoRA."""
+    try:
+        llama_cpp_dir = find_llama_cpp()
+    except ValueError as e:
+        pytest.skip(str(e))
+    path = tmp_path_factory.mktemp("gguf")
+    export_base(tiny_llama, path, "F16", llama_cpp_dir=llama_cpp_dir)
+    export_lora(tiny_lora, tiny_llama, path, llama_cpp_dir=llama_cpp_dir)
+    return path
+
+
+@pytest.mark.parametrize("with_lora", [False, True])
+def test_llama_cpp_parity(tiny_llama, tiny_lora, gguf_dir, with_lora):
+    """The llama.cpp engine gives the greedy outputs and chapters of the torch
+    one, for the base model and with the LoRA on top."""
+    peft_model = str(tiny_lora) if with_lora else None
+    torch_engine = LlamaInference(
+        str(tiny_llama),
+        peft_model=peft_model,
+        device="cpu",
+        torch_dtype=torch.float32,
+        max_new_tokens=MAX_NEW_TOKENS,
+    )
+    llama_cpp_engine = LlamaCppInference(
+        str(tiny_llama),
+        peft_model=peft_model,
+        gguf_dir=gguf_dir,
+        gguf_quantization="F16",
+        device="cpu",
+        max_new_tokens=MAX_NEW_TOKENS,
+    )
+    for n_lines in [3, 10, 30]:
+        prompt = "Chapters of the transcript:\n" + random_transcript(n_lines, n_lines)
+        reference = torch_engine(prompt)
+        output = llama_cpp_engine(prompt)
+        assert extract_chapters(output) == extract_chapters(reference)
+        assert output == reference
@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+import torch
+
+from src.models.llama_inference import LlamaInference, TokenIterator
+from src.models.llama_scheduler import LlamaScheduler
+from tests.helpers.tiny_llama import random_transcript
+
+
+class PausedStream(TokenIterator):
+    """Blocks the decode loop on the first token, until `resume` is set."""
+
+    def __init__(self):
+        super().__init__(skip_prompt=False)
+        self.started = threading.Event()
+        self.resume = threading.Event()
+
+    def push(self, token_id):
+        super().push(token_id)
+        if not self.started.is_set():
+            self.started.set()
+            assert self.resume.wait(timeout=60)
+
+
+@pytest.fixture(scope="module")
+def inference(tiny_llama):
+    return LlamaInference(
+        str(tiny_llama), device="cpu", torch_dtype=torch.float32, max_new_tokens=24
+    )
+
+
+def test_scheduler_matches_inference(inference):
+    """Concurrent requests of mixed lengths, one joining mid-decode, decode
+    greedily as `LlamaInference` decodes each of them alone."""
+    prompts = [random_transcript(n, seed=n) for n in [30, 2, 60, 8, 15]]
+    max_new_tokens = [40, 24, 24, 10, 24]
+    references = [
+        inference(p, max_new_tokens=n) for p, n in zip(prompts, max_new_tokens)
+    ]
+    assert len(set(references)) == len(references)
+
+    scheduler = LlamaScheduler.from_inference(inference, max_batch_size=4)
+    try:
+        stream = PausedStream()
+        first = scheduler.submit(prompts[0], max_new_tokens=40, streamer=stream)
+        assert stream.started.wait(timeout=60)
+        # The first request is being decoded, the others join its batch
+        futures = [first] + [
+            scheduler.submit(prompt, max_new_tokens=n)
+            for prompt, n in zip(prompts[1:], max_new_tokens[1:])
+        ]
+        assert not first.done()
+        stream.resume.set()
+        outputs = [future.result(timeout=120) for future in futures]
+    finally:
+        stream.resume.set()
+        scheduler.close()
+
+    assert outputs == references
@@ -0,0 +1,80 @@
+"""
+Export Chapter-Llama to GGUF for the llama.cpp engine.
+
+    python -m tools.export.gguf asr-10k captions_asr-10k --quantization Q4_K_M
+
+The base model (`--ckpt_path`) is converted and quantized once, and each
+adapter (an alias of `tools.download.models.MODEL_PATHS` or a path, all the
+aliases if none is given) is converted to a GGUF LoRA, in `--gguf_dir`. The
+conversion uses the scripts of a llama.cpp checkout (`--llama_cpp_dir` or
+`$LLAMA_CPP_DIR`, see `src.models.gguf_export`).
+"""
+
+from pathlib import Path
+
+from src.models.gguf_export import (
+    GGUF_DIR,
+    GGUF_QUANTIZATIONS,
+    export_base,
+    export_lora,
+)
+from tools.download.models import MODEL_PATHS, download_model
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Export the base model and LoRA adapters to GGUF for llama.cpp"
+    )
+    parser.add_argument(
+        "model_ids",
+        type=str,
+        nargs="*",
+        default=list(MODEL_PATHS),
+        help="IDs or paths of the LoRA adapters to export (all the IDs by default)",
+    )
+    parser.add_argument(
+        "--ckpt_path",
+        type=str,
+        default="meta-llama/Meta-Llama-3.1-8B-Instruct",
+        help="Base model of the adapters",
+    )
+    parser.add_argument(
+        "--gguf_dir", type=str, default=str(GGUF_DIR), help="Directory of the exports"
+    )
+    parser.add_argument(
+        "--quantization",
+        type=str,
+        default="Q4_K_M",
+        choices=GGUF_QUANTIZATIONS,
+        help="Quantization of the base model",
+    )
+    parser.add_argument(
+        "--llama_cpp_dir", type=str, default=None, help="Checkout of llama.cpp"
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="Export again if already exported"
+    )
+    args = parser.parse_args()
+
+    base_path = export_base(
+        args.ckpt_path,
+        gguf_dir=args.gguf_dir,
+        quantization=args.quantization,
+        llama_cpp_dir=args.llama_cpp_dir,
+        overwrite=args.overwrite,
+    )
+    print(f"Base model: {base_path}")
+
+    for model_id in args.model_ids:
+        peft_model = model_id
+        if not Path(peft_model).exists():
+            peft_model = download_model(model_id)
+        lora_path = export_lora(
+            peft_model,
+            args.ckpt_path,
+            gguf_dir=args.gguf_dir,
+            llama_cpp_dir=args.llama_cpp_dir,
+            overwrite=args.overwrite,
+        )
+        print(f"LoRA {model_id}: {lora_path}")
@@ -0,0 +1,70 @@
+"""
+Merge a Chapter-Llama LoRA into the base weights for inference.
+
+    python -m tools.export.merge_lora asr-10k
+
+The adapter (an alias of `tools.download.models.MODEL_PATHS` or a path) is
+merged into the base model and saved as sharded safetensors, with the hash
+of every shard, in `--merged_dir`. `LlamaInference` then finds the export
+from the adapter and loads it instead of the base model and the LoRA (see
+`src.models.merged_lora`), if it loads the same base model in the same
+`--dtype`: bfloat16 on CPU, float32 on GPU (unless `torch_dtype` is set).
+"""
+
+from pathlib import Path
+
+import torch
+
+from src.models.merged_lora import MERGED_DIR, merge_lora, verify_merged
+from tools.download.models import download_model
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Merge a LoRA adapter into the base model weights"
+    )
+    parser.add_argument(
+        "model_id", type=str, help="ID or path of the LoRA adapter to merge"
+    )
+    parser.add_argument(
+        "--ckpt_path",
+        type=str,
+        default="meta-llama/Meta-Llama-3.1-8B-Instruct",
+        help="Base model of the adapter",
+    )
+    parser.add_argument(
+        "--merged_dir",
+        type=str,
+        default=str(MERGED_DIR),
+        help="Directory of the merged checkpoints",
+    )
+    parser.add_argument(
+        "--max_shard_size", type=str, default="5GB", help="Size of the shards"
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="bfloat16",
+        choices=["bfloat16", "float16", "float32"],
+        help="Dtype of the merged weights, the one the model is loaded in",
+    )
+    parser.add_argument(
+        "--overwrite", action="store_true", help="Export again if already merged"
+    )
+    args = parser.parse_args()
+
+    peft_model = args.model_id
+    if not Path(peft_model).exists():
+        peft_model = download_model(args.model_id)
+
+    output_dir = merge_lora(
+        args.ckpt_path,
+        peft_model,
+        merged_dir=args.merged_dir,
+        max_shard_size=args.max_shard_size,
+        dtype=getattr(torch, args.dtype),
+        overwrite=args.overwrite,
+    )
+    print(f"Merged checkpoint: {output_dir}")
+    print(f"Shards verified: {verify_merged(output_dir)}")
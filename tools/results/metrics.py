@@ -2,7 +2,8 @@ from pathlib import Path
 
 from lutils import openf
 
-from src.data.chapters import Chapters, hms_to_sec
+from src.data.chapters import Chapters
+from src.data.timestamps import hms_to_sec
 from tools.results.metrics_caption import (
     CaptionSegmentEvaluator,
     get_n_captions,
@@ -77,6 +78,9 @@ class MetricsExperiment:
 
     def get_subset_refs(self, subset: str, hms=False, segments=False):
         subset_ids = self.chp.get_subset_ids(subset)
+        if segments:
+            assert not hms, "With segments, cannot have hms format"
+            return self.chp.get_subset_chapter_segments(subset_ids)
 
         vid2refs = {}
         for vid_id in subset_ids: